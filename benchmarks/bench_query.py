@@ -0,0 +1,80 @@
+""" Compares MySearchEngine.query against the original exhaustive scoring path.
+
+    The original path scored every match with cosine_similarity() and sorted the
+    whole list to keep the top k. Run from the repository root:
+
+        python benchmarks/bench_query.py --sizes 1000 5000 20000
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from news_buddy.SearchEngine import MySearchEngine
+from synthetic import generate_documents, make_vocabulary
+
+
+class _TermsOnlyEngine(MySearchEngine):
+    # entity extraction doesn't affect query scoring; skip it to keep setup fast
+    def get_entities_from_text(self, text):
+        return []
+
+
+def exhaustive_query(engine, q, k=10, mode="or"):
+    """ The original query(): cosine similarity for every match, full sort. """
+    query_tokens = engine.tokenize(q)
+    if mode == "or":
+        ids = engine.get_matches_OR(query_tokens)
+    else:
+        ids = engine.get_matches_AND(query_tokens)
+    query_tv = Counter(query_tokens)
+    scores = [(id, engine.cosine_similarity(query_tv, engine.term_vectors[id])) for id in ids]
+    scores = sorted(scores, key=lambda t: t[1], reverse=True)
+    return scores[:k]
+
+
+def time_queries(fn, queries, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in queries:
+            fn(q)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--vocab-size", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--entities", action="store_true",
+                        help="also run entity extraction while indexing (slow)")
+    args = parser.parse_args()
+
+    vocab = make_vocabulary(args.vocab_size)
+    # common, mid-frequency and rare terms, as single and multi-word queries
+    queries = [vocab[0], vocab[5] + " " + vocab[50], vocab[1] + " " + vocab[300] + " " + vocab[4000],
+               vocab[2] + " " + vocab[3]]
+
+    print("%8s %5s %3s %14s %14s %8s" % ("docs", "mode", "k", "exhaustive ms", "query ms", "speedup"))
+    for size in args.sizes:
+        engine = MySearchEngine() if args.entities else _TermsOnlyEngine()
+        for id, text in generate_documents(size, vocab_size=args.vocab_size).items():
+            engine.add(id, text)
+        engine.refresh_stats()
+
+        # queries are repeated, so time the scoring rather than the result cache
+        engine.query_cache = None
+
+        for mode in ("or", "and"):
+            for k in (1, 10):
+                old = time_queries(lambda q: exhaustive_query(engine, q, k, mode), queries, args.repeat)
+                new = time_queries(lambda q: engine.query(q, k, mode), queries, args.repeat)
+                print("%8d %5s %3d %14.3f %14.3f %7.1fx" % (size, mode, k, old * 1e3, new * 1e3, old / max(new, 1e-12)))
+
+
+if __name__ == "__main__":
+    main()
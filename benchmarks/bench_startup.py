@@ -0,0 +1,61 @@
+""" Measures how long `import news_buddy` and the first query take in a fresh interpreter.
+
+    Each measurement runs in a new subprocess so that nothing is cached in
+    sys.modules. Run from the repository root:
+
+        python benchmarks/bench_startup.py --index mysearchengine.idx --query "north korea"
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the subprocess; prints a JSON dict of timings in milliseconds
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import news_buddy
+imported = time.perf_counter()
+timings = {"import_ms": (imported - start) * 1e3,
+           "heavy_modules_loaded": sorted(m for m in ("nltk", "numpy", "feedparser", "justext", "requests")
+                                          if m in sys.modules)}
+if len(sys.argv) > 1:
+    engine = news_buddy.open_search_engine(sys.argv[1])
+    opened = time.perf_counter()
+    engine.query(sys.argv[2], k=10)
+    queried = time.perf_counter()
+    timings["open_ms"] = (opened - imported) * 1e3
+    timings["first_query_ms"] = (queried - opened) * 1e3
+print(json.dumps(timings))
+"""
+
+
+def run_probe(index, query):
+    args = [sys.executable, "-c", PROBE]
+    if index is not None:
+        args += [index, query]
+    output = subprocess.run(args, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--index", help="index directory or pickle to open (optional)")
+    parser.add_argument("--query", default="president")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_probe(args.index, args.query) for _ in range(args.repeat)]
+    summary = {"heavy_modules_loaded": runs[-1]["heavy_modules_loaded"]}
+    for key in ("import_ms", "open_ms", "first_query_ms"):
+        if key in runs[0]:
+            summary[key + "_median"] = statistics.median(run[key] for run in runs)
+    print(json.dumps(summary, indent=1))
+
+
+if __name__ == "__main__":
+    main()
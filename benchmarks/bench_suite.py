@@ -0,0 +1,366 @@
+""" End-to-end benchmarks of ingestion, storage and queries, written as JSON for comparison.
+
+    Runs against either corpus:
+
+        synthetic   articles from synthetic.generate_articles (Zipfian words and
+                    entities), indexed with their known entities at each of --sizes; the
+                    NLP pipeline only runs with --nlp, so ingest measures tokenizing and
+                    indexing
+        DIRECTORY   a corpus written by recorded_corpus.py, served by a local HTTP server
+                    and ingested end to end through IngestionPipeline (needs the nltk data)
+
+    Each index reports ingest docs/s, memory (memory_usage() and growth of the
+    resident set), save_index / load_index time and size on disk, and p50 / p99
+    latency of query (per mode), new_with, most_associated_with_phrase and
+    most_associated_with_entity over queries sampled from the index itself. Each
+    size runs in a fresh interpreter so memory figures don't carry over. The query
+    cache is disabled, so repeated queries are scored again. Run from the repository root:
+
+        python benchmarks/bench_suite.py --sizes 1000 100000 1000000 --output results.json
+        python benchmarks/bench_suite.py --corpus corpus/ --output recorded.json
+        python benchmarks/bench_suite.py --sizes 1000 100000 --compare results.json
+
+    --compare exits with status 1 if a latency, duration or size grew, or a rate
+    dropped, by more than --tolerance relative to the earlier results.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import news_buddy as nb
+from news_buddy.SearchEngine import MySearchEngine
+from news_buddy.docstore import FileDocumentStore
+from news_buddy.storage import load_index, save_index
+from news_buddy.tokenizer import normalize_tokens, split_words
+from recorded_corpus import CorpusServer
+from synthetic import generate_articles
+
+FORMAT = 1
+
+
+def rss_bytes():
+    """ Returns the resident set size of this process, or None where /proc isn't available. """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def percentiles(seconds):
+    """ Returns count, mean, p50 and p99 (nearest rank) in milliseconds. """
+    ordered = sorted(seconds)
+    if not ordered:
+        return {"count": 0}
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))] * 1e3
+
+    return {"count": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1e3,
+            "p50_ms": rank(50), "p99_ms": rank(99), "max_ms": ordered[-1] * 1e3}
+
+
+def time_calls(function, arguments, warmup=3):
+    """ Calls function(argument) for each argument and returns the latencies. """
+    for argument in arguments[:warmup]:
+        function(argument)
+    seconds = []
+    for argument in arguments:
+        start = time.perf_counter()
+        function(argument)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+# ------------------------------------------------------------------------
+#  building indexes
+# ------------------------------------------------------------------------
+
+def new_engine(args, workdir):
+    doc_store = FileDocumentStore(os.path.join(workdir, "texts")) if args.texts_on_disk else None
+    return MySearchEngine(doc_store=doc_store, tokenizer=args.tokenizer, positions=args.positions)
+
+
+def ingest_synthetic(engine, args, size):
+    """ Indexes size synthetic articles; generating them isn't timed. """
+    seconds = 0.0
+    for id, text, entities, timestamp in generate_articles(size, vocab_size=args.vocab_size,
+                                                           num_entities=args.entities, seed=args.seed):
+        start = time.perf_counter()
+        if args.nlp:
+            engine.add(id, text, timestamp)
+        else:
+            tokens = normalize_tokens(split_words(text, engine.tokenizer))
+            engine.add_annotated(id, text, tokens, entities, timestamp)
+        seconds += time.perf_counter() - start
+    start = time.perf_counter()
+    engine.refresh_stats()
+    refresh = time.perf_counter() - start
+    return {"docs": engine.num_docs(), "seconds": seconds, "refresh_seconds": refresh,
+            "docs_per_second": engine.num_docs() / max(seconds + refresh, 1e-12)}
+
+
+def ingest_recorded(engine, args):
+    """ Streams a recorded corpus into the engine through a local HTTP server. """
+    with CorpusServer(args.corpus, delay=args.delay) as server:
+        pipeline = nb.IngestionPipeline(engine, workers={"fetch": args.fetch_workers},
+                                        processes=args.processes)
+        start = time.perf_counter()
+        stages = pipeline.run(server.feed_urls())
+        seconds = time.perf_counter() - start
+        served = server.stats()
+    start = time.perf_counter()
+    engine.refresh_stats()
+    refresh = time.perf_counter() - start
+    return {"docs": engine.num_docs(), "seconds": seconds, "refresh_seconds": refresh,
+            "docs_per_second": engine.num_docs() / max(seconds + refresh, 1e-12),
+            "errors": sum(stage["errors"] for stage in stages.values()),
+            "stages": stages, "http": served}
+
+
+# ------------------------------------------------------------------------
+#  measurements
+# ------------------------------------------------------------------------
+
+def sample_queries(engine, args):
+    """ Returns {kind: [arguments]} sampled from the index: term queries mixing common,
+        mid-frequency and rare terms, phrases cut out of documents and entities drawn
+        by the number of documents mentioning them.
+    """
+    rng = random.Random(args.seed)
+    index = engine.inverted_index
+    terms = sorted(index, key=lambda term: (-len(index[term]), term))
+    # the most common terms are function words, rarely searched on their own
+    terms = [term for term in terms[len(terms) // 100:] if term.isalpha()] or terms
+    third = max(1, len(terms) // 3)
+    bands = [terms[:third], terms[third:2 * third] or terms, terms[2 * third:] or terms]
+
+    # a common term, then a mid-frequency and a rare one
+    queries = []
+    for _ in range(args.queries):
+        length = rng.choice((1, 2, 2, 3))
+        queries.append(" ".join(rng.choice(bands[i]) for i in range(length)))
+
+    ids = list(engine.raw_text) if args.positions else []
+    phrases = []
+    for _ in range(args.queries if ids else 0):
+        id = rng.choice(ids)
+        tokens = engine.tokenize(engine.get(id))
+        if len(tokens) < 3:
+            continue
+        start = rng.randrange(len(tokens) - 2)
+        phrases.append(" ".join(tokens[start:start + rng.choice((2, 3))]))
+
+    coocurrences = engine.entity_coocurrences
+    entities = sorted(coocurrences)
+    weights = [coocurrences.doc_count(entity) for entity in entities]
+    entities = rng.choices(entities, weights=weights, k=args.queries) if entities else []
+    return {"terms": queries, "phrases": phrases, "entities": entities}
+
+
+def measure_latency(engine, queries, args):
+    engine.query_cache = None
+    operations = {
+        "query_or": (lambda q: engine.query(q, k=10, mode="or"), queries["terms"]),
+        "query_and": (lambda q: engine.query(q, k=10, mode="and"), queries["terms"]),
+        "new_with": (lambda q: nb.new_with(q, search_engine=engine), queries["terms"]),
+        "most_associated_with_phrase": (lambda q: nb.most_associated_with_phrase(q, search_engine=engine),
+                                        queries["terms"]),
+        "most_associated_with_entity": (lambda entity: nb.most_associated_with_entity(entity, search_engine=engine),
+                                        queries["entities"]),
+    }
+    if args.positions:
+        operations["query_phrase"] = (lambda q: engine.query(q, k=10, mode="phrase"), queries["phrases"])
+        operations["query_near"] = (lambda q: engine.query(q, k=10, mode="near", window=10), queries["terms"])
+    return {name: percentiles(time_calls(function, arguments)) for name, (function, arguments) in operations.items()}
+
+
+def measure_storage(engine, workdir, first_query):
+    path = os.path.join(workdir, "index")
+    start = time.perf_counter()
+    save_index(engine, path)
+    saved = time.perf_counter()
+    loaded_engine = load_index(path)
+    loaded = time.perf_counter()
+    loaded_engine.query(first_query, k=10)
+    queried = time.perf_counter()
+    result = {"save_seconds": saved - start, "load_seconds": loaded - saved,
+              "first_query_seconds": queried - loaded, "disk_bytes": directory_bytes(path)}
+    del loaded_engine
+    shutil.rmtree(path)
+    return result
+
+
+def run(args, size=None):
+    """ Builds one index (size synthetic articles, or the recorded corpus if size is
+        None) and returns its results.
+    """
+    workdir = tempfile.mkdtemp(prefix="news_buddy-bench-", dir=args.workdir)
+    try:
+        gc.collect()
+        rss_before = rss_bytes()
+        engine = new_engine(args, workdir)
+        if size is None:
+            ingest = ingest_recorded(engine, args)
+        else:
+            ingest = ingest_synthetic(engine, args, size)
+        rss_after = rss_bytes()
+
+        memory = engine.memory_usage()
+        memory["rss_growth_bytes"] = None if rss_before is None else rss_after - rss_before
+
+        queries = sample_queries(engine, args)
+        result = {"corpus": "synthetic" if size is not None else args.corpus,
+                  "size": size if size is not None else ingest["docs"],
+                  "ingest": ingest,
+                  "memory": memory,
+                  "latency": measure_latency(engine, queries, args)}
+        if not args.skip_storage:
+            result["storage"] = measure_storage(engine, workdir, queries["terms"][0] if queries["terms"] else "")
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# ------------------------------------------------------------------------
+#  reports
+# ------------------------------------------------------------------------
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "commit": commit}
+
+
+def flatten(result, prefix=""):
+    """ Returns {"a.b.c": value} of the numbers in nested dicts. """
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(baseline, current, tolerance):
+    """ Returns a line per metric that got worse by more than tolerance (a fraction):
+        *_ms, *_seconds and *_bytes are better lower, *per_second better higher.
+    """
+    regressions = []
+    earlier = {(result["corpus"], result["size"]): flatten(result) for result in baseline["results"]}
+    for result in current["results"]:
+        before = earlier.get((result["corpus"], result["size"]))
+        if before is None:
+            continue
+        for name, value in sorted(flatten(result).items()):
+            old = before.get(name)
+            # per-stage pipeline counters and the like depend on timing; only compare the headline figures
+            if not old or ".stages." in "." + name or name.startswith("ingest.http"):
+                continue
+            change = (value - old) / old
+            if name.endswith("per_second"):
+                worse = change < -tolerance
+            elif name.endswith(("_ms", "_seconds", "_bytes")):
+                worse = change > tolerance
+            else:
+                continue
+            if worse:
+                regressions.append("%s %s: %s: %.4g -> %.4g (%+.1f%%)" % (result["corpus"], result["size"], name,
+                                                                         old, value, change * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default="synthetic",
+                        help="\"synthetic\" or the directory of a recorded corpus")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000],
+                        help="numbers of synthetic articles")
+    parser.add_argument("--vocab-size", type=int, default=20000)
+    parser.add_argument("--entities", type=int, default=2000, help="number of distinct synthetic entities")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=200, help="queries per operation")
+    parser.add_argument("--tokenizer", default="fast")
+    parser.add_argument("--positions", action="store_true", help="build a positional index and time phrase queries")
+    parser.add_argument("--nlp", action="store_true",
+                        help="run the NLP pipeline on synthetic articles instead of using their entities")
+    parser.add_argument("--texts-on-disk", action="store_true", help="keep article texts in a FileDocumentStore")
+    parser.add_argument("--skip-storage", action="store_true", help="don't time save_index / load_index")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="download threads (recorded corpus)")
+    parser.add_argument("--processes", type=int, default=None, help="NLP processes (recorded corpus)")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds the local server waits per request")
+    parser.add_argument("--workdir", default=None, help="where indexes are saved while timing (default: temp dir)")
+    parser.add_argument("--in-process", action="store_true", help="run every size in this interpreter")
+    parser.add_argument("--output", help="JSON file to write the results to (default: stdout)")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--child-size", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child_size is not None:
+        # one size in a fresh interpreter; the parent reads the JSON from stdout
+        print(json.dumps(run(args, args.child_size)))
+        return
+
+    results = []
+    if args.corpus != "synthetic":
+        results.append(run(args))
+    else:
+        for size in args.sizes:
+            if args.in_process:
+                result = run(args, size)
+            else:
+                output = subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                        ["--child-size", str(size)], check=True, capture_output=True,
+                                        text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print("%8d docs: %.0f docs/s, query_or p50 %.2f ms p99 %.2f ms" % (
+                size, result["ingest"]["docs_per_second"], result["latency"]["query_or"]["p50_ms"],
+                result["latency"]["query_or"]["p99_ms"]), file=sys.stderr)
+
+    report = {"format": FORMAT, "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "environment": environment(),
+              "config": {key: value for key, value in vars(args).items()
+                         if key not in ("output", "compare", "child_size", "in_process")},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        for line in regressions:
+            print("regression: " + line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
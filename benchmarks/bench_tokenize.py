@@ -0,0 +1,101 @@
+""" Compares the throughput of the "nltk" and "fast" tokenizers and checks that they agree.
+
+    Tokens per second are measured for split_words() followed by normalize_tokens(),
+    i.e. what MySearchEngine.tokenize does. The corpus is synthetic news-like text
+    (sentences with quotes, contractions, abbreviations and numbers) or the articles
+    of a pickle written by collect_rss.collect(). Run from the repository root:
+
+        python benchmarks/bench_tokenize.py --docs 2000
+        python benchmarks/bench_tokenize.py --texts rssdata.txt
+"""
+import argparse
+import os
+import pickle
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from news_buddy.tokenizer import TOKENIZERS, compare_tokenizers, normalize_tokens, split_words
+from synthetic import generate_documents
+
+_DECORATIONS = [
+    lambda s: '"' + s[:-1] + '," said Mr. Smith.',
+    lambda s: "The U.S. economy grew 2.5% in Q3, and " + s,
+    lambda s: s + " It isn't clear whether they'll agree (or won't).",
+    lambda s: "On Jan. 5, officials' report -- released at 10:30 a.m. -- said " + s,
+    lambda s: s + " Shares rose $1,250.75 to a record; analysts didn't comment...",
+    lambda s: "'" + s[:-1] + "' was the company's answer to the government's e-mail.",
+]
+
+
+def news_like_documents(num_docs, seed=0):
+    """ Synthetic documents with the punctuation of news articles mixed into their sentences. """
+    rng = random.Random(seed)
+    docs = []
+    for text in generate_documents(num_docs, seed=seed).values():
+        sentences = text.split(". ")
+        docs.append(" ".join(rng.choice(_DECORATIONS)(s.rstrip(".") + ".") if rng.random() < 0.5 else s + "."
+                             for s in sentences))
+    return docs
+
+
+def load_texts(filename):
+    """ Returns the article texts of a collect_rss.collect() pickle. """
+    with open(filename, "rb") as f:
+        data = pickle.load(f)
+    # collect(with_published=True) pickles (texts, published)
+    if isinstance(data, tuple):
+        data = data[0]
+    return list(data.values())
+
+
+def tokens_per_second(tokenizer, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        num_tokens = 0
+        for text in texts:
+            num_tokens += len(normalize_tokens(split_words(text, tokenizer)))
+        best = min(best, time.perf_counter() - start)
+    return num_tokens, num_tokens / max(best, 1e-12)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--docs", type=int, default=2000, help="number of synthetic documents")
+    parser.add_argument("--texts", help="pickle written by collect_rss.collect() to use instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--examples", type=int, default=10,
+                        help="number of disagreeing tokens to show")
+    args = parser.parse_args()
+
+    texts = load_texts(args.texts) if args.texts else news_like_documents(args.docs)
+
+    print("%8s %10s %14s" % ("tokenizer", "tokens", "tokens/s"))
+    rates = {}
+    for name in TOKENIZERS:
+        try:
+            num_tokens, rates[name] = tokens_per_second(name, texts, args.repeat)
+        except LookupError:
+            # nltk.word_tokenize needs the punkt data: nltk.download("punkt_tab")
+            print("%8s %10s %14s" % (name, "-", "no punkt data"))
+            continue
+        print("%8s %10d %14.0f" % (name, num_tokens, rates[name]))
+
+    if "nltk" not in rates:
+        print("nltk data missing; skipping the comparison.")
+        return
+    print("speedup: %.1fx" % (rates["fast"] / rates["nltk"]))
+
+    report = compare_tokenizers(texts, max_examples=args.examples)
+    print("identical documents: %d / %d" % (report["identical_documents"], report["documents"]))
+    print("token agreement: %.4f" % report["agreement"])
+    print("only nltk: " + ", ".join("%s (%d)" % item for item in report["only_reference"]))
+    print("only fast: " + ", ".join("%s (%d)" % item for item in report["only_candidate"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+""" Recorded news corpora: rss feeds and article pages on disk, served over local HTTP.
+
+    Benchmarks of the ingestion paths (update_via_rss_feed, IngestionPipeline,
+    FeedPoller) would otherwise depend on live feeds that change every hour and may
+    disappear. A corpus directory holds:
+
+        manifest.json       format, feed files, number of articles, where they came from
+        feeds/*.xml         rss documents whose links point at BASE_URL/articles/...
+        articles/*.html     the article pages
+
+    CorpusServer serves a corpus from a local HTTP server, replacing BASE_URL with
+    its own address in the feeds, so the articles are downloaded, extracted and
+    annotated exactly like live ones. Corpora are written from live feeds (record)
+    or from the synthetic generator (synthetic). Run from the repository root:
+
+        python benchmarks/recorded_corpus.py record corpus/ http://feeds.reuters.com/reuters/topNews
+        python benchmarks/recorded_corpus.py synthetic corpus/ --docs 5000
+        python benchmarks/recorded_corpus.py serve corpus/ --port 8000
+"""
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import article_html, generate_articles
+
+__all__ = ["BASE_URL", "write_synthetic_corpus", "record_feeds", "read_manifest", "CorpusServer"]
+
+# stands for the server's address in recorded feeds
+BASE_URL = "http://recorded-corpus.invalid"
+
+FORMAT = 1
+
+_CONTENT_TYPES = {".xml": "application/rss+xml; charset=utf-8", ".html": "text/html; charset=utf-8",
+                  ".json": "application/json"}
+
+
+def _rss(title, items):
+    """ Returns an rss 2.0 document of (title, link, timestamp, description) items. """
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<rss version="2.0"><channel>',
+             "<title>" + escape(title) + "</title><link>" + BASE_URL + "/</link>",
+             "<description>" + escape(title) + "</description>"]
+    for item_title, link, timestamp, description in items:
+        lines.append("<item><title>" + escape(item_title) + "</title><link>" + escape(link) + "</link>"
+                     '<guid isPermaLink="true">' + escape(link) + "</guid>"
+                     "<pubDate>" + formatdate(timestamp, usegmt=True) + "</pubDate>"
+                     "<description>" + escape(description) + "</description></item>")
+    lines.append("</channel></rss>")
+    return "\n".join(lines) + "\n"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _write_manifest(directory, feeds, articles, source):
+    manifest = {"format": FORMAT, "base_url": BASE_URL, "feeds": feeds, "articles": articles,
+                "source": source, "recorded": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+def read_manifest(directory):
+    """ Returns the manifest of a corpus directory. """
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        raise ValueError("unsupported corpus format in [" + directory + "].")
+    return manifest
+
+
+def write_synthetic_corpus(directory, num_docs, num_feeds=10, seed=0, **kwargs):
+    """ Writes num_docs synthetic articles (see synthetic.generate_articles, which takes
+        the other keyword arguments) spread round-robin over num_feeds feeds; returns
+        the manifest.
+    """
+    items = [[] for _ in range(num_feeds)]
+    for i, (id, text, entities, timestamp) in enumerate(generate_articles(num_docs, seed=seed, **kwargs)):
+        name = "%d.html" % i
+        title = text.split(". ")[0][:80]
+        _write(os.path.join(directory, "articles", name), article_html(title, text).encode("utf-8"))
+        items[i % num_feeds].append((title, BASE_URL + "/articles/" + name, timestamp, title))
+
+    feeds = []
+    for number, feed_items in enumerate(items):
+        name = "feeds/synthetic-%02d.xml" % number
+        # newest first, like live feeds
+        _write(os.path.join(directory, name), _rss("Synthetic feed %d" % number, feed_items[::-1]).encode("utf-8"))
+        feeds.append(name)
+    return _write_manifest(directory, feeds, num_docs, {"synthetic": {"docs": num_docs, "seed": seed}})
+
+
+def record_feeds(directory, feed_urls, timeout=10, print_status=True):
+    """ Downloads live rss feeds and the pages of their entries into a corpus
+        directory, pointing the feeds' links at the recorded pages; returns the manifest.
+        Entries whose page fails to download are left out of the recorded feeds.
+    """
+    import feedparser
+    from news_buddy.collect_rss import entry_timestamp, make_session
+
+    session = make_session()
+    feeds = []
+    articles = 0
+    for url in feed_urls:
+        response = session.get(url, timeout=timeout)
+        response.raise_for_status()
+        parsed = feedparser.parse(response.content)
+
+        items = []
+        for entry in parsed["entries"]:
+            link = entry.get("link")
+            if link is None:
+                continue
+            try:
+                page = session.get(link, timeout=timeout)
+                page.raise_for_status()
+            except Exception as e:
+                if print_status:
+                    print("skipped " + link + ": " + str(e))
+                continue
+            name = hashlib.sha1(link.encode("utf-8")).hexdigest()[:20] + ".html"
+            _write(os.path.join(directory, "articles", name), page.content)
+            articles += 1
+            timestamp = entry_timestamp(entry)
+            items.append((entry.get("title", ""), BASE_URL + "/articles/" + name,
+                          time.time() if timestamp is None else timestamp,
+                          entry.get("summary", "")))
+
+        # the feed is rewritten rather than patched, so no entry still points at the live site
+        name = "feeds/" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:20] + ".xml"
+        title = parsed["feed"].get("title", url)
+        _write(os.path.join(directory, name), _rss(title, items).encode("utf-8"))
+        feeds.append(name)
+        if print_status:
+            print("recorded %d articles of %s" % (len(items), url))
+    session.close()
+    return _write_manifest(directory, feeds, articles, {"feeds": list(feed_urls)})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        root = server.directory
+        path = os.path.normpath(os.path.join(root, self.path.split("?")[0].lstrip("/")))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        extension = os.path.splitext(path)[1]
+        if extension == ".xml":
+            data = data.replace(BASE_URL.encode("ascii"), server.url.encode("ascii"))
+        if server.delay:
+            time.sleep(server.delay)
+        with server.lock:
+            server.requests += 1
+            server.bytes_sent += len(data)
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPES.get(extension, "application/octet-stream"))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CorpusServer():
+    """
+    Serves a corpus directory over HTTP from a background thread; use it in a with
+    block or call close().
+
+    params:
+        directory [String]:
+            The corpus directory, as written by write_synthetic_corpus or record_feeds.
+
+        host [String], port [int]:
+            Address to listen on; port 0 picks a free one.
+
+        delay [float]:
+            Seconds to wait before answering each request, to stand in for network latency.
+    """
+
+    def __init__(self, directory, host="127.0.0.1", port=0, delay=0.0):
+        self.manifest = read_manifest(directory)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.directory = os.path.abspath(directory)
+        self._server.url = "http://%s:%d" % self._server.server_address[:2]
+        self._server.delay = delay
+        self._server.lock = threading.Lock()
+        self._server.requests = 0
+        self._server.bytes_sent = 0
+        self._thread = threading.Thread(target=self._server.serve_forever, name="corpus-server", daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return self._server.url
+
+    def feed_urls(self):
+        """ Returns the urls of the corpus' feeds on this server. """
+        return [self.url + "/" + name for name in self.manifest["feeds"]]
+
+    def stats(self):
+        """ Returns the number of requests answered and bytes sent. """
+        with self._server.lock:
+            return {"requests": self._server.requests, "bytes_sent": self._server.bytes_sent}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="record live feeds and their articles")
+    record.add_argument("directory")
+    record.add_argument("feeds", nargs="+")
+    record.add_argument("--timeout", type=float, default=10)
+
+    synthetic = commands.add_parser("synthetic", help="write a synthetic corpus")
+    synthetic.add_argument("directory")
+    synthetic.add_argument("--docs", type=int, default=1000)
+    synthetic.add_argument("--feeds", type=int, default=10)
+    synthetic.add_argument("--seed", type=int, default=0)
+
+    serve = commands.add_parser("serve", help="serve a corpus until interrupted")
+    serve.add_argument("directory")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        manifest = record_feeds(args.directory, args.feeds, timeout=args.timeout)
+        print("recorded %d articles from %d feeds" % (manifest["articles"], len(manifest["feeds"])))
+    elif args.command == "synthetic":
+        manifest = write_synthetic_corpus(args.directory, args.docs, num_feeds=args.feeds, seed=args.seed)
+        print("wrote %d articles in %d feeds" % (manifest["articles"], len(manifest["feeds"])))
+    else:
+        server = CorpusServer(args.directory, args.host, args.port, args.delay)
+        print("serving " + args.directory + " at " + server.url + "; feeds:")
+        for url in server.feed_urls():
+            print("  " + url)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.close()
+
+
+if __name__ == "__main__":
+    main()
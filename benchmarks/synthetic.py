@@ -0,0 +1,149 @@
+""" Synthetic news-like corpus for benchmarks.
+
+    Words are drawn from a Zipfian distribution over a fixed vocabulary so that
+    postings lengths look like those of real text: a few very common terms and a
+    long tail of rare ones. generate_articles() adds named entities, also drawn from
+    a Zipfian distribution, and English function words, so that the articles survive
+    justext's boilerplate removal when served as HTML pages (see recorded_corpus.py).
+"""
+from xml.sax.saxutils import escape
+import random
+
+__all__ = ["make_vocabulary", "make_entity_names", "generate_documents", "generate_articles", "article_html"]
+
+# mixed into generated articles; justext keeps paragraphs dense in stopwords only
+FUNCTION_WORDS = ["the", "of", "and", "to", "a", "in", "that", "is", "was", "for", "on", "with", "as",
+                  "by", "at", "from", "it", "his", "her", "be", "has", "have", "are", "were", "which",
+                  "not", "but", "this", "an", "their", "they", "been", "after", "who", "would"]
+
+# first article timestamp (2018-01-01 UTC), so generated corpora don't depend on the clock
+START_TIME = 1514764800.0
+
+
+def make_vocabulary(size, seed=0):
+    """ Returns a list of `size` distinct pronounceable lowercase words. """
+    rng = random.Random(seed)
+    consonants = "bcdfghklmnprstvz"
+    vowels = "aeiou"
+    words = set()
+    while len(words) < size:
+        length = rng.randint(2, 4)
+        words.add("".join(rng.choice(consonants) + rng.choice(vowels) for _ in range(length)))
+    return sorted(words)
+
+
+def make_entity_names(size, seed=0):
+    """ Returns a list of `size` distinct capitalized names of one to three words. """
+    rng = random.Random(seed + 1)
+    words = make_vocabulary(max(size, 100), seed + 1)
+    names = set()
+    while len(names) < size:
+        names.add(" ".join(rng.choice(words).capitalize() for _ in range(rng.choice((1, 2, 2, 3)))))
+    return sorted(names)
+
+
+def _zipf_cumulative_weights(size, s):
+    weights = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1.0 / (rank ** s)
+        weights.append(total)
+    return weights
+
+
+def generate_documents(num_docs, vocab_size=20000, doc_length=(80, 400), zipf_s=1.1, seed=0):
+    """ Returns a dict mapping synthetic document ids (URLs) to text.
+
+        params:
+            num_docs[int]:
+                Number of documents to generate.
+
+            vocab_size[int]:
+                Number of distinct words.
+
+            doc_length[tuple(int, int)]:
+                Inclusive range of words per document.
+
+            zipf_s[float]:
+                Exponent of the Zipf distribution; larger means more skewed.
+
+            seed[int]:
+                Seed for reproducible output.
+    """
+    rng = random.Random(seed)
+    vocab = make_vocabulary(vocab_size, seed)
+
+    # cumulative Zipf weights for rank r: 1 / r^s
+    weights = [1.0 / (rank ** zipf_s) for rank in range(1, vocab_size + 1)]
+
+    docs = {}
+    for i in range(num_docs):
+        length = rng.randint(*doc_length)
+        words = rng.choices(vocab, weights=weights, k=length)
+        # break into sentences of roughly 20 words
+        sentences = [" ".join(words[j:j + 20]).capitalize() + "." for j in range(0, length, 20)]
+        docs["http://synthetic.local/article/%d" % i] = " ".join(sentences)
+    return docs
+
+
+def generate_articles(num_docs, vocab_size=20000, num_entities=2000, doc_length=(80, 400), zipf_s=1.1,
+                      entities_per_doc=(1, 12), interval=60.0, seed=0):
+    """ Yields (id, text, entities, timestamp) for synthetic news articles, one at a time
+        so that large corpora needn't fit in memory.
+
+        params:
+            num_docs[int], vocab_size[int], doc_length[tuple(int, int)], zipf_s[float], seed[int]:
+                As for generate_documents(); doc_length counts content words, and
+                about as many function words are mixed in.
+
+            num_entities[int]:
+                Number of distinct entity names, drawn with the same Zipf exponent.
+
+            entities_per_doc[tuple(int, int)]:
+                Inclusive range of entity mentions per article; each starts a sentence.
+
+            interval[float]:
+                Seconds between the timestamps of consecutive articles, from START_TIME.
+
+        returns:
+            entities are in the format of MySearchEngine.get_entities_from_text, e.g.
+            [[('North', 'NNP'), ('Korea', 'NNP')], ...].
+    """
+    rng = random.Random(seed)
+    vocab = make_vocabulary(vocab_size, seed)
+    names = make_entity_names(num_entities, seed)
+    word_weights = _zipf_cumulative_weights(vocab_size, zipf_s)
+    name_weights = _zipf_cumulative_weights(num_entities, zipf_s)
+
+    for i in range(num_docs):
+        length = rng.randint(*doc_length)
+        words = rng.choices(vocab, cum_weights=word_weights, k=length)
+        fillers = rng.choices(FUNCTION_WORDS, k=length)
+        mentions = rng.choices(names, cum_weights=name_weights, k=rng.randint(*entities_per_doc))
+
+        # sentences of ten function words each followed by a content word, the first
+        # ones opened by an entity mention
+        sentences = []
+        for j in range(0, length, 10):
+            sentence = " ".join(filler + " " + word for word, filler in zip(words[j:j + 10], fillers[j:j + 10]))
+            if len(sentences) < len(mentions):
+                sentence = mentions[len(sentences)] + " " + sentence
+            else:
+                sentence = sentence.capitalize()
+            sentences.append(sentence + ".")
+        # mentions beyond the number of sentences are left out
+        entities = [[(part, "NNP") for part in name.split(" ")] for name in mentions[:len(sentences)]]
+        yield ("http://synthetic.local/article/%d" % i, " ".join(sentences), entities, START_TIME + i * interval)
+
+
+def article_html(title, text, paragraph_sentences=4):
+    """ Returns the HTML page of an article, with navigation and footer boilerplate
+        around its text split into paragraphs.
+    """
+    sentences = text.split(". ")
+    paragraphs = [". ".join(sentences[j:j + paragraph_sentences]) for j in range(0, len(sentences), paragraph_sentences)]
+    body = "\n".join("<p>" + escape(paragraph.rstrip(".") + ".") + "</p>" for paragraph in paragraphs)
+    return ("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>" + escape(title) + "</title></head>\n"
+            "<body><nav><a href=\"/\">Home</a> | <a href=\"/world\">World</a> | <a href=\"/business\">Business</a></nav>\n"
+            "<article><h1>" + escape(title) + "</h1>\n" + body + "</article>\n"
+            "<footer>All quotes delayed by a minimum of 15 minutes. Synthetic News.</footer></body></html>\n")
@@ -1,16 +1,213 @@
-from collections import defaultdict, Counter
-from nltk.tokenize import word_tokenize
-import nltk
-import numpy as np
-import string
-
-__all__ = ["MySearchEngine"]
+from array import array
+from collections import Counter
+from operator import itemgetter
+from ._lazy import lazy_import
+from . import metrics
+from .cache import QueryCache
+from .entities import EntityCooccurrence, EntityVectors
+from .postings import Positions, Postings, intersect
+from .tokenizer import get_tokenizer, normalize_tokens, split_words
+import functools
+import heapq
+import math
+import threading
+import time
+
+concurrent_futures = lazy_import("concurrent.futures")
+nltk = lazy_import("nltk")
+np = lazy_import("numpy")
+
+__all__ = ["MySearchEngine", "annotate_text"]
+
+# width in seconds of the time buckets that documents are grouped into by timestamp
+TIME_BUCKET_SECONDS = 3600
+
+# query modes; "phrase" and "near" need an engine built with positions=True
+MODES = ("or", "and", "phrase", "near")
+POSITIONAL_MODES = ("phrase", "near")
+
+# serializes loading the lazy attributes of engines opened with storage.load_index(),
+# which readers of a shared snapshot may first touch from several threads at once
+_lazy_lock = threading.RLock()
+
+
+def entities_from_chunks(named_entities):
+    """ Returns the proper noun entities (lists of (word, tag) tuples) of an nltk.ne_chunk tree. """
+    proper_nouns = []
+    for i in range(0, len(named_entities)):
+        ents = named_entities.pop()
+        if getattr(ents, 'label', None) is not None and ents.label() == "NE" and ([ne for ne in ents][0][1] == "NNP" or
+                                                                              [ne for ne in ents][0][1] == "NNPS"):
+            proper_nouns.append([ne for ne in ents])
+
+    return proper_nouns
+
+
+def score_query_block(indptr, docs, tfs, norms, queries, k, mode):
+    """
+    Scores a block of queries against the same postings as one sparse matrix
+    product: scores = Q @ X.T, with Q the (queries x terms) matrix of query weights
+    and X the (documents x terms) matrix of term frequencies, both restricted to
+    the terms of the batch. A plain function so it can run in a worker process.
+
+    params:
+        indptr, docs, tfs [np.ndarray]:
+            The postings of the batch terms in CSC layout: column t holds the
+            document numbers docs[indptr[t]:indptr[t + 1]] with term frequencies
+            tfs[...].
+
+        norms [np.ndarray]:
+            tf-idf norm of each document number.
+
+        queries [List(tuple(np.ndarray, np.ndarray, float))]:
+            (term columns, weights, query norm) per query, one column per distinct term.
+
+        k [int], mode [str]:
+            As in MySearchEngine.query.
+
+    returns:
+        results [List(tuple(np.ndarray, np.ndarray))]:
+            (documents, scores) per query, the top k by descending score.
+    """
+    results = [(np.zeros(0, dtype=np.int64), np.zeros(0)) for query in queries]
+    if k <= 0 or not queries:
+        return results
+
+    # one entry per (query, term) pair, expanded to the term's postings
+    rows = np.repeat(np.arange(len(queries)), [len(terms) for terms, weights, query_norm in queries])
+    terms = np.concatenate([terms for terms, weights, query_norm in queries]).astype(np.int64)
+    weights = np.concatenate([weights for terms, weights, query_norm in queries])
+    num_terms = np.array([len(terms) for terms, weights, query_norm in queries])
+    query_norms = np.array([query_norm for terms, weights, query_norm in queries], dtype=np.float64)
+
+    counts = np.diff(indptr)[terms]
+    total = int(counts.sum())
+    if total == 0:
+        return results
+    positions = np.repeat(indptr[terms] - np.cumsum(counts) + counts, counts) + np.arange(total)
+    values = np.repeat(weights, counts) * tfs[positions]
+
+    # sum the entries of each (query, document) cell; every postings list is sorted by
+    # document, so the cells are a few sorted runs per query and a stable sort is cheap
+    cells = np.repeat(rows, counts) * len(norms) + docs[positions]
+    order = np.argsort(cells, kind="stable")
+    cells = cells[order]
+    starts = np.flatnonzero(np.concatenate([[True], cells[1:] != cells[:-1]]))
+    scores = np.add.reduceat(values[order], starts)
+    matched = np.diff(np.append(starts, total))
+    cells = cells[starts]
+    cell_rows, cell_docs = np.divmod(cells, len(norms))
+
+    # cosine similarity of the matching documents
+    if mode == "and":
+        keep = matched == num_terms[cell_rows]
+        cell_rows, cell_docs, scores = cell_rows[keep], cell_docs[keep], scores[keep]
+    scores /= np.maximum(1e-7, query_norms[cell_rows] * norms[cell_docs])
+
+    # partial selection of the top k of every query, then sort only those
+    bounds = np.searchsorted(cell_rows, np.arange(len(queries) + 1))
+    for row in range(len(queries)):
+        lo, hi = bounds[row], bounds[row + 1]
+        row_scores = scores[lo:hi]
+        if k < hi - lo:
+            top = np.argpartition(-row_scores, k - 1)[:k]
+        else:
+            top = np.arange(hi - lo)
+        top = top[np.argsort(-row_scores[top], kind="stable")]
+        results[row] = (cell_docs[lo:hi][top], row_scores[top])
+    return results
+
+
+def _score_query_block(args):
+    return score_query_block(*args)
+
+
+def _has_phrase(positions, offsets):
+    """ Whether there is a start s such that every term occurs at s + each of its offsets
+        in the phrase; positions and offsets are given per term.
+    """
+    # intersect the starts each term allows, rarest term first
+    starts = None
+    for term in sorted(range(len(positions)), key=lambda term: len(positions[term])):
+        for offset in offsets[term]:
+            allowed = {position - offset for position in positions[term]}
+            starts = allowed if starts is None else starts & allowed
+            if not starts:
+                return False
+    return True
+
+
+def _within_window(positions, window):
+    """ Whether some span of fewer than window consecutive tokens holds every term, given
+        the increasing positions of each term.
+    """
+    # sweep the smallest current position forward, tracking the largest
+    heap = [(term_positions[0], term, 0) for term, term_positions in enumerate(positions)]
+    heapq.heapify(heap)
+    high = max(position for position, term, i in heap)
+    while True:
+        low, term, i = heap[0]
+        if high - low < window:
+            return True
+        i += 1
+        if i == len(positions[term]):
+            return False
+        high = max(high, positions[term][i])
+        heapq.heapreplace(heap, (positions[term][i], term, i))
+
+
+def _record_annotation(timings):
+    """ Reports the per-stage timings of annotate_text() to metrics, if enabled. """
+    if metrics.enabled:
+        for stage, seconds in timings.items():
+            metrics.observe("nlp_seconds", seconds, stage=stage)
+
+
+def annotate_text(text, tokenizer="nltk"):
+    """
+    Runs the whole NLP pipeline over a document, tokenizing it only once.
+
+    params:
+        text[str]:
+            The text of the document.
+
+        tokenizer[str]:
+            Name of the word tokenizer to use (see tokenizer.TOKENIZERS).
+
+    returns:
+        (tokens, entities, timings)[tuple]:
+            tokens is the output of MySearchEngine.tokenize, entities the output of
+            MySearchEngine.get_entities_from_text and timings a dict of seconds spent
+            in each of the "tokenize", "pos_tag" and "ne_chunk" stages.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    words = split_words(text, tokenizer)
+    tokens = normalize_tokens(words)
+    timings["tokenize"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pos = nltk.pos_tag(words)
+    timings["pos_tag"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    entities = entities_from_chunks(nltk.ne_chunk(pos, binary=True))
+    timings["ne_chunk"] = time.perf_counter() - start
+
+    return tokens, entities, timings
 
 
 class MySearchEngine():
-    def __init__(self):
-        # Dict[str, str]: maps document id to original/raw text
-        self.raw_text = {}
+    def __init__(self, doc_store=None, tokenizer="nltk", positions=False):
+        # Dict[str, str]: maps document id to original/raw text; any mutable mapping
+        # works, e.g. a docstore.FileDocumentStore to keep the texts on disk
+        self.raw_text = {} if doc_store is None else doc_store
+
+        # str: name of the word tokenizer used for documents and queries (see tokenizer.TOKENIZERS);
+        # "fast" trades exact nltk compatibility for speed
+        get_tokenizer(tokenizer)
+        self.tokenizer = tokenizer
 
         # Dict[str, Counter]: maps document id to term vector (counts of terms in document)
         self.term_vectors = {}
@@ -18,14 +215,132 @@ class MySearchEngine():
         # Counter: maps term to count of how many documents contain term
         self.doc_freq = Counter()
 
-        # Dict[str, set]: maps term to set of ids of documents that contain term
-        self.inverted_index = defaultdict(set)
-
-        # Dict[str, Counter] maps document id to Entity vector (counts of entity in document)
-        self.entity_vectors = {}
-
-        # Dict[str, Counter]: maps Entity phrase to Counter of its coocurrences with other Entity phrases
-        self.entity_coocurrences = defaultdict(Counter)
+        # Dict[str, Postings]: maps term to postings list of the documents that contain term
+        # (sorted document numbers, see _doc_numbers, with term frequencies)
+        self.inverted_index = {}
+
+        # bool: whether token positions are indexed, for "phrase" and "near" queries
+        self.positions = positions
+
+        # Dict[str, Positions]: maps term to the positions of the term in each document of
+        # its postings list (in the same order); empty unless positions is set
+        self.positional_index = {}
+
+        # Dict[str, int]: interns document ids to the dense document numbers used in postings
+        self._doc_numbers = {}
+
+        # List[str or None]: maps document number back to document id, None once removed
+        self._doc_names = []
+
+        # EntityVectors: maps document id to Entity vector (counts of entity in document),
+        # kept in compact arrays so the vectors of many documents can be summed at once
+        self.entity_vectors = EntityVectors()
+
+        # EntityCooccurrence: maps Entity phrase to Counter of its coocurrences with other Entity phrases
+        # (a sparse matrix over entity ids, see entities.py)
+        self.entity_coocurrences = EntityCooccurrence()
+
+        # Dict[str, float]: caches idf weight per term (see refresh_stats)
+        self._idf_cache = {}
+
+        # List[float]: caches tf-idf length (norm) per document number
+        self._doc_norms = []
+
+        # Dict[str, float]: maps term to an upper bound of tf(t, d) / norm(d) over its postings,
+        # used to prune candidates in query()
+        self._term_max_ratio = {}
+
+        # int or None: number of documents the cached idf weights / norms were computed against
+        self._stats_num_docs = None
+
+        # int: number of documents added or removed since the cached statistics were computed
+        self._stats_changes = 0
+
+        # float: fraction of num_docs() that may be added or removed after the cached statistics
+        # were computed before query() triggers a full refresh; 0.0 keeps scores exact, at the
+        # cost of an O(total postings) refresh on the first query after every add or remove
+        self.stats_tolerance = 0.0
+
+        # Dict[str, float]: maps document id to its time (seconds since the epoch), by default
+        # the time it was added
+        self.timestamps = {}
+
+        # float or None: age in seconds beyond which expire() removes documents; None keeps them
+        self.retention = None
+
+        # Dict[int, set]: maps time bucket (timestamp // TIME_BUCKET_SECONDS) to the ids of
+        # the documents in it, so queries for recent documents skip older ones
+        self._time_buckets = {}
+
+        # int: bumped by every add and remove, so cached query results can tell they are stale
+        self.generation = 0
+
+        # QueryCache or None: caches query results per generation; None disables caching
+        self.query_cache = QueryCache()
+
+        # dedup.NearDuplicateDetector or None: checks added documents against those seen
+        # before, and keeps near-duplicates out of the index if it drops them
+        self.dedup = None
+
+    def __setstate__(self, state):
+        # engines pickled by older versions lack the newer attributes; start from the
+        # defaults and force the cached statistics to be rebuilt on first query
+        self.__init__()
+        self.__dict__.update(state)
+        self._stats_num_docs = None
+
+        # older engines kept postings as sets of document ids
+        if any(isinstance(postings, set) for postings in self.inverted_index.values()):
+            self._rebuild_term_index()
+
+        # ... and entity vectors and coocurrences as Dict[str, Counter]
+        if not isinstance(self.entity_vectors, EntityVectors):
+            self.entity_vectors = EntityVectors.from_counters(self.entity_vectors)
+        if not isinstance(self.entity_coocurrences, EntityCooccurrence):
+            self.entity_coocurrences = EntityCooccurrence.from_entity_vectors(self.entity_vectors.values())
+
+        # ... and had no time buckets
+        if "_time_buckets" not in state:
+            self._time_buckets = self._build_time_buckets()
+
+    def __getstate__(self):
+        # materialize lazily loaded / memory mapped structures so the engine pickles as plain objects
+        for name in list(self.__dict__.get("_lazy_attributes", ())):
+            getattr(self, name)
+        state = dict(self.__dict__)
+        state.pop("_lazy_attributes", None)
+        for name, value in state.items():
+            if hasattr(value, "materialize"):
+                state[name] = value.materialize()
+        return state
+
+    def __getattr__(self, name):
+        # engines opened with storage.load_index() load their structures on first use
+        lazy_attributes = self.__dict__.get("_lazy_attributes")
+        if lazy_attributes is not None and name in lazy_attributes:
+            with _lazy_lock:
+                # another thread may have loaded it while this one waited
+                if name in self.__dict__:
+                    return self.__dict__[name]
+                value = lazy_attributes[name]()
+                setattr(self, name, value)
+                del lazy_attributes[name]
+            return value
+        raise AttributeError("'" + type(self).__name__ + "' object has no attribute '" + name + "'")
+
+    def _rebuild_term_index(self):
+        """ Rebuilds postings, document numbers and cached statistics from term_vectors. """
+        term_vectors = self.term_vectors
+        self.term_vectors = {}
+        self.doc_freq = Counter()
+        self.inverted_index = {}
+        self._doc_numbers = {}
+        self._doc_names = []
+        self._doc_norms = []
+        self._term_max_ratio = {}
+        self._idf_cache = {}
+        for id, term_vector in term_vectors.items():
+            self._index_terms(id, term_vector.elements())
 
     # ------------------------------------------------------------------------
     #  indexing
@@ -50,11 +365,11 @@ class MySearchEngine():
         # You'll notice that it's able to differentiate between an end-of-sentence period
         # versus a period that's part of an abbreviation (like "U.S.").
 
-        # tokenize
-        tokens = word_tokenize(text)
+        # tokenize with self.tokenizer ("nltk" by default, see tokenizer.py)
+        tokens = split_words(text, self.tokenizer)
 
         # lowercase and filter out punctuation (as in string.punctuation)
-        return [token.lower() for token in tokens if not token in string.punctuation]
+        return normalize_tokens(tokens)
 
     def get_entities_from_text(self, text):
         """
@@ -75,19 +390,32 @@ class MySearchEngine():
 
         """
 
-        tokens = word_tokenize(text)
+        tokens = split_words(text, self.tokenizer)
         pos = nltk.pos_tag(tokens)
         named_entities = nltk.ne_chunk(pos, binary=True)
-        proper_nouns = []
-        for i in range(0, len(named_entities)):
-            ents = named_entities.pop()
-            if getattr(ents, 'label', None) is not None and ents.label() == "NE" and ([ne for ne in ents][0][1] == "NNP" or
-                                                                                  [ne for ne in ents][0][1] == "NNPS"):
-                proper_nouns.append([ne for ne in ents])
+        return entities_from_chunks(named_entities)
 
-        return proper_nouns
+    def annotate(self, text):
+        """ Returns (tokens, entities) for a document, i.e. the results of tokenize()
+            and get_entities_from_text(), splitting words only once.
+        """
+        if self.overrides_annotation():
+            return self.tokenize(text), self.get_entities_from_text(text)
+        tokens, entities, timings = annotate_text(text, self.tokenizer)
+        _record_annotation(timings)
+        return tokens, entities
+
+    def overrides_annotation(self):
+        """ Returns True if a subclass overrides tokenize() or get_entities_from_text().
+            annotate_text() only stands in for the methods defined here, so such engines
+            annotate documents with their own methods, in this process and without
+            reusing cached annotations.
+        """
+        cls = type(self)
+        return cls.tokenize is not MySearchEngine.tokenize or \
+            cls.get_entities_from_text is not MySearchEngine.get_entities_from_text
 
-    def add(self, id, text):
+    def add(self, id, text, timestamp=None):
         """ Adds document to index.
             Parameters
             ----------
@@ -95,16 +423,152 @@ class MySearchEngine():
                 A unique identifier for the document to add, e.g., the URL of a webpage.
             text: str
                 The text of the document to be indexed.
+            timestamp: float
+                Time of the document in seconds since the epoch; now if None.
+            Returns
+            -------
+            str or None
+                The id of the document it duplicates if self.dedup dropped it as a
+                near-duplicate, otherwise None.
         """
         # check if document already in collection and throw exception if it is
         if id in self.raw_text:
             raise RuntimeError("document with id [" + id + "] already indexed.")
 
-        # store raw text for this doc id
-        self.raw_text[id] = text
+        # tokenize once, get entities from the same tokens
+        tokens, entities = self.annotate(text)
+        return self._add_annotated(id, text, tokens, entities, timestamp)
 
-        # tokenize
-        tokens = self.tokenize(text)
+    def add_annotated(self, id, text, tokens, entities, timestamp=None):
+        """ Adds a document whose tokens and entities were already computed, e.g. by
+            annotate_text() in another process or stage of a pipeline.
+            Parameters
+            ----------
+            id: str
+                A unique identifier for the document to add, e.g., the URL of a webpage.
+            text: str
+                The text of the document to be indexed.
+            tokens: list(str)
+                The document's tokens, as returned by tokenize().
+            entities: list(list(tuple(str, str)))
+                The document's entities, as returned by get_entities_from_text().
+            timestamp: float
+                Time of the document in seconds since the epoch; now if None.
+            Returns
+            -------
+            str or None
+                As for add().
+        """
+        if id in self.raw_text:
+            raise RuntimeError("document with id [" + id + "] already indexed.")
+        return self._add_annotated(id, text, tokens, entities, timestamp)
+
+    def _add_annotated(self, id, text, tokens, entities, timestamp):
+        # near-duplicates (e.g. a wire story syndicated under another url) may be dropped
+        if self.dedup is not None:
+            original = self.dedup.check(id, tokens)
+            if original is not None and self.dedup.drop_duplicates:
+                metrics.inc("duplicates_dropped")
+                return original
+
+        with metrics.timer("index_seconds"):
+            # store raw text for this doc id
+            self.generation += 1
+            self._stats_changes += 1
+            self.raw_text[id] = text
+            self._index_time(id, time.time() if timestamp is None else timestamp)
+
+            # index terms and entities
+            self._index_terms(id, tokens)
+            self._index_entities(id, entities)
+        metrics.inc("documents_indexed")
+        return None
+
+    def add_many(self, docs, workers=1, chunksize=4, timestamps=None, cache=None):
+        """ Adds many documents to the index, running the NLP pipeline (tokenizing,
+            POS tagging and NE chunking) across a process pool, then merging the
+            results into the index in one pass.
+            Parameters
+            ----------
+            docs: dict(str, str) or iterable(tuple(str, str))
+                The documents to add, as id -> text.
+            workers: int
+                Number of worker processes; 1 annotates in this process.
+            chunksize: int
+                Number of documents sent to a worker at a time.
+            timestamps: dict(str, float)
+                Time of each document in seconds since the epoch; now for missing ones.
+            cache: article_cache.ArticleCache
+                If given, documents whose text was annotated before reuse the cached
+                tokens and entities, and new annotations are added to the cache.
+            Returns
+            -------
+            dict(str, float)
+                Seconds spent per stage: "tokenize", "pos_tag" and "ne_chunk" summed over
+                all documents (CPU time across workers), and wall-clock "annotate" and "index",
+                plus the number of "duplicates" self.dedup dropped.
+        """
+        docs = list(docs.items()) if hasattr(docs, "items") else list(docs)
+
+        # check for documents already in collection (or repeated) before doing any work
+        seen = set()
+        for id, text in docs:
+            if id in self.raw_text or id in seen:
+                raise RuntimeError("document with id [" + id + "] already indexed.")
+            seen.add(id)
+
+        timings = Counter(tokenize=0.0, pos_tag=0.0, ne_chunk=0.0)
+        texts = [text for id, text in docs]
+
+        annotate = functools.partial(annotate_text, tokenizer=self.tokenizer)
+        if self.overrides_annotation():
+            def annotate(text):
+                return self.annotate(text) + ({},)
+            workers = 1
+            cache = None
+
+        start = time.perf_counter()
+        annotations = [None] * len(texts)
+        if cache is not None:
+            for i, text in enumerate(texts):
+                cached = cache.annotations(text, self.tokenizer)
+                if cached is not None:
+                    annotations[i] = (cached[0], cached[1], {})
+        missing = [i for i, annotation in enumerate(annotations) if annotation is None]
+
+        if workers > 1 and len(missing) > 1:
+            with concurrent_futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                computed = list(pool.map(annotate, [texts[i] for i in missing], chunksize=chunksize))
+        else:
+            computed = [annotate(texts[i]) for i in missing]
+        for i, annotation in zip(missing, computed):
+            annotations[i] = annotation
+            if cache is not None:
+                cache.put_annotations(texts[i], self.tokenizer, annotation[0], annotation[1])
+        timings["annotate"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        now = time.time()
+        timestamps = timestamps or {}
+        duplicates = 0
+        for (id, text), (tokens, entities, doc_timings) in zip(docs, annotations):
+            timings.update(doc_timings)
+            _record_annotation(doc_timings)
+            if self._add_annotated(id, text, tokens, entities, timestamps.get(id, now)) is not None:
+                duplicates += 1
+        timings["index"] = time.perf_counter() - start
+        timings["duplicates"] = duplicates
+
+        return dict(timings)
+
+    def _index_terms(self, id, tokens):
+        """ Adds the tokens of a document to the term index structures. """
+        # positions of each term in the document, in increasing order
+        if self.positions:
+            tokens = list(tokens)
+            term_positions = {}
+            for position, token in enumerate(tokens):
+                term_positions.setdefault(token, []).append(position)
 
         # create term vector for document (a Counter over tokens)
         term_vector = Counter(tokens)
@@ -112,17 +576,59 @@ class MySearchEngine():
         # store term vector for this doc id
         self.term_vectors[id] = term_vector
 
-        # update inverted index by adding doc id to each term's set of ids
-        for term in term_vector.keys():
-            self.inverted_index[term].add(id)
+        # documents are numbered in insertion order, so appending keeps postings sorted
+        doc = self._intern_doc(id)
+
+        # update inverted index by appending doc number to each term's postings list
+        for term, tf in term_vector.items():
+            postings = self.inverted_index.get(term)
+            if postings is None:
+                postings = self.inverted_index[term] = Postings()
+            postings.append(doc, tf)
+            if self.positions:
+                positions = self.positional_index.get(term)
+                if positions is None:
+                    positions = self.positional_index[term] = Positions()
+                positions.append(term_positions[term])
 
         # update document frequencies for terms found in this doc
         # i.e., counts should increase by 1 for each (unique) term in term vector
         self.doc_freq.update(term_vector.keys())
-
-        # get entities from raw text
-        entities = self.get_entities_from_text(text)
-
+        metrics.inc("postings_added", len(term_vector))
+
+        # idf of this doc's terms changed; cache its norm against the current weights,
+        # unless the statistics are stale anyway and refresh_stats() will compute every
+        # norm (and score bound) once before they are used
+        self._invalidate_idf(term_vector.keys())
+        if self.stats_are_stale():
+            self._doc_norms.append(0.0)
+        else:
+            self._doc_norms.append(self._cached_length(term_vector))
+            self._update_term_max_ratio(doc, term_vector)
+
+    def _intern_doc(self, id):
+        """ Assigns the next document number to a document id and returns it. """
+        doc = len(self._doc_names)
+        self._doc_numbers[id] = doc
+        self._doc_names.append(id)
+        return doc
+
+    def _index_time(self, id, timestamp):
+        """ Records the timestamp of a document and files it under its time bucket. """
+        self.timestamps[id] = timestamp
+        self._time_buckets.setdefault(int(timestamp // TIME_BUCKET_SECONDS), set()).add(id)
+
+    def _build_time_buckets(self):
+        """ Returns the time buckets of all timestamped documents. """
+        buckets = {}
+        for id, timestamp in self.timestamps.items():
+            buckets.setdefault(int(timestamp // TIME_BUCKET_SECONDS), set()).add(id)
+        return buckets
+
+    def _index_entities(self, id, entities):
+        """ Adds the entities of a document (as returned by get_entities_from_text)
+            to the entity vectors and the entity coocurrence matrix.
+        """
         ent_phrases = []
 
         #unpack list of tuples and join into one string (multiword) phrase per endtity
@@ -136,9 +642,8 @@ class MySearchEngine():
 
         ent_phrases_set = set(ent_phrases) #unique elements will be captured
 
-        #update entity coocurrence matrix
-        for ref_ent_phrase in ent_phrases_set:                      #remove self coocurrence
-            self.entity_coocurrences[ref_ent_phrase].update(ent_phrases_set - {ref_ent_phrase})
+        #update entity coocurrence matrix (self coocurrences aren't counted)
+        self.entity_coocurrences.add_document(ent_phrases_set)
 
     def remove(self, id):
         """ Removes document from index.
@@ -152,19 +657,117 @@ class MySearchEngine():
             raise KeyError("document with id [" + id + "] not found in index.")
 
         # remove raw text for this document
+        metrics.inc("documents_removed")
+        self.generation += 1
+        self._stats_changes += 1
         del self.raw_text[id]
+        self._unindex_time(id)
 
-        # update document frequencies for terms found in this doc
-        # i.e., counts should decrease by 1 for each (unique) term in term vector
-        self.doc_freq.subtract(self.term_vectors[id].keys())
+        self._unindex_terms(id)
+        self._unindex_entities(id)
+        if self.dedup is not None and id in self.dedup:
+            self.dedup.remove(id)
+
+        # reclaim the slots of removed documents once they outnumber the live ones
+        removed = len(self._doc_names) - len(self._doc_numbers)
+        if removed > 1024 and removed > len(self._doc_numbers):
+            self.compact()
+
+    def _unindex_terms(self, id):
+        """ Removes a document from the term index structures. """
+        doc = self._doc_numbers.pop(id)
+        self._doc_names[doc] = None
 
-        # update inverted index by removing doc id from each term's set of ids
         for term in self.term_vectors[id].keys():
-            self.inverted_index[term].remove(id)
+            # update document frequencies for terms found in this doc
+            # i.e., counts should decrease by 1 for each (unique) term in term vector
+            self.doc_freq[term] -= 1
+            if self.doc_freq[term] <= 0:
+                del self.doc_freq[term]
+
+            # update inverted index by removing doc number from the term's postings list,
+            # dropping terms no document contains any more
+            postings = self.inverted_index[term]
+            if self.positions:
+                self.positional_index[term].remove(postings.index(doc))
+            postings.remove(doc)
+            if not len(postings):
+                del self.inverted_index[term]
+                self.positional_index.pop(term, None)
+                self._term_max_ratio.pop(term, None)
+
+        # drop cached statistics that depended on this doc
+        self._invalidate_idf(self.term_vectors[id].keys())
+        self._doc_norms[doc] = 0.0
 
         # remove term vector for this doc
         del self.term_vectors[id]
 
+    def _unindex_time(self, id):
+        """ Forgets the timestamp of a document. """
+        timestamp = self.timestamps.pop(id, None)
+        if timestamp is None:
+            return
+        bucket = int(timestamp // TIME_BUCKET_SECONDS)
+        self._time_buckets[bucket].discard(id)
+        if not self._time_buckets[bucket]:
+            del self._time_buckets[bucket]
+
+    def _unindex_entities(self, id):
+        """ Removes a document from the entity vectors and subtracts its coocurrences. """
+        entity_vector = self.entity_vectors.pop(id)
+        self.entity_coocurrences.remove_document(entity_vector.keys())
+
+    def compact(self):
+        """ Renumbers the remaining documents densely, so that the per-document-number
+            structures no longer keep a slot for every document ever removed.
+            remove() calls this once removed documents outnumber the remaining ones.
+        """
+        numbers = [0] * len(self._doc_names)
+        doc_names = []
+        doc_norms = []
+        for doc, id in enumerate(self._doc_names):
+            if id is not None:
+                numbers[doc] = len(doc_names)
+                doc_names.append(id)
+                doc_norms.append(self._doc_norms[doc])
+        if len(doc_names) == len(self._doc_names):
+            return
+
+        for postings in self.inverted_index.values():
+            postings.renumber(numbers)
+        self._doc_names = doc_names
+        self._doc_numbers = {id: doc for doc, id in enumerate(doc_names)}
+        self._doc_norms = doc_norms
+
+    def expire(self, max_age=None, now=None):
+        """ Removes every document older than a maximum age.
+            Parameters
+            ----------
+            max_age: float
+                Age in seconds; retention if None.
+            now: float
+                The current time in seconds since the epoch; time.time() if None.
+            Returns
+            -------
+            list(str)
+                The ids of the removed documents.
+        """
+        max_age = self.retention if max_age is None else max_age
+        if max_age is None:
+            return []
+
+        cutoff = (time.time() if now is None else now) - max_age
+        # only the time buckets up to the cutoff's can hold expired documents
+        last_bucket = int(cutoff // TIME_BUCKET_SECONDS)
+        expired = []
+        for bucket, ids in self._time_buckets.items():
+            if bucket <= last_bucket:
+                expired.extend(id for id in ids if self.timestamps[id] < cutoff)
+        for id in expired:
+            self.remove(id)
+        return expired
+
     def get(self, id):
         """ Returns the original (raw) text of a document.
             Parameters
@@ -188,6 +791,23 @@ class MySearchEngine():
 
         return self.entity_vectors[id]
 
+    def get_most_common_entities(self, ids, k=10, weights=None):
+        """ Returns the k entities with the largest counts summed over some documents.
+            Parameters
+            ----------
+            ids: iterable(str)
+                The ids of the documents.
+            k: int
+                The number of entities to return; None for all of them.
+            weights: iterable(float)
+                A weight per document (e.g. its query score) to multiply its counts by.
+            Returns
+            ------
+            List[tuple(str, number)]
+                (entity, total) pairs, largest first.
+        """
+        return self.entity_vectors.most_common(ids, k, weights)
+
     def get_associated_entities(self, entity):
         """ Returns the Counter of coocurrences of given entity with all other
             entities in database.
@@ -207,11 +827,64 @@ class MySearchEngine():
 
         return self.entity_coocurrences[entity]
 
+    def get_most_associated_entities(self, entity, k=10, scoring="count", min_count=1):
+        """ Returns the k entities most associated with given entity.
+            Parameters
+            ----------
+            entity: str
+                The entity whose associated entities are returned.
+            k: int
+                The number of entities to return.
+            scoring: str
+                "count" (number of shared documents), "pmi" or "npmi"
+                (normalized pointwise mutual information).
+            min_count: int
+                The number of documents an entity must share with given entity.
+            Returns
+            ------
+            List[tuple(str, number)]
+                (entity, score) pairs, best first.
+        """
+        return self.entity_coocurrences.most_common(entity, k, scoring, min_count)
+
     def num_docs(self):
         """ Returns the current number of documents in index.
         """
         return len(self.raw_text)
 
+    def memory_usage(self):
+        """ Returns the size of the main index structures: "documents", "terms" and
+            "postings" counts, and approximate "*_bytes" of the arrays holding postings,
+            positions, document norms, entity vectors and entity coocurrences.
+            Structures not loaded yet from an index on disk (see storage.load_index)
+            aren't loaded for this and count as empty.
+        """
+        loaded = self.__dict__
+        index = loaded.get("inverted_index", {})
+        # mapped postings indexes only hold the postings looked up so far
+        postings = list(getattr(index, "_overlay", index).values())
+        positional_index = loaded.get("positional_index", {})
+        positions = list(getattr(positional_index, "_overlay", positional_index).values())
+        entity_vectors = loaded.get("entity_vectors")
+        coocurrences = loaded.get("entity_coocurrences")
+
+        usage = {"documents": self.num_docs(),
+                 "terms": len(index),
+                 "postings": sum(len(term_postings) for term_postings in postings)}
+        usage["postings_bytes"] = sum(memoryview(term_postings.docs).nbytes + memoryview(term_postings.tfs).nbytes
+                                      for term_postings in postings)
+        usage["positions_bytes"] = sum(term_positions.offsets[-1] - term_positions.offsets[0] +
+                                       memoryview(term_positions.offsets).nbytes for term_positions in positions)
+        usage["doc_norms_bytes"] = 8 * len(loaded.get("_doc_norms", ()))
+        usage["entity_vectors_bytes"] = 0
+        if isinstance(entity_vectors, EntityVectors):
+            usage["entity_vectors_bytes"] = entity_vectors._entities.nbytes + entity_vectors._counts.nbytes
+        usage["entity_coocurrences_bytes"] = 0
+        if isinstance(coocurrences, EntityCooccurrence) and coocurrences._indptr is not None:
+            usage["entity_coocurrences_bytes"] = (coocurrences._indptr.nbytes + coocurrences._indices.nbytes +
+                                                  coocurrences._data.nbytes)
+        return usage
+
     # ------------------------------------------------------------------------
     #  matching
     # ------------------------------------------------------------------------
@@ -229,7 +902,7 @@ class MySearchEngine():
         """
         # note: term needs to be lowercased so can match output of tokenizer
         # look up term in inverted index
-        return self.inverted_index[term.lower()]
+        return self._doc_ids_of(self.inverted_index.get(term.lower(), ()))
 
     def get_matches_OR(self, terms):
         """ Returns set of documents that contain at least one of the specified terms.
@@ -242,14 +915,14 @@ class MySearchEngine():
             set(str)
                 A set of ids of documents that contain at least one of the term.
         """
-        # initialize set of ids to empty set
-        ids = set()
+        # initialize set of doc numbers to empty set
+        docs = set()
 
-        # union ids with sets of ids matching any of the terms
+        # union doc numbers with postings of any of the terms
         for term in terms:
-            ids.update(self.inverted_index[term])
+            docs.update(self.inverted_index.get(term, ()))
 
-        return ids
+        return self._doc_ids_of(docs)
 
     def get_matches_AND(self, terms):
         """ Returns set of documents that contain all of the specified terms.
@@ -262,14 +935,7 @@ class MySearchEngine():
             set(str)
                 A set of ids of documents that contain each term.
         """
-        # initialize set of ids to those that match first term
-        ids = self.inverted_index[terms[0]]
-
-        # intersect with sets of ids matching rest of terms
-        for term in terms[1:]:
-            ids = ids.intersection(self.inverted_index[term])
-
-        return ids
+        return self._doc_ids_of(self._match_all(terms))
 
     def get_matches_NOT(self, terms):
         """ Returns set of documents that don't contain any of the specified terms.
@@ -282,14 +948,82 @@ class MySearchEngine():
             set(str)
                 A set of ids of documents that don't contain any of the terms.
         """
-        # initialize set of ids to all ids
-        ids = set(self.raw_text.keys())
-
-        # subtract ids of docs that match any of the terms
+        # doc numbers of docs that match any of the terms
+        excluded = set()
         for term in terms:
-            ids = ids.difference(self.inverted_index[term])
+            excluded.update(self.inverted_index.get(term, ()))
+
+        # walk the live document numbers instead of copying every id into a set first
+        return {id for doc, id in enumerate(self._doc_names) if id is not None and doc not in excluded}
+
+    def _match_all(self, terms):
+        """ Returns the sorted doc numbers of documents that contain all of the terms. """
+        # intersect smallest postings first so intermediate results stay small
+        postings = sorted((self.inverted_index.get(term, Postings()) for term in terms), key=len)
+
+        # initialize doc numbers to those that match first term
+        docs = postings[0].docs
+        touched = len(docs)
+
+        # gallop through the (larger) postings of the rest of terms
+        for other in postings[1:]:
+            if not docs:
+                break
+            # galloping probes about as many postings as the smaller side holds
+            touched += len(docs)
+            docs = intersect(docs, other.docs)
+
+        metrics.inc("query_postings_touched", touched)
+        return docs
+
+    def _match_positions(self, docs, query_tokens, mode, window):
+        """ Returns the sorted doc numbers among docs (which contain every query term) in
+            which the query tokens occur as a phrase ("phrase") or all within a span of
+            window tokens ("near"), decoding only the positions of the query terms.
+        """
+        if not len(docs):
+            return docs
+        terms = list(dict.fromkeys(query_tokens))
+        postings = [self.inverted_index[term] for term in terms]
+        positions = [self.positional_index[term] for term in terms]
+        # offset of every query token within the phrase, per term
+        offsets = [[i for i, token in enumerate(query_tokens) if token == term] for term in terms]
+
+        matched = array("I")
+        for doc in docs:
+            doc_positions = [term_positions.get(term_postings.index(doc))
+                             for term_postings, term_positions in zip(postings, positions)]
+            if mode == "phrase":
+                found = _has_phrase(doc_positions, offsets)
+            else:
+                found = _within_window(doc_positions, window)
+            if found:
+                matched.append(doc)
+        return matched
+
+    def _docs_since(self, since):
+        """ Returns the sorted doc numbers of the documents timestamped at or after since,
+            looking only at the time buckets that can hold them.
+        """
+        first_bucket = int(since // TIME_BUCKET_SECONDS)
+        docs = []
+        for bucket, ids in self._time_buckets.items():
+            if bucket >= first_bucket:
+                docs.extend(self._doc_numbers[id] for id in ids if self.timestamps[id] >= since)
+        return array("I", sorted(docs))
+
+    def _recency(self, doc, now, half_life):
+        """ Returns the exponential decay factor of a document: 1 when it is new, halving
+            every half_life seconds. Documents without a timestamp aren't decayed.
+        """
+        timestamp = self.timestamps.get(self._doc_names[doc])
+        if timestamp is None:
+            return 1.0
+        return 0.5 ** (max(0.0, now - timestamp) / half_life)
 
-        return ids
+    def _doc_ids_of(self, docs):
+        """ Returns the set of document ids for an iterable of document numbers. """
+        return {self._doc_names[doc] for doc in docs}
 
     # ------------------------------------------------------------------------
     #  scoring
@@ -306,7 +1040,77 @@ class MySearchEngine():
             float
                 The value idf(t, D) as defined above.
         """
-        return np.log10(self.num_docs() / (1.0 + self.doc_freq[term]))
+        num_docs = self.num_docs()
+        if num_docs == 0:
+            return 0.0
+        return math.log10(num_docs / (1.0 + self.doc_freq[term]))
+
+    def cached_idf(self, term):
+        """ Returns the idf weight of a term as of the last statistics refresh.
+            Unlike idf(), the value is memoized until add()/remove() changes the
+            term's document frequency or refresh_stats() rebuilds the cache.
+            Parameters
+            ----------
+            term: str
+                A term.
+            Returns
+            -------
+            float
+                The cached value idf(t, D).
+        """
+        try:
+            return self._idf_cache[term]
+        except KeyError:
+            num_docs = self.num_docs() if self._stats_num_docs is None else self._stats_num_docs
+            if num_docs == 0:
+                weight = 0.0
+            else:
+                weight = math.log10(num_docs / (1.0 + self.doc_freq[term]))
+            self._idf_cache[term] = weight
+            return weight
+
+    def _invalidate_idf(self, terms):
+        """ Drops cached idf weights for terms whose document frequency changed. """
+        for term in terms:
+            self._idf_cache.pop(term, None)
+
+    def stats_are_stale(self):
+        """ Returns True if more documents were added or removed since the cached idf
+            weights and document norms were computed than stats_tolerance allows.
+            Every change counts, so removing a document and adding another (which
+            leaves num_docs() alone but changes document frequencies) does too.
+        """
+        if self._stats_num_docs is None:
+            return True
+        return self._stats_changes > self.stats_tolerance * max(1, self._stats_num_docs)
+
+    def refresh_stats(self):
+        """ Recomputes every cached idf weight and document norm against the
+            current collection. This is O(total postings) and is called lazily by
+            query() whenever stats_are_stale() is True.
+        """
+        self._stats_num_docs = self.num_docs()
+        self._stats_changes = 0
+        self._idf_cache = {}
+        self._doc_norms = [0.0] * len(self._doc_names)
+        self._term_max_ratio = {}
+        for id, tv in self.term_vectors.items():
+            doc = self._doc_numbers[id]
+            self._doc_norms[doc] = self._cached_length(tv)
+            self._update_term_max_ratio(doc, tv)
+
+    def _update_term_max_ratio(self, doc, tv):
+        """ Raises the per-term score upper bounds to cover the document with the given number.
+            Bounds are only ever raised between refreshes, so they stay valid (if loose)
+            after remove().
+        """
+        norm = self._doc_norms[doc]
+        if norm <= 0:
+            return
+        for term, tf in tv.items():
+            ratio = tf / norm
+            if ratio > self._term_max_ratio.get(term, 0.0):
+                self._term_max_ratio[term] = ratio
 
     def dot_product(self, tv1, tv2):
         """ Returns dot product between two term vectors (including idf weighting).
@@ -347,6 +1151,13 @@ class MySearchEngine():
         result = result ** 0.5
         return result
 
+    def _cached_length(self, tv):
+        """ Same as length(), but weighted with cached_idf(). """
+        result = 0.0
+        for term in tv:
+            result += (tv[term] * self.cached_idf(term)) ** 2
+        return result ** 0.5
+
     def cosine_similarity(self, tv1, tv2):
         """ Returns the cosine similarity (including idf weighting).
             Parameters
@@ -366,7 +1177,7 @@ class MySearchEngine():
     #  querying
     # ------------------------------------------------------------------------
 
-    def query(self, q, k=10, mode = "or"):
+    def query(self, q, k=10, mode = "or", half_life=None, since=None, now=None, window=10):
         """ Returns up to top k documents matching at least one term in query q, sorted by relevance.
             Parameters
             ----------
@@ -375,34 +1186,318 @@ class MySearchEngine():
             k: int
                 The number of top matched documents to return, e.g., k = 8 will return the top 8 document ids.
             mode: str
-                The mode in which to search. By default, it is set to "or".
+                The mode in which to search. By default, it is set to "or"; "and" only
+                matches documents containing every query term, "phrase" documents
+                containing the query terms next to each other in order and "near"
+                documents containing them all within window consecutive tokens. The
+                last two need an engine built with positions=True.
+            half_life: float
+                If given, favour recent documents: scores are multiplied by 0.5 for every
+                half_life seconds of age of the document.
+            since: float
+                If given, only match documents timestamped at or after this time
+                (seconds since the epoch).
+            now: float
+                The time ages are measured against; time.time() if None.
+            window: int
+                Span in tokens within which "near" queries must match.
             Returns
             -------
             List(tuple(str, float))
                 A list of (document, score) pairs sorted in descending order.
         """
-        # tokenize query
-        # note: it's very important to tokenize the same way the documents were so that matching will work
-        query_tokens = self.tokenize(q)
-
-        # get matches
-        # just support OR for now...
-        if mode == "or":
-            ids = self.get_matches_OR(query_tokens)
+        if not metrics.enabled:
+            return self._cached_query(q, k, mode, half_life, since, now, window)
+        with metrics.timer("query_seconds", mode=mode):
+            result = self._cached_query(q, k, mode, half_life, since, now, window)
+        metrics.inc("queries", mode=mode)
+        return result
 
-        elif mode == "and":
-            ids = self.get_matches_AND(query_tokens)
+    def _cached_query(self, q, k, mode, half_life, since, now, window):
+        """ Answers query() from the query cache, or else with _query(). """
+        if mode not in MODES:
+            msg = "Mode not implemented."
+            raise Exception(msg)
+        if mode in POSITIONAL_MODES and not self.positions:
+            raise ValueError("mode [" + mode + "] needs an engine built with positions=True.")
+        if mode != "near":
+            window = None
 
-        else:
+        # tokenize query
+        # note: it's very important to tokenize the same way the documents were so that matching will work
+        cache = self.query_cache
+        if cache is None:
+            return self._query(self.tokenize(q), k, mode, half_life, since, now, window)
+        query_tokens = cache.tokens(q, self.tokenize)
+
+        # decayed scores change with the clock unless the query pins now
+        if half_life is not None and now is None:
+            return self._query(query_tokens, k, mode, half_life, since, now, window)
+
+        key = (tuple(query_tokens), k, mode, half_life, since, now, window)
+        generation = self.generation
+        result = cache.get(key, generation)
+        if result is None:
+            result = self._query(query_tokens, k, mode, half_life, since, now, window)
+            cache.put(key, generation, tuple(result))
+        return list(result)
+
+    @metrics.timed("query_batch_seconds")
+    def query_batch(self, queries, k=10, mode="or", workers=1, executor="thread"):
+        """ Runs many queries at once; returns the same as [query(q, k, mode) for q in queries].
+            Terms are deduplicated across the batch, each term's postings are fetched
+            once, and the queries are scored together as a sparse matrix product
+            (see score_query_block). Results in the query cache are reused.
+            Parameters
+            ----------
+            queries: iterable(str)
+                The queries, e.g. one per trending entity.
+            k: int
+                The number of top matched documents to return per query.
+            mode: str
+                "or" or "and", as in query().
+            workers: int
+                Number of threads or processes scoring blocks of queries; 1 scores them
+                in this thread.
+            executor: str
+                "thread" or "process". Processes only receive the postings of the batch
+                terms, not the index.
+            Returns
+            -------
+            List(List(tuple(str, float)))
+                The (document, score) pairs of each query, in the order of queries.
+        """
+        if mode not in ("or", "and"):
             msg = "Mode not implemented."
             raise Exception(msg)
+        if executor not in ("thread", "process"):
+            raise ValueError("unknown executor [" + str(executor) + "], expected thread or process.")
+
+        queries = list(queries)
+        cache = self.query_cache
+        generation = self.generation
+        results = [None] * len(queries)
+
+        # tokenize each query and answer what the cache can
+        pending = {}
+        for i, q in enumerate(queries):
+            query_tokens = self.tokenize(q) if cache is None else cache.tokens(q, self.tokenize)
+            key = (tuple(query_tokens), k, mode, None, None, None, None)
+            if cache is not None:
+                result = cache.get(key, generation)
+                if result is not None:
+                    results[i] = list(result)
+                    continue
+            # repeated queries are scored once
+            pending.setdefault(key, []).append(i)
+
+        if pending:
+            # make sure cached idf weights and document norms are fresh enough
+            self._prepare_batch()
+
+            # terms of the whole batch, each given a column
+            columns = {}
+            weighted = []
+            for key in pending:
+                query_tv = Counter(key[0])
+                terms = np.array([columns.setdefault(term, len(columns)) for term in query_tv], dtype=np.int64)
+                weights = np.array([tf * self.cached_idf(term) ** 2 for term, tf in query_tv.items()])
+                weighted.append((terms, weights, self._cached_length(query_tv)))
+
+            # fetch each postings list once
+            postings = self._batch_postings(list(columns))
+            lengths = np.array([len(docs) for docs, tfs in postings], dtype=np.int64)
+            indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            docs = np.concatenate([docs for docs, tfs in postings] + [np.zeros(0, dtype=np.int64)])
+            tfs = np.concatenate([tfs for docs, tfs in postings] + [np.zeros(0)]).astype(np.float64)
+            norms = self._batch_norms()
+
+            # one block of queries per worker
+            block_size = -(-len(weighted) // max(1, workers))
+            blocks = [(indptr, docs, tfs, norms, weighted[start:start + block_size], k, mode)
+                      for start in range(0, len(weighted), block_size)]
+
+            if workers > 1 and len(blocks) > 1:
+                pool_class = concurrent_futures.ThreadPoolExecutor if executor == "thread" \
+                    else concurrent_futures.ProcessPoolExecutor
+                with pool_class(max_workers=workers) as pool:
+                    scored = [result for block in pool.map(_score_query_block, blocks) for result in block]
+            else:
+                scored = [result for block in map(_score_query_block, blocks) for result in block]
+
+            for key, (top_docs, top_scores) in zip(pending, scored):
+                result = [(self._doc_names[doc], score)
+                          for doc, score in zip(top_docs.tolist(), top_scores.tolist())]
+                if cache is not None:
+                    cache.put(key, generation, tuple(result))
+                for i in pending[key]:
+                    results[i] = list(result)
+
+        return results
+
+    def _prepare_batch(self):
+        """ Brings the statistics query_batch() scores with up to date. """
+        if self.stats_are_stale():
+            self.refresh_stats()
+
+    def _batch_postings(self, terms):
+        """ Returns (document numbers, term frequencies) arrays of each term's postings. """
+        postings = []
+        for term in terms:
+            term_postings = self.inverted_index.get(term, Postings())
+            postings.append((np.frombuffer(term_postings.docs, dtype=np.uint32).astype(np.int64),
+                             np.frombuffer(term_postings.tfs, dtype=np.uint32)))
+        return postings
+
+    def _batch_norms(self):
+        """ Returns the cached tf-idf norm of every document number as an array. """
+        return np.asarray(self._doc_norms, dtype=np.float64)
+
+    def _query(self, query_tokens, k, mode, half_life, since, now, window=None):
+        """ Scores the documents matching the tokens of a query; see query(). """
+        # restrict matching to recent documents
+        within = None
+        if since is not None:
+            within = self._docs_since(since)
+            if not within:
+                return []
+
+        # get matches for AND queries up front; OR queries are matched while scoring
+        if mode != "or":
+            if not query_tokens:
+                return []
+            docs = self._match_all(query_tokens)
+            if within is not None:
+                docs = intersect(within, docs) if len(within) < len(docs) else intersect(docs, within)
+
+            # phrase and proximity queries check the positions of the AND matches only
+            if mode in POSITIONAL_MODES:
+                docs = self._match_positions(docs, query_tokens, mode, window)
 
         # convert query to a term vector (Counter over tokens)
         query_tv = Counter(query_tokens)
 
-        # score each match by computing cosine similarity between query and document
-        scores = [(id, self.cosine_similarity(query_tv, self.term_vectors[id])) for id in ids]
-        scores = sorted(scores, key=lambda t: t[1], reverse=True)
+        # make sure cached idf weights and document norms are fresh enough
+        if self.stats_are_stale():
+            self.refresh_stats()
+
+        # weight of each query term: tf(t, q) * idf(t)^2, so that dot(q, d) = sum_t weight(t) * tf(t, d)
+        query_weights = {term: tf * self.cached_idf(term) ** 2 for term, tf in query_tv.items()}
+        query_norm = self._cached_length(query_tv)
 
-        # sort results and return top k
-        return scores[:k]
+        # decay factor per document number, computed once per document
+        decay = None
+        if half_life is not None:
+            now = time.time() if now is None else now
+            factors = {}
+
+            def decay(doc):
+                factor = factors.get(doc)
+                if factor is None:
+                    factor = factors[doc] = self._recency(doc, now, half_life)
+                return factor
+
+        # score matches by cosine similarity between query and document
+        if mode == "or":
+            scores = self._score_term_at_a_time(query_weights, query_norm, k, within, decay)
+        else:
+            scores = self._score_candidates(docs, query_weights, query_norm)
+
+        if decay is not None:
+            scores = {doc: score * decay(doc) for doc, score in scores.items()}
+        metrics.inc("query_candidates_scored", len(scores))
+
+        # keep the top k in a bounded heap instead of sorting every match
+        top = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+        return [(self._doc_names[doc], score) for doc, score in top]
+
+    def _score_candidates(self, docs, query_weights, query_norm):
+        """ Returns a dict mapping each of the given document numbers to its cosine similarity
+            with the query, touching only the query terms of each document vector.
+        """
+        scores = {}
+        for doc in docs:
+            doc_tv = self.term_vectors[self._doc_names[doc]]
+            dot = 0.0
+            for term, weight in query_weights.items():
+                if term in doc_tv:
+                    dot += weight * doc_tv[term]
+            scores[doc] = dot / max(1e-7, query_norm * self._doc_norms[doc])
+        return scores
+
+    def _score_term_at_a_time(self, query_weights, query_norm, k, within=None, decay=None):
+        """ Scores documents matching any query term by walking postings term by term into
+            score accumulators, with MaxScore-style pruning: once the k-th best partial score
+            exceeds what the remaining terms could still add, no new documents are admitted
+            and hopeless accumulators are dropped.
+            Only documents in within (sorted document numbers) are scored, if given. With a
+            decay function, pruning is done against the decayed scores; factors are at most
+            1, so the bounds stay valid. The returned scores are not decayed.
+            Returns a dict mapping document number to score that contains at least the top k.
+        """
+        # upper bound on how much each term can add to any single document's score
+        bounds = {}
+        for term, weight in query_weights.items():
+            if query_norm > 0:
+                bounds[term] = weight * self._term_max_ratio.get(term, 0.0) / query_norm
+            else:
+                bounds[term] = 0.0
+
+        # process terms with the largest potential contribution first
+        terms = sorted(query_weights, key=bounds.get, reverse=True)
+
+        within_set = None if within is None else set(within)
+
+        accumulators = {}
+        admitting = True
+        touched = 0
+        for i, term in enumerate(terms):
+            # most that the terms after this one could still add to any document
+            remaining = sum(bounds[t] for t in terms[i + 1:])
+            weight = query_weights[term]
+            postings = self.inverted_index.get(term, Postings())
+
+            if admitting:
+                touched += len(postings) if within is None else min(len(within), len(postings))
+                if within is None:
+                    matches = postings.items()
+                elif len(within) < len(postings):
+                    matches = ((doc, postings.tf(doc)) for doc in within)
+                else:
+                    # documents are numbered in insertion order, so skip the older head
+                    matches = ((doc, tf) for doc, tf in postings.items(within[0]) if doc in within_set)
+
+                for doc, tf in matches:
+                    if tf:
+                        accumulators[doc] = accumulators.get(doc, 0.0) + \
+                            weight * tf / max(1e-7, query_norm * self._doc_norms[doc])
+
+            elif len(postings) < len(accumulators):
+                touched += len(postings)
+                for doc, tf in postings.items():
+                    if doc in accumulators:
+                        accumulators[doc] += weight * tf / max(1e-7, query_norm * self._doc_norms[doc])
+
+            else:
+                touched += len(accumulators)
+                for doc in accumulators:
+                    tf = postings.tf(doc)
+                    if tf:
+                        accumulators[doc] += weight * tf / max(1e-7, query_norm * self._doc_norms[doc])
+
+            if k <= 0 or len(accumulators) < k:
+                continue
+
+            # scores only grow, so the current k-th best is a lower bound on the final one
+            if decay is None:
+                threshold = heapq.nlargest(k, accumulators.values())[-1]
+            else:
+                threshold = heapq.nlargest(k, [score * decay(doc) for doc, score in accumulators.items()])[-1]
+            if threshold > remaining:
+                admitting = False
+                accumulators = {doc: score for doc, score in accumulators.items()
+                                if (score + remaining) * (1.0 if decay is None else decay(doc)) >= threshold}
+
+        metrics.inc("query_postings_touched", touched)
+        return accumulators
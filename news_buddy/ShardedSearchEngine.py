@@ -0,0 +1,535 @@
+from collections import Counter
+from collections.abc import Mapping
+from operator import itemgetter
+from .SearchEngine import MySearchEngine
+from .entities import SCORINGS
+import heapq
+import math
+import multiprocessing
+import threading
+import zlib
+
+__all__ = ["ShardedSearchEngine"]
+
+
+class _Shard(MySearchEngine):
+    """ A MySearchEngine holding one partition of a ShardedSearchEngine.
+
+        Its idf weights (and so its document and query norms) are computed from the
+        document frequencies and document count of the whole sharded collection, as
+        last pushed by set_global_stats(), so scores from different shards are
+        comparable. Changes to its own document frequencies are collected until the
+        coordinator takes them with take_doc_freq_changes().
+    """
+
+    def __init__(self, doc_store=None, tokenizer="nltk", positions=False):
+        super().__init__(doc_store=doc_store, tokenizer=tokenizer, positions=positions)
+
+        # Counter: document frequency per term over all shards, as of the last sync
+        self.global_doc_freq = Counter()
+
+        # int or None: number of documents over all shards, as of the last sync
+        self.global_num_docs = None
+
+        # Counter: changes to doc_freq since the last take_doc_freq_changes()
+        self._doc_freq_changes = Counter()
+
+    def _index_terms(self, id, tokens):
+        super()._index_terms(id, tokens)
+        self._doc_freq_changes.update(self.term_vectors[id].keys())
+
+    def _unindex_terms(self, id):
+        self._doc_freq_changes.subtract(self.term_vectors[id].keys())
+        super()._unindex_terms(id)
+
+    def take_doc_freq_changes(self):
+        """ Returns and resets the document frequency changes since the last call. """
+        changes = Counter({term: change for term, change in self._doc_freq_changes.items() if change})
+        self._doc_freq_changes = Counter()
+        return changes
+
+    def set_global_stats(self, doc_freq_changes, num_docs):
+        """ Applies the combined document frequency changes of all shards and recomputes
+            the cached idf weights and norms against the new global statistics.
+        """
+        for term, change in doc_freq_changes.items():
+            self.global_doc_freq[term] += change
+            if self.global_doc_freq[term] <= 0:
+                del self.global_doc_freq[term]
+        self.global_num_docs = num_docs
+        self.refresh_stats()
+        # cached query results were scored against the old statistics
+        self.generation += 1
+
+    def stats_are_stale(self):
+        # the coordinator decides when statistics are refreshed
+        return self.global_num_docs is None and super().stats_are_stale()
+
+    def cached_idf(self, term):
+        if self.global_num_docs is None:
+            return super().cached_idf(term)
+        try:
+            return self._idf_cache[term]
+        except KeyError:
+            if self.global_num_docs == 0:
+                weight = 0.0
+            else:
+                weight = math.log10(self.global_num_docs / (1.0 + self.global_doc_freq[term]))
+            self._idf_cache[term] = weight
+            return weight
+
+    def entity_row(self, entity):
+        """ Returns the Counter of coocurrences of entity, or None if no document here has it. """
+        if entity not in self.entity_coocurrences:
+            return None
+        return self.entity_coocurrences[entity]
+
+    def entity_doc_counts(self, entities):
+        """ Returns ({entity: number of documents containing it}, number of documents). """
+        coocurrences = self.entity_coocurrences
+        return {entity: coocurrences.doc_count(entity) for entity in entities}, coocurrences.num_docs
+
+    def indexed(self, ids):
+        """ Returns the given ids of documents held by this shard. """
+        return [id for id in ids if id in self.raw_text]
+
+    def ids(self):
+        return list(self.raw_text)
+
+
+def _serve_shard(connection, options):
+    """ Runs a shard in a worker process, answering (method, args, kwargs) calls until None. """
+    shard = _Shard(**options)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        method, args, kwargs = message
+        try:
+            result = getattr(shard, method)(*args, **kwargs)
+        except Exception as e:
+            connection.send((False, e))
+        else:
+            connection.send((True, result))
+    connection.close()
+
+
+class _LocalShard():
+    """ A shard in this process, called like a _ProcessShard. """
+
+    def __init__(self, options):
+        self.engine = _Shard(**options)
+        self._reply = None
+
+    def send(self, method, args, kwargs):
+        try:
+            self._reply = (True, getattr(self.engine, method)(*args, **kwargs))
+        except Exception as e:
+            self._reply = (False, e)
+
+    def recv(self):
+        reply, self._reply = self._reply, None
+        return reply
+
+    def close(self):
+        pass
+
+
+class _ProcessShard():
+    """ A shard living in a worker process, called over a pipe. """
+
+    def __init__(self, context, options):
+        self._connection, child = context.Pipe()
+        self._process = context.Process(target=_serve_shard, args=(child, options), daemon=True)
+        self._process.start()
+        child.close()
+
+    def send(self, method, args, kwargs):
+        self._connection.send((method, args, kwargs))
+
+    def recv(self):
+        return self._connection.recv()
+
+    def close(self):
+        if self._process.is_alive():
+            self._connection.send(None)
+            self._process.join()
+        self._connection.close()
+
+
+class _ShardedTexts(Mapping):
+    """ Read-only id -> text view over the documents of every shard. """
+
+    def __init__(self, engine):
+        self._engine = engine
+
+    def __getitem__(self, id):
+        return self._engine.get(id)
+
+    def __contains__(self, id):
+        return bool(self._engine._call(self._engine.shard_of(id), "indexed", [id]))
+
+    def __iter__(self):
+        return (id for ids in self._engine._broadcast("ids") for id in ids)
+
+    def __len__(self):
+        return self._engine.num_docs()
+
+
+class ShardedSearchEngine():
+    """ A search engine whose documents are partitioned by a hash of their id across
+        num_shards MySearchEngine shards, which can run in worker processes.
+
+        Writes go to the shard owning the document; add_many() sends each shard its
+        part of the batch at once, so with processes=True the NLP pipeline and
+        indexing run on one core per shard. Queries are scattered to every shard and
+        their top k results merged.
+
+        Scores match those of a single MySearchEngine over the same documents: before
+        a query, if more documents were added or removed than stats_tolerance allows, the
+        shards' document frequency changes are gathered, summed and pushed back to
+        every shard, which recomputes its idf weights and norms from the global
+        statistics. Each shard keeps a copy of the global document frequencies.
+
+        params:
+            num_shards [int]:
+                Number of partitions.
+
+            processes [bool]:
+                Whether each shard runs in its own worker process; otherwise all shards
+                live in this process. Call close() (or use a with block) to stop the workers.
+
+            tokenizer [str]:
+                Word tokenizer of every shard (see tokenizer.TOKENIZERS).
+
+            positions [bool]:
+                Whether the shards index token positions, for "phrase" and "near" queries.
+    """
+
+    def __init__(self, num_shards=4, processes=False, tokenizer="nltk", positions=False):
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1.")
+        self.num_shards = num_shards
+        self.processes = processes
+        self.tokenizer = tokenizer
+        self.positions = positions
+
+        # float or None: age in seconds beyond which expire() removes documents; None keeps them
+        self.retention = None
+
+        # float: fraction of num_docs() that may be added or removed after the last sync
+        # before query() syncs the statistics again; 0.0 keeps scores exact
+        self.stats_tolerance = 0.0
+
+        # Counter: document frequency per term over all shards, as of the last sync
+        self.doc_freq = Counter()
+
+        # int or None: number of documents the shards' statistics were last synced at
+        self._stats_num_docs = None
+
+        # int: number of documents added or removed since the last sync
+        self._stats_changes = 0
+
+        # int: number of documents over all shards
+        self._num_docs = 0
+
+        # dedup.NearDuplicateDetector or None: checks documents for near-duplicates across
+        # all shards, here rather than per shard since copies of a story hash to any shard
+        self.dedup = None
+
+        # serializes calls, so that replies can't be interleaved between threads
+        self._lock = threading.RLock()
+
+        options = {"tokenizer": tokenizer, "positions": positions}
+        if processes:
+            context = multiprocessing.get_context()
+            self._shards = [_ProcessShard(context, options) for _ in range(num_shards)]
+        else:
+            self._shards = [_LocalShard(options) for _ in range(num_shards)]
+
+        # Mapping[str, str]: id -> text over all shards, like MySearchEngine.raw_text
+        self.raw_text = _ShardedTexts(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ Stops the shard worker processes. """
+        for shard in self._shards:
+            shard.close()
+
+    # ------------------------------------------------------------------------
+    #  scatter / gather
+    # ------------------------------------------------------------------------
+
+    def shard_of(self, id):
+        """ Returns the index of the shard that owns a document id. """
+        return zlib.crc32(id.encode("utf-8")) % self.num_shards
+
+    def _scatter(self, calls):
+        """ Sends (shard index, method, args, kwargs) calls, then collects their results
+            in order; the calls to different shards run in parallel with processes=True.
+        """
+        with self._lock:
+            for index, method, args, kwargs in calls:
+                self._shards[index].send(method, args, kwargs)
+            replies = [self._shards[index].recv() for index, method, args, kwargs in calls]
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for ok, result in replies]
+
+    def _call(self, index, method, *args, **kwargs):
+        return self._scatter([(index, method, args, kwargs)])[0]
+
+    def _broadcast(self, method, *args, **kwargs):
+        return self._scatter([(index, method, args, kwargs) for index in range(self.num_shards)])
+
+    # ------------------------------------------------------------------------
+    #  indexing
+    # ------------------------------------------------------------------------
+
+    def overrides_annotation(self):
+        """ Shards annotate with annotate_text(); see MySearchEngine.overrides_annotation. """
+        return False
+
+    def add(self, id, text, timestamp=None):
+        """ Adds a document to the shard that owns its id; see MySearchEngine.add. """
+        index = self.shard_of(id)
+        if self.dedup is not None:
+            # the tokens are needed here to check for near-duplicates in other shards
+            if id in self.raw_text:
+                raise RuntimeError("document with id [" + id + "] already indexed.")
+            tokens, entities = self._call(index, "annotate", text)
+            return self.add_annotated(id, text, tokens, entities, timestamp)
+        self._call(index, "add", id, text, timestamp)
+        self._num_docs += 1
+        self._stats_changes += 1
+
+    def add_annotated(self, id, text, tokens, entities, timestamp=None):
+        """ Adds an annotated document to the shard that owns its id; see MySearchEngine.add_annotated. """
+        if self.dedup is not None:
+            if id in self.raw_text:
+                raise RuntimeError("document with id [" + id + "] already indexed.")
+            original = self.dedup.check(id, tokens)
+            if original is not None and self.dedup.drop_duplicates:
+                return original
+        self._call(self.shard_of(id), "add_annotated", id, text, tokens, entities, timestamp)
+        self._num_docs += 1
+        self._stats_changes += 1
+        return None
+
+    def add_many(self, docs, workers=1, chunksize=4, timestamps=None):
+        """ Adds many documents, each shard indexing its part of them in parallel; see
+            MySearchEngine.add_many. workers is the number of NLP processes per shard.
+            Returns the stage timings summed over shards.
+
+            With a dedup detector the documents are added one at a time instead, since
+            each must be checked against the ones added before it.
+        """
+        docs = list(docs.items()) if hasattr(docs, "items") else list(docs)
+        timestamps = timestamps or {}
+        if self.dedup is not None:
+            duplicates = 0
+            for id, text in docs:
+                if self.add(id, text, timestamps.get(id)) is not None:
+                    duplicates += 1
+            return {"duplicates": duplicates}
+
+        parts = [[] for _ in range(self.num_shards)]
+        for id, text in docs:
+            parts[self.shard_of(id)].append((id, text))
+
+        # check for documents already in collection (or repeated) before doing any work
+        seen = set()
+        for id, text in docs:
+            if id in seen:
+                raise RuntimeError("document with id [" + id + "] already indexed.")
+            seen.add(id)
+        for ids in self._scatter([(index, "indexed", ([id for id, text in part],), {})
+                                  for index, part in enumerate(parts) if part]):
+            if ids:
+                raise RuntimeError("document with id [" + ids[0] + "] already indexed.")
+
+        calls = []
+        for index, part in enumerate(parts):
+            if part:
+                part_timestamps = {id: timestamps[id] for id, text in part if id in timestamps}
+                calls.append((index, "add_many", (part,),
+                              {"workers": workers, "chunksize": chunksize, "timestamps": part_timestamps}))
+
+        timings = Counter()
+        for shard_timings in self._scatter(calls):
+            timings.update(shard_timings)
+        self._num_docs += len(docs)
+        self._stats_changes += len(docs)
+        return dict(timings)
+
+    def remove(self, id):
+        """ Removes a document from the shard that owns it; see MySearchEngine.remove. """
+        self._call(self.shard_of(id), "remove", id)
+        self._num_docs -= 1
+        self._stats_changes += 1
+        if self.dedup is not None and id in self.dedup:
+            self.dedup.remove(id)
+
+    def expire(self, max_age=None, now=None):
+        """ Removes every document older than max_age seconds (retention if None) from
+            every shard; see MySearchEngine.expire. Returns the ids of the removed documents.
+        """
+        max_age = self.retention if max_age is None else max_age
+        if max_age is None:
+            return []
+        expired = [id for ids in self._broadcast("expire", max_age, now) for id in ids]
+        self._num_docs -= len(expired)
+        self._stats_changes += len(expired)
+        if self.dedup is not None:
+            for id in expired:
+                if id in self.dedup:
+                    self.dedup.remove(id)
+        return expired
+
+    # ------------------------------------------------------------------------
+    #  lookups
+    # ------------------------------------------------------------------------
+
+    def num_docs(self):
+        """ Returns the current number of documents over all shards. """
+        return self._num_docs
+
+    def get(self, id):
+        """ Returns the original (raw) text of a document. """
+        return self._call(self.shard_of(id), "get", id)
+
+    def memory_usage(self):
+        """ Returns the sizes of MySearchEngine.memory_usage summed over shards; terms
+            held by several shards are counted once per shard.
+        """
+        total = Counter()
+        for usage in self._broadcast("memory_usage"):
+            total.update(usage)
+        return dict(total)
+
+    def get_entity_vector(self, id):
+        """ Returns the Counter of entities in a document. """
+        return self._call(self.shard_of(id), "get_entity_vector", id)
+
+    def get_most_common_entities(self, ids, k=10, weights=None):
+        """ Returns the k entities with the largest counts summed over some documents;
+            see MySearchEngine.get_most_common_entities. Each shard sums its documents,
+            then the totals are merged; ties are broken by name.
+        """
+        ids = list(ids)
+        weights = None if weights is None else list(weights)
+        parts = {}
+        for i, id in enumerate(ids):
+            part = parts.setdefault(self.shard_of(id), ([], []))
+            part[0].append(id)
+            if weights is not None:
+                part[1].append(weights[i])
+        totals = Counter()
+        for shard_totals in self._scatter([(index, "get_most_common_entities",
+                                            (part_ids, None, None if weights is None else part_weights), {})
+                                           for index, (part_ids, part_weights) in parts.items()]):
+            for entity, total in shard_totals:
+                totals[entity] += total
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+        return ranked if k is None else ranked[:k]
+
+    def get_associated_entities(self, entity):
+        """ Returns the Counter of coocurrences of given entity with all other entities,
+            summed over shards.
+        """
+        rows = [row for row in self._broadcast("entity_row", entity) if row is not None]
+        if not rows:
+            raise KeyError("entity with name [" + entity + "] not found in index.")
+        total = Counter()
+        for row in rows:
+            total.update(row)
+        return total
+
+    def get_most_associated_entities(self, entity, k=10, scoring="count", min_count=1):
+        """ Returns the k entities most associated with given entity over all shards;
+            see MySearchEngine.get_most_associated_entities. Ties are broken by name.
+        """
+        if scoring not in SCORINGS:
+            raise ValueError("scoring must be one of " + ", ".join(SCORINGS) + ".")
+        counts = self.get_associated_entities(entity)
+        counts = Counter({other: count for other, count in counts.items() if count >= min_count})
+
+        if scoring == "count":
+            scores = counts
+        else:
+            # PMI needs document counts over all shards, also from shards lacking entity
+            doc_counts = Counter()
+            num_docs = 0
+            for shard_doc_counts, shard_num_docs in self._broadcast("entity_doc_counts", [entity] + list(counts)):
+                doc_counts.update(shard_doc_counts)
+                num_docs += shard_num_docs
+            scores = {}
+            for other, count in counts.items():
+                joint = count / num_docs
+                score = math.log(joint / (doc_counts[entity] / num_docs * doc_counts[other] / num_docs))
+                if scoring == "npmi":
+                    denominator = -math.log(joint)
+                    score = score / denominator if denominator > 0 else 1.0
+                scores[other] = score
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:max(k, 0)]
+
+    # ------------------------------------------------------------------------
+    #  statistics
+    # ------------------------------------------------------------------------
+
+    def stats_are_stale(self):
+        """ Returns True if more documents were added or removed since the shards'
+            statistics were last synced than stats_tolerance allows; see
+            MySearchEngine.stats_are_stale.
+        """
+        if self._stats_num_docs is None:
+            return True
+        return self._stats_changes > self.stats_tolerance * max(1, self._stats_num_docs)
+
+    def refresh_stats(self):
+        """ Gathers the shards' document frequency changes and pushes the summed global
+            statistics back to every shard.
+        """
+        changes = Counter()
+        for shard_changes in self._broadcast("take_doc_freq_changes"):
+            changes.update(shard_changes)
+        changes = Counter({term: change for term, change in changes.items() if change})
+
+        for term, change in changes.items():
+            self.doc_freq[term] += change
+            if self.doc_freq[term] <= 0:
+                del self.doc_freq[term]
+        self._broadcast("set_global_stats", changes, self._num_docs)
+        self._stats_num_docs = self._num_docs
+        self._stats_changes = 0
+
+    # ------------------------------------------------------------------------
+    #  querying
+    # ------------------------------------------------------------------------
+
+    def query(self, q, k=10, mode="or", half_life=None, since=None, now=None, window=10):
+        """ Returns up to top k documents over all shards, sorted by relevance; see
+            MySearchEngine.query.
+        """
+        if self.stats_are_stale():
+            self.refresh_stats()
+        results = self._broadcast("query", q, k, mode, half_life, since, now, window)
+        return heapq.nlargest(k, (match for result in results for match in result), key=itemgetter(1))
+
+    def query_batch(self, queries, k=10, mode="or", workers=1, executor="thread"):
+        """ Runs many queries at once, each shard scoring the whole batch; see
+            MySearchEngine.query_batch.
+        """
+        queries = list(queries)
+        if self.stats_are_stale():
+            self.refresh_stats()
+        results = self._broadcast("query_batch", queries, k, mode, workers, executor)
+        return [heapq.nlargest(k, (match for result in shard_results for match in result), key=itemgetter(1))
+                for shard_results in zip(*results)]
@@ -0,0 +1,399 @@
+from collections import Counter
+from .SearchEngine import MySearchEngine
+import math
+import numpy as np
+import time
+
+__all__ = ["SparseSearchEngine"]
+
+
+class _Segment():
+    """ An immutable block of the term-document matrix in CSC layout.
+
+        Column t (a term id) holds the postings of that term:
+        doc_ids[indptr[t]:indptr[t + 1]] are global document numbers in increasing
+        order and tfs[...] the matching term frequencies. Terms first seen after the
+        segment was built have an empty column (t >= num_terms).
+    """
+    def __init__(self, indptr, doc_ids, tfs, first_doc, end_doc):
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+
+        # global document numbers covered by this segment: [first_doc, end_doc)
+        self.first_doc = first_doc
+        self.end_doc = end_doc
+
+    @property
+    def num_terms(self):
+        return len(self.indptr) - 1
+
+    @property
+    def num_docs(self):
+        return self.end_doc - self.first_doc
+
+    def column(self, term_id):
+        """ Returns (doc_ids, tfs) of the postings of a term in this segment. """
+        if term_id >= self.num_terms:
+            return self.doc_ids[:0], self.tfs[:0]
+        lo, hi = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.doc_ids[lo:hi], self.tfs[lo:hi]
+
+    def term_ids(self):
+        """ Returns the term id of every stored posting (the expanded column index). """
+        return np.repeat(np.arange(self.num_terms, dtype=np.int64), np.diff(self.indptr))
+
+    @classmethod
+    def from_coo(cls, term_ids, doc_ids, tfs, num_terms, first_doc, end_doc):
+        """ Builds a segment from unsorted (term id, doc, tf) triples. """
+        # sort by term, then by document, so each column is in document order
+        order = np.lexsort((doc_ids, term_ids))
+        term_ids = term_ids[order]
+        indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=num_terms), out=indptr[1:])
+        return cls(indptr, doc_ids[order].astype(np.int32), tfs[order].astype(np.int32),
+                   first_doc, end_doc)
+
+
+class SparseSearchEngine(MySearchEngine):
+    """ A MySearchEngine whose term index is a vocabulary of integer term ids plus a
+        term-document matrix stored as NumPy arrays, instead of dicts of Counters and sets.
+
+        New documents are buffered and appended to the matrix in segments of
+        segment_size documents. Adjacent segments are merged whenever the older one
+        is no larger than the newer one, which keeps O(log n) segments. Removed
+        documents are tombstoned and physically dropped on the next merge.
+
+        Queries are scored as a sparse matrix-vector product over the query term
+        columns followed by np.argpartition for the top k.
+    """
+
+    def __init__(self, segment_size=1024, doc_store=None, tokenizer="nltk"):
+        super().__init__(doc_store=doc_store, tokenizer=tokenizer)
+
+        # int: number of buffered documents that triggers building a new segment
+        self.segment_size = segment_size
+
+        # Dict[str, int]: maps term to term id (column of the term-document matrix)
+        self.vocabulary = {}
+
+        # List[int]: document frequency per term id
+        self._df = []
+
+        # bytearray: 1 per live document number, 0 once removed
+        self._alive = bytearray()
+
+        # List[_Segment]: sealed segments, oldest first
+        self._segments = []
+
+        # List[int]: buffered (term id, doc number, tf) triples not yet in a segment
+        self._pending_terms = []
+        self._pending_docs = []
+        self._pending_tfs = []
+
+        # np.ndarray: idf per term id and tf-idf norm per document number, as of the last refresh
+        self._idf = np.zeros(0)
+        self._norms = np.zeros(0)
+
+    # ------------------------------------------------------------------------
+    #  indexing
+    # ------------------------------------------------------------------------
+
+    def _index_terms(self, id, tokens):
+        doc = self._intern_doc(id)
+        self._alive.append(1)
+
+        for term, tf in Counter(tokens).items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                term_id = self.vocabulary[term] = len(self._df)
+                self._df.append(0)
+            self._df[term_id] += 1
+            self._pending_terms.append(term_id)
+            self._pending_docs.append(doc)
+            self._pending_tfs.append(tf)
+
+        if len(self._doc_names) - self._pending_first_doc() >= self.segment_size:
+            self.flush()
+
+    def _unindex_terms(self, id):
+        doc = self._doc_numbers.pop(id)
+        self._doc_names[doc] = None
+        self._alive[doc] = 0
+
+        # decrement document frequencies of the removed document's terms
+        for term_id in self._doc_term_ids(doc):
+            self._df[term_id] -= 1
+
+    def _doc_term_ids(self, doc):
+        """ Returns the term ids of the postings stored for a document number. """
+        if doc >= self._pending_first_doc():
+            return [t for t, d in zip(self._pending_terms, self._pending_docs) if d == doc]
+        for segment in self._segments:
+            if segment.first_doc <= doc < segment.end_doc:
+                positions = np.flatnonzero(segment.doc_ids == doc)
+                return (np.searchsorted(segment.indptr, positions, side="right") - 1).tolist()
+        return []
+
+    def _pending_first_doc(self):
+        return self._segments[-1].end_doc if self._segments else 0
+
+    def flush(self):
+        """ Moves buffered documents into a new segment and merges segments as needed. """
+        end_doc = len(self._doc_names)
+        first_doc = self._pending_first_doc()
+        if end_doc == first_doc:
+            return
+
+        segment = _Segment.from_coo(np.array(self._pending_terms, dtype=np.int64),
+                                    np.array(self._pending_docs, dtype=np.int64),
+                                    np.array(self._pending_tfs, dtype=np.int64),
+                                    len(self._df), first_doc, end_doc)
+        self._pending_terms, self._pending_docs, self._pending_tfs = [], [], []
+        self._segments.append(segment)
+
+        # merge while the previous segment is no larger than the newest one
+        while len(self._segments) > 1 and self._segments[-2].num_docs <= self._segments[-1].num_docs:
+            newer = self._segments.pop()
+            older = self._segments.pop()
+            self._segments.append(self._merge([older, newer]))
+
+    def optimize(self):
+        """ Flushes buffered documents and merges all segments into one, dropping
+            postings of removed documents.
+        """
+        self.flush()
+        if self._segments:
+            self._segments = [self._merge(self._segments)]
+
+    def compact(self):
+        """ Merges all segments, then renumbers the remaining documents and the terms
+            they still contain densely, reclaiming the ids of removed ones.
+        """
+        self.optimize()
+        alive = self._alive_mask()
+        live_terms = np.flatnonzero(np.asarray(self._df, dtype=np.int64) > 0)
+        if alive.all() and len(live_terms) == len(self._df):
+            return
+
+        # columns of dead terms and postings of dead documents were dropped by the merge
+        numbers = np.cumsum(alive) - 1
+        num_docs = int(alive.sum())
+        if self._segments:
+            segment = self._segments[0]
+            self._segments = [_Segment(np.concatenate([[0], segment.indptr[live_terms + 1]]),
+                                       numbers[segment.doc_ids].astype(np.int32), segment.tfs, 0, num_docs)]
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        self.vocabulary = {terms[term_id]: i for i, term_id in enumerate(live_terms.tolist())}
+        self._df = [self._df[term_id] for term_id in live_terms.tolist()]
+        self._doc_names = [id for id in self._doc_names if id is not None]
+        self._doc_numbers = {id: doc for doc, id in enumerate(self._doc_names)}
+        self._alive = bytearray(b"\x01") * num_docs
+
+        # statistics are indexed by the old numbers; recompute them on the next query
+        self._idf = np.zeros(0)
+        self._norms = np.zeros(0)
+        self._stats_num_docs = None
+
+    def _merge(self, segments):
+        """ Merges adjacent segments into one, dropping postings of removed documents. """
+        term_ids = np.concatenate([segment.term_ids() for segment in segments])
+        doc_ids = np.concatenate([segment.doc_ids for segment in segments])
+        tfs = np.concatenate([segment.tfs for segment in segments])
+
+        alive = self._alive_mask()[doc_ids]
+        return _Segment.from_coo(term_ids[alive], doc_ids[alive], tfs[alive], len(self._df),
+                                 segments[0].first_doc, segments[-1].end_doc)
+
+    def _alive_mask(self):
+        return np.frombuffer(bytes(self._alive), dtype=bool)
+
+    # ------------------------------------------------------------------------
+    #  matching
+    # ------------------------------------------------------------------------
+
+    def _postings(self, term):
+        """ Returns a sorted array of the live document numbers that contain term. """
+        self.flush()
+        term_id = self.vocabulary.get(term)
+        if term_id is None or not self._segments:
+            return np.zeros(0, dtype=np.int32)
+        docs = np.concatenate([segment.column(term_id)[0] for segment in self._segments])
+        return docs[self._alive_mask()[docs]]
+
+    def get_matches_term(self, term):
+        return self._doc_ids_of(self._postings(term.lower()))
+
+    def get_matches_OR(self, terms):
+        postings = [self._postings(term) for term in terms]
+        if not postings:
+            return set()
+        return self._doc_ids_of(np.unique(np.concatenate(postings)))
+
+    def get_matches_AND(self, terms):
+        # intersect smallest postings first so intermediate results stay small
+        postings = sorted((self._postings(term) for term in terms), key=len)
+        docs = postings[0]
+        for other in postings[1:]:
+            docs = np.intersect1d(docs, other, assume_unique=True)
+        return self._doc_ids_of(docs)
+
+    def get_matches_NOT(self, terms):
+        self.flush()
+        keep = self._alive_mask().copy()
+        for term in terms:
+            keep[self._postings(term)] = False
+        return self._doc_ids_of(np.flatnonzero(keep))
+
+    # ------------------------------------------------------------------------
+    #  scoring
+    # ------------------------------------------------------------------------
+
+    def _term_df(self, term):
+        term_id = self.vocabulary.get(term)
+        return 0 if term_id is None else self._df[term_id]
+
+    def idf(self, term):
+        num_docs = self.num_docs()
+        if num_docs == 0:
+            return 0.0
+        return math.log10(num_docs / (1.0 + self._term_df(term)))
+
+    def cached_idf(self, term):
+        term_id = self.vocabulary.get(term)
+        if term_id is not None and term_id < len(self._idf):
+            return float(self._idf[term_id])
+        num_docs = self.num_docs() if self._stats_num_docs is None else self._stats_num_docs
+        if num_docs == 0:
+            return 0.0
+        return math.log10(num_docs / (1.0 + self._term_df(term)))
+
+    def refresh_stats(self):
+        """ Recomputes idf per term and the tf-idf norm of every document, vectorized
+            over all segments.
+        """
+        self.flush()
+        self._stats_num_docs = self.num_docs()
+        self._stats_changes = 0
+        self._idf = self._idf_array(self._stats_num_docs, 0)
+        self._norms = np.zeros(len(self._doc_names))
+        for segment in self._segments:
+            self._add_segment_norms(segment, 0)
+
+    def _idf_array(self, num_docs, start):
+        df = np.asarray(self._df[start:], dtype=np.float64)
+        if num_docs == 0:
+            return np.zeros(len(df))
+        return np.log10(num_docs / (1.0 + df))
+
+    def _add_segment_norms(self, segment, first_doc):
+        """ Fills in the norms of the documents of a segment numbered first_doc or higher. """
+        term_ids = segment.term_ids()
+        new = segment.doc_ids >= first_doc
+        weights = segment.tfs[new] * self._idf[term_ids[new]]
+        squares = np.bincount(segment.doc_ids[new], weights=weights ** 2, minlength=len(self._norms))
+        lo, hi = max(first_doc, segment.first_doc), segment.end_doc
+        self._norms[lo:hi] = np.sqrt(squares[lo:hi])
+
+    def _ensure_stats(self):
+        """ Refreshes stale statistics, or extends them to documents flushed since the
+            last refresh when within stats_tolerance.
+        """
+        self.flush()
+        if self.stats_are_stale():
+            self.refresh_stats()
+            return
+
+        # idf for new terms against the cached num_docs, norms for new documents
+        if len(self._idf) < len(self._df):
+            self._idf = np.concatenate([self._idf, self._idf_array(self._stats_num_docs, len(self._idf))])
+        if len(self._norms) < len(self._doc_names):
+            first_new = len(self._norms)
+            self._norms = np.concatenate([self._norms, np.zeros(len(self._doc_names) - first_new)])
+            for segment in self._segments:
+                if segment.end_doc > first_new:
+                    self._add_segment_norms(segment, first_new)
+
+    # ------------------------------------------------------------------------
+    #  querying
+    # ------------------------------------------------------------------------
+
+    def _query(self, query_tokens, k, mode, half_life, since, now, window=None):
+        """ Scores the documents matching the tokens of a query (see MySearchEngine.query);
+            with since given, only segments holding recent documents are scanned.
+        """
+        self._ensure_stats()
+        query_tv = Counter(query_tokens)
+        if not query_tv:
+            return []
+        query_norm = self._cached_length(query_tv)
+
+        # documents are numbered in insertion order, so recent ones sit in the newest segments
+        segments = self._segments
+        if since is not None:
+            within = np.asarray(self._docs_since(since), dtype=np.int64)
+            if len(within) == 0:
+                return []
+            segments = [segment for segment in segments if segment.end_doc > within[0]]
+
+        # scores = X[:, query terms] @ query weights, with X the tf matrix
+        num_docs = len(self._doc_names)
+        scores = np.zeros(num_docs)
+        matched = np.zeros(num_docs, dtype=np.int32)
+        for term, tf in query_tv.items():
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            weight = tf * self._idf[term_id] ** 2
+            for segment in segments:
+                docs, tfs = segment.column(term_id)
+                scores[docs] += weight * tfs
+                matched[docs] += 1
+
+        if mode == "or":
+            candidates = matched > 0
+        else:
+            candidates = matched == len(query_tv)
+        candidates = candidates & self._alive_mask()
+        if since is not None:
+            recent = np.zeros(num_docs, dtype=bool)
+            recent[within] = True
+            candidates &= recent
+        candidates = np.flatnonzero(candidates)
+        if len(candidates) == 0 or k <= 0:
+            return []
+
+        scores = scores[candidates] / np.maximum(1e-7, query_norm * self._norms[candidates])
+        if half_life is not None:
+            now = time.time() if now is None else now
+            scores *= [self._recency(doc, now, half_life) for doc in candidates.tolist()]
+
+        # partial selection of the top k, then sort only those
+        if k < len(candidates):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(candidates))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self._doc_names[candidates[i]], float(scores[i])) for i in top]
+
+    def _prepare_batch(self):
+        self._ensure_stats()
+
+    def _batch_postings(self, terms):
+        alive = self._alive_mask()
+        postings = []
+        for term in terms:
+            term_id = self.vocabulary.get(term)
+            if term_id is None or not self._segments:
+                postings.append((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)))
+                continue
+            columns = [segment.column(term_id) for segment in self._segments]
+            docs = np.concatenate([docs for docs, tfs in columns])
+            tfs = np.concatenate([tfs for docs, tfs in columns])
+            live = alive[docs]
+            postings.append((docs[live].astype(np.int64), tfs[live]))
+        return postings
+
+    def _batch_norms(self):
+        return self._norms
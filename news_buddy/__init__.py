@@ -1,8 +1,16 @@
 from .SearchEngine import MySearchEngine
-import nltk
-from nltk.tokenize import word_tokenize
-from collections import Counter
+from . import metrics
+from .article_cache import ArticleCache, rebuild_index
+from .cache import QueryCache
 from .collect_rss import collect
+from .dedup import NearDuplicateDetector
+from .docstore import FileDocumentStore
+from .pipeline import IngestionPipeline
+from .poller import FeedPoller
+from .serving import SearchService
+from .storage import save_index, load_index
+from .tokenizer import split_words
+import os
 import pickle
 
 __all__ = [
@@ -12,20 +20,87 @@ __all__ = [
         "update_via_rss_feed"
         ]
 
-try:
-    with open("mysearchengine.pkl", "rb") as f:
-        mse = pickle.load(f)
-except:
-    mse = MySearchEngine()
+# environment variable naming the index (or pickle) that the module-level `mse` is loaded from
+INDEX_PATH_VARIABLE = "NEWS_BUDDY_INDEX"
+DEFAULT_INDEX_PATH = "mysearchengine.pkl"
 
-def new_with(texts, search_engine = mse, trigger_token = "Reuters"):
+
+def open_search_engine(path=None):
+    """
+    Opens a search engine from disk, or returns an empty one if there is nothing at path.
+
+    params:
+        path [String]:
+            A directory written by save_index() or a file written by save(). Defaults to
+            the NEWS_BUDDY_INDEX environment variable, then to "mysearchengine.pkl".
+
+    returns:
+        search_engine [MySearchEngine]
+    """
+    if path is None:
+        path = os.environ.get(INDEX_PATH_VARIABLE, DEFAULT_INDEX_PATH)
+
+    if os.path.isdir(path):
+        return load_index(path)
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return MySearchEngine()
+
+
+def get_search_engine():
+    """ Returns the module-level search engine `mse`, opening it on first use. """
+    global mse
+    try:
+        return mse
+    except NameError:
+        mse = open_search_engine()
+        return mse
+
+
+def enable_metrics(search_engine=None):
+    """
+    Starts recording latency histograms and counters (see metrics.py) and exports the
+    memory used by a search engine's structures as gauges.
+
+    params:
+        search_engine [MySearchEngine]:
+            The search engine to report on; the module-level `mse` if None.
+
+    returns:
+        metrics [module]:
+            news_buddy.metrics, whose snapshot() and prometheus() export what was recorded.
+    """
+    if search_engine is None:
+        search_engine = get_search_engine()
+    metrics.add_gauges("index", search_engine.memory_usage)
+    metrics.enable()
+    return metrics
+
+
+def __getattr__(name):
+    # `mse` is only opened when first used, not when news_buddy is imported
+    if name == "mse":
+        return get_search_engine()
+    if name == "SparseSearchEngine":
+        from .SparseSearchEngine import SparseSearchEngine
+        return SparseSearchEngine
+    if name == "ShardedSearchEngine":
+        from .ShardedSearchEngine import ShardedSearchEngine
+        return ShardedSearchEngine
+    raise AttributeError("module 'news_buddy' has no attribute '" + name + "'")
+
+@metrics.timed("api_seconds", function="new_with")
+def new_with(texts, search_engine = None, trigger_token = "Reuters", mode = "and"):
 
     """
     Gets the first sentence of the highest ranking document.
 
     param:
         search_engine [MySearchEngine]:
-            The search engine
+            The search engine; the module-level `mse` if None.
 
         texts[Iterable or string]:
             The thing you want to search up.
@@ -33,11 +108,18 @@ def new_with(texts, search_engine = mse, trigger_token = "Reuters"):
         trigger_token [String]:
             The token in a found document that determines where the actual text starts.
 
+        mode [String]:
+            The query mode; "phrase" finds the words next to each other (e.g. "North
+            Korea"), which needs an engine built with positions=True.
+
     returns:
         sentence[str]:
             The first sentence of the highest ranking document.
     """
 
+    if search_engine is None:
+        search_engine = get_search_engine()
+
     # if texts is a list, make it into a space seperated string of words
     if type(texts) != str and hasattr(texts, '__iter__'):
         texts = " ".join(texts)
@@ -45,7 +127,7 @@ def new_with(texts, search_engine = mse, trigger_token = "Reuters"):
     assert(type(texts) == str)
 
     # get id of top document
-    doc_ids = search_engine.query(texts, k=1, mode="and")
+    doc_ids = search_engine.query(texts, k=1, mode=mode)
 
     if len(doc_ids) == 0:
         return "Input phrase not found."
@@ -56,7 +138,7 @@ def new_with(texts, search_engine = mse, trigger_token = "Reuters"):
     raw_text = search_engine.get(best_doc_id)
 
     # tokenize raw text
-    raw_tokens = word_tokenize(raw_text)
+    raw_tokens = split_words(raw_text, search_engine.tokenizer)
 
     # find index of first period in token list
     if "." not in raw_tokens:
@@ -75,13 +157,14 @@ def new_with(texts, search_engine = mse, trigger_token = "Reuters"):
     return " ".join(raw_tokens[first_dash_index:first_period_index]) + "."
 
 
-def most_associated_with_entity(entity, search_engine=mse, num_entities=10):
+@metrics.timed("api_seconds", function="most_associated_with_entity")
+def most_associated_with_entity(entity, search_engine=None, num_entities=10, scoring="count"):
     """
     Gets the entities that are most associated with another entity.
 
     params:
         search_engine [MySearchEngine]:
-            The search engine
+            The search engine; the module-level `mse` if None.
 
         entity[string]:
             The entity that you want to find the entities associated with it.
@@ -90,6 +173,11 @@ def most_associated_with_entity(entity, search_engine=mse, num_entities=10):
         num_entities[int]:
             An int that describes the amount of entities returned.
 
+        scoring[string]:
+            "count" ranks entities by the number of articles they share with entity,
+            "pmi" / "npmi" by (normalized) pointwise mutual information, which favours
+            entities specific to entity over ones that are common everywhere.
+
 
     returns:
         associated_entities[List]:
@@ -97,21 +185,25 @@ def most_associated_with_entity(entity, search_engine=mse, num_entities=10):
 
     """
 
+    if search_engine is None:
+        search_engine = get_search_engine()
+
     try:
-        associated_entities = search_engine.get_associated_entities(entity)
-    except:
+        associated_entities = search_engine.get_most_associated_entities(entity, num_entities, scoring)
+    except KeyError:
         return []
 
-    return list(list(zip(*associated_entities.most_common(num_entities)))[0])
+    return [associated_entity for associated_entity, score in associated_entities]
 
 
-def most_associated_with_phrase(text, search_engine=mse, num_entities=10, num_docs=10):
+@metrics.timed("api_seconds", function="most_associated_with_phrase")
+def most_associated_with_phrase(text, search_engine=None, num_entities=10, num_docs=10, weighted=False):
     """
     Gets the entities that are most associated with a phrase.
 
     params:
         search_engine [MySearchEngine]:
-            The search engine
+            The search engine; the module-level `mse` if None.
 
         text[string]:
             The phrase that you want to find the entities associated with.
@@ -124,77 +216,90 @@ def most_associated_with_phrase(text, search_engine=mse, num_entities=10, num_do
             An int that describes the maximum number of documents to be searched
             through.
 
+        weighted[bool]:
+            Whether each document's entities count as much as its relevance to the
+            phrase (its query score) rather than once per occurrence.
+
     returns:
         associated_entities[List]:
             The top num_entities entities associated with the asked for phrase.
     """
 
+    if search_engine is None:
+        search_engine = get_search_engine()
+
     # get ids of most relevant documents through query
     try:
-        doc_ids = list(zip(*search_engine.query(text, k=num_docs, mode="and")))[0]
+        results = search_engine.query(text, k=num_docs, mode="and")
     except:
         return []
+    if not results:
+        return []
 
-    # sum over entites vectors of all relevant documents
-    accumulative_counter = Counter()
-    for doc_id in doc_ids:
-        accumulative_counter = accumulative_counter + search_engine.get_entity_vector(doc_id)
+    # sum the entity vectors of all relevant documents in one pass
+    doc_ids, scores = zip(*results)
+    most_common = search_engine.get_most_common_entities(doc_ids, k=num_entities,
+                                                         weights=scores if weighted else None)
 
     # return most frequent entities in accumulative vector
-    return list(list(zip(*accumulative_counter.most_common(num_entities)))[0])
+    return [entity for entity, total in most_common]
 
-def update_via_rss_feed(rss_url, search_engine=mse):
+@metrics.timed("api_seconds", function="update_via_rss_feed")
+def update_via_rss_feed(rss_url, search_engine=None, workers=1, cache=None):
     """
     Updates search engine with articles from the given rss feed url.
 
     params:
         search_engine [MySearchEngine]:
-            The search engine
+            The search engine; the module-level `mse` if None.
 
         rss_url [String] or [Iterable(String)]
             The url or iterable of urls of the rss feed(s) from which to import articles.
 
+        workers [int]:
+            Number of threads downloading articles and of processes running the NLP
+            pipeline over them.
+
+        cache [ArticleCache]:
+            If given, pages, texts and annotations are kept in it (see rebuild_index).
+
 
     returns:
-        updates database with new articles found from rss feed.
+        stats [dict]:
+            Per-stage counters of the ingestion pipeline (see IngestionPipeline.stats);
+            articles that failed to download or parse are counted there as errors.
     """
 
-    if type(rss_url) == str:
-        #collect rss field to dictionary(Str,Str)
-        feed_dict = collect(rss_url, mode='return', print_status=False)
-
-        #add each article to dictionary
-        for article_id in feed_dict:
-            try:
-                search_engine.add(article_id, feed_dict[article_id])
-            except:
-                pass
-        print("Added feed to database. Source: " + rss_url)
-
-    elif hasattr(rss_url, '__iter__'):
-        for url in rss_url:
-            #collect rss field to dictionary(Str,Str)
-            feed_dict = collect(url, mode='return', print_status = False)
-
-            #add each article to dictionary
-            for article_id in feed_dict:
-                try:
-                    search_engine.add(article_id, feed_dict[article_id])
-                except:
-                    pass
-            print("Added feed to database. Source: " + url)
-
-def save(obj=mse, file_path="mysearchengine.pkl"):
+    if search_engine is None:
+        search_engine = get_search_engine()
+
+    # a generator would be used up by the pipeline before the status line lists it
+    rss_url = [rss_url] if isinstance(rss_url, str) else list(rss_url)
+
+    # stream the feeds' new articles into the database; articles already in it aren't
+    # downloaded again (use FeedPoller for conditional, scheduled polling)
+    pipeline = IngestionPipeline(search_engine, workers={"fetch": workers},
+                                 processes=workers if workers > 1 else None, cache=cache)
+    stats = pipeline.run(rss_url)
+    dropped = stats["index"]["dropped"]
+    print("Added " + str(stats["index"]["emitted"]) + " articles to database" +
+          (" (dropped " + str(dropped) + " near-duplicates)" if dropped else "") + ". Sources: " + ", ".join(rss_url))
+    return stats
+
+def save(obj=None, file_path="mysearchengine.pkl"):
     """
     Saves object to a given file_path
 
     params:
         obj: [Object]
-            object to save via pickle
+            object to save via pickle; the module-level `mse` if None.
 
         file_path: [String]
             location in which to save file
     """
 
+    if obj is None:
+        obj = get_search_engine()
+
     with open(file_path, "wb") as f:
         pickle.dump(obj, f)
@@ -0,0 +1,34 @@
+import importlib
+import threading
+
+__all__ = ["lazy_import"]
+
+_import_lock = threading.Lock()
+
+
+class _LazyModule():
+    """ Stand-in for a module that is only imported on first attribute access. """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attribute):
+        module = self.__dict__["_module"]
+        if module is None:
+            with _import_lock:
+                module = importlib.import_module(self.__dict__["_name"])
+                self.__dict__["_module"] = module
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return "<lazy module '" + self.__dict__["_name"] + "'>"
+
+
+def lazy_import(name):
+    """
+    Returns a proxy for the module `name` that imports it the first time one of its
+    attributes is used, so that heavy dependencies (nltk, numpy, feedparser, justext,
+    requests) don't slow down `import news_buddy`.
+    """
+    return _LazyModule(name)
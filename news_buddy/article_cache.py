@@ -0,0 +1,311 @@
+""" A local, content-addressed cache of downloaded articles and their annotations.
+
+    Everything expensive to recompute when rebuilding an index is kept: the raw HTML
+    of each url, the text justext extracted from it and the tokens and entities the
+    NLP pipeline found in that text. Blobs are stored once per content hash
+    (sha256), so re-fetching an unchanged page, or the same text under two urls,
+    reuses the extracted text and annotations. rebuild_index() re-creates a search
+    engine from the cache alone, without touching the network.
+
+    Layout of the cache directory:
+
+        cache.sqlite        url -> html hash (plus publication time), derived blobs
+                            (html hash -> text hash, text hash -> annotations) and
+                            size / last use of every blob
+        blobs/ab/abcd...    zlib compressed blobs named by their sha256
+
+    Blobs are evicted least recently used first once their total size exceeds
+    max_bytes, down to EVICT_TO of it so the next few stores don't evict again;
+    urls and derived entries pointing at evicted blobs become misses.
+"""
+from .SearchEngine import annotate_text
+from .collect_rss import extract_text
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+__all__ = ["ArticleCache", "rebuild_index", "content_hash"]
+
+# bumped whenever annotate_text changes its output, so stale annotations aren't reused
+ANNOTATION_VERSION = 1
+
+# fraction of max_bytes that eviction frees the cache down to once it is exceeded
+EVICT_TO = 0.9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, html TEXT NOT NULL, timestamp REAL, fetched REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS derived (source TEXT NOT NULL, kind TEXT NOT NULL, blob TEXT NOT NULL,
+                                    PRIMARY KEY (source, kind));
+CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS blobs_used ON blobs (used);
+CREATE INDEX IF NOT EXISTS derived_blob ON derived (blob);
+"""
+
+
+def content_hash(data):
+    """ Returns the sha256 hex digest of bytes or of a str encoded as utf-8. """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ArticleCache():
+    """
+    On-disk cache of article HTML, extracted text and annotations; see the module
+    docstring. Safe to share between threads.
+
+    params:
+        path [String]:
+            Cache directory; created if it doesn't exist.
+
+        max_bytes [int]:
+            Total size of the (compressed) blobs beyond which the least recently used
+            are evicted; None for no limit.
+
+        level [int]:
+            zlib compression level of the blobs.
+    """
+
+    def __init__(self, path, max_bytes=1 << 30, level=6):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.level = level
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(os.path.join(path, "cache.sqlite"), check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Zeroes the hit/miss counters. """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """ Returns the hit/miss counters and current sizes as a dict. """
+        with self._lock:
+            urls = self._db.execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+            blobs = self._db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "urls": urls,
+                "blobs": blobs,
+                "bytes": self._size,
+                "max_bytes": self.max_bytes}
+
+    # ------------------------------------------------------------------------
+    #  blobs
+    # ------------------------------------------------------------------------
+
+    def _blob_path(self, hash):
+        return os.path.join(self.path, "blobs", hash[:2], hash)
+
+    def _put_blob(self, data):
+        """ Stores bytes under their content hash and returns the hash. """
+        hash = content_hash(data)
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM blobs WHERE hash = ?", (hash,)).fetchone() is None:
+                compressed = zlib.compress(data, self.level)
+                path = self._blob_path(hash)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(compressed)
+                os.replace(tmp_path, path)
+                self._db.execute("INSERT INTO blobs VALUES (?, ?, ?)", (hash, len(compressed), time.time()))
+                self._size += len(compressed)
+                if self.max_bytes is not None and self._size > self.max_bytes:
+                    self.evict(int(self.max_bytes * EVICT_TO), keep=hash)
+            else:
+                self._db.execute("UPDATE blobs SET used = ? WHERE hash = ?", (time.time(), hash))
+        return hash
+
+    def _get_blob(self, hash):
+        """ Returns the bytes stored under a hash, or None if they were evicted. """
+        with self._lock:
+            try:
+                with open(self._blob_path(hash), "rb") as f:
+                    data = zlib.decompress(f.read())
+            except FileNotFoundError:
+                return None
+            self._db.execute("UPDATE blobs SET used = ? WHERE hash = ?", (time.time(), hash))
+        return data
+
+    def _derived(self, source, kind):
+        with self._lock:
+            row = self._db.execute("SELECT blob FROM derived WHERE source = ? AND kind = ?",
+                                   (source, kind)).fetchone()
+            data = None if row is None else self._get_blob(row[0])
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def _put_derived(self, source, kind, data):
+        hash = self._put_blob(data)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO derived VALUES (?, ?, ?)", (source, kind, hash))
+        return hash
+
+    def evict(self, max_bytes=None, keep=None):
+        """ Deletes least recently used blobs until they take at most max_bytes
+            (default: self.max_bytes), never deleting the blob hashed keep.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            if self._size <= max_bytes:
+                return
+            # walk the index on last use only as far as needed, then delete
+            victims = []
+            excess = self._size - max_bytes
+            cursor = self._db.execute("SELECT hash, size FROM blobs ORDER BY used")
+            for hash, size in cursor:
+                if excess <= 0:
+                    break
+                if hash != keep:
+                    victims.append((hash, size))
+                    excess -= size
+            cursor.close()
+
+            for hash, size in victims:
+                try:
+                    os.remove(self._blob_path(hash))
+                except FileNotFoundError:
+                    pass
+                self._db.execute("DELETE FROM blobs WHERE hash = ?", (hash,))
+                self._db.execute("DELETE FROM derived WHERE blob = ?", (hash,))
+                self._size -= size
+                self.evictions += 1
+
+    # ------------------------------------------------------------------------
+    #  pages, texts and annotations
+    # ------------------------------------------------------------------------
+
+    def put_page(self, url, html, timestamp=None):
+        """ Stores the downloaded HTML (bytes) of a url and returns its content hash. """
+        hash = self._put_blob(html)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)", (url, hash, timestamp, time.time()))
+        return hash
+
+    def page(self, url):
+        """ Returns the cached HTML of a url, or None. """
+        with self._lock:
+            row = self._db.execute("SELECT html FROM urls WHERE url = ?", (url,)).fetchone()
+            data = None if row is None else self._get_blob(row[0])
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def urls(self):
+        """ Returns the cached urls with their publication times, as {url: timestamp or None}. """
+        with self._lock:
+            return dict(self._db.execute("SELECT url, timestamp FROM urls ORDER BY fetched"))
+
+    def text_of_page(self, html_hash):
+        """ Returns the text extracted from the page with the given content hash, or None. """
+        data = self._derived(html_hash, "text")
+        return None if data is None else data.decode("utf-8")
+
+    def put_text(self, html_hash, text):
+        """ Stores the text extracted from the page with the given content hash. """
+        self._put_derived(html_hash, "text", text.encode("utf-8"))
+
+    def text(self, url):
+        """ Returns the extracted text of a cached url, or None. """
+        with self._lock:
+            row = self._db.execute("SELECT html FROM urls WHERE url = ?", (url,)).fetchone()
+        return None if row is None else self.text_of_page(row[0])
+
+    def extract(self, url, html, extract, timestamp=None):
+        """ Caches a downloaded page and returns its text, running extract(html) only if
+            the same content was never extracted before.
+        """
+        html_hash = self.put_page(url, html, timestamp)
+        text = self.text_of_page(html_hash)
+        if text is None:
+            text = extract(html)
+            self.put_text(html_hash, text)
+        return text
+
+    def annotations(self, text, tokenizer="nltk"):
+        """ Returns the cached (tokens, entities) of a text for a tokenizer, or None. """
+        data = self._derived(content_hash(text), self._annotation_kind(tokenizer))
+        return None if data is None else pickle.loads(data)
+
+    def put_annotations(self, text, tokenizer, tokens, entities):
+        """ Stores the (tokens, entities) of a text for a tokenizer. """
+        data = pickle.dumps((tokens, entities), protocol=pickle.HIGHEST_PROTOCOL)
+        self._put_derived(content_hash(text), self._annotation_kind(tokenizer), data)
+
+    def annotate(self, text, tokenizer="nltk"):
+        """ Returns (tokens, entities) of a text, running annotate_text only on a miss. """
+        cached = self.annotations(text, tokenizer)
+        if cached is not None:
+            return cached
+        tokens, entities, _ = annotate_text(text, tokenizer)
+        self.put_annotations(text, tokenizer, tokens, entities)
+        return tokens, entities
+
+    @staticmethod
+    def _annotation_kind(tokenizer):
+        return "annotations/" + tokenizer + "/" + str(ANNOTATION_VERSION)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def rebuild_index(cache, search_engine, workers=1):
+    """
+    Adds every article of an ArticleCache to a search engine without any download,
+    reusing the cached annotations (and caching those that were missing).
+
+    params:
+        cache [ArticleCache]:
+            The cache to read articles from.
+
+        search_engine [MySearchEngine]:
+            The (typically empty) search engine to add them to; urls it already
+            holds are skipped.
+
+        workers [int]:
+            Number of processes annotating articles missing from the cache.
+
+    returns:
+        added [list(str)]:
+            The urls that were added; urls whose text and HTML were both evicted, and
+            near-duplicates search_engine.dedup dropped, are left out.
+    """
+    docs = {}
+    timestamps = {}
+    for url, timestamp in cache.urls().items():
+        if url in search_engine.raw_text:
+            continue
+        text = cache.text(url)
+        if text is None:
+            # the text was evicted but the page may still be there
+            html = cache.page(url)
+            if html is None:
+                continue
+            text = cache.extract(url, html, extract_text, timestamp)
+        docs[url] = text
+        if timestamp is not None:
+            timestamps[url] = timestamp
+    search_engine.add_many(docs, workers=workers, timestamps=timestamps, cache=cache)
+    return [url for url in docs if url in search_engine.raw_text]
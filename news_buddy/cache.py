@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import threading
+import time
+
+__all__ = ["QueryCache"]
+
+
+class QueryCache():
+    """
+    LRU cache of query results, with an optional time to live, placed in front of
+    MySearchEngine.query.
+
+    Results are keyed on the normalized query tokens and the query options and are
+    tagged with the index generation they were computed at: the engine bumps its
+    generation on every add and remove, and the first lookup at a new generation
+    empties the cache. Raw query strings are also mapped to their tokens, so a hit
+    skips tokenizing too.
+
+    params:
+        max_size [int]:
+            Maximum number of results (and, separately, of tokenized queries) kept.
+
+        ttl [float]:
+            Seconds after which a result is dropped even if the index didn't change;
+            None to keep results until they are evicted or invalidated.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # OrderedDict[tuple, tuple(float, object)]: key -> (expiry time, result), least recently used first
+        self._results = OrderedDict()
+
+        # OrderedDict[str, list]: raw query -> tokens, least recently used first
+        self._tokens = OrderedDict()
+
+        # int or None: index generation the cached results belong to
+        self._generation = None
+
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Zeroes the hit/miss counters. """
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.token_hits = 0
+        self.token_misses = 0
+
+    def stats(self):
+        """ Returns the hit/miss counters and current sizes as a dict. """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "size": len(self._results),
+                "max_size": self.max_size,
+                "token_hits": self.token_hits,
+                "token_misses": self.token_misses}
+
+    def clear(self):
+        """ Drops every cached result and tokenized query. """
+        with self._lock:
+            self._results.clear()
+            self._tokens.clear()
+
+    def tokens(self, q, tokenize):
+        """ Returns tokenize(q), from the cache if q was tokenized before. """
+        with self._lock:
+            tokens = self._tokens.get(q)
+            if tokens is not None:
+                self._tokens.move_to_end(q)
+                self.token_hits += 1
+                return list(tokens)
+            self.token_misses += 1
+
+        tokens = tokenize(q)
+        with self._lock:
+            self._tokens[q] = tuple(tokens)
+            if len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+        return tokens
+
+    def get(self, key, generation):
+        """ Returns the result cached for key at the given index generation, or None. """
+        with self._lock:
+            if generation != self._generation:
+                if self._results:
+                    self.invalidations += 1
+                self._results.clear()
+                self._generation = generation
+
+            entry = self._results.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self._results[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, result):
+        """ Caches the result of key computed at the given index generation. """
+        with self._lock:
+            if generation != self._generation or self.max_size <= 0:
+                return
+            expiry = None if self.ttl is None else time.monotonic() + self.ttl
+            self._results[key] = (expiry, result)
+            self._results.move_to_end(key)
+            if len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    # cached results are only valid for the engine in memory, so only the settings are pickled
+    def __getstate__(self):
+        return {"max_size": self.max_size, "ttl": self.ttl}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_size"], state["ttl"])
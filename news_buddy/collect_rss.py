@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from ._lazy import lazy_import
+from . import metrics
+import calendar
+import pickle
+import sys
+import threading
+import time
+
+feedparser = lazy_import("feedparser")
+justext = lazy_import("justext")
+requests = lazy_import("requests")
+
+__all__ = ["get_text", "collect", "fetch_texts", "make_session", "entry_timestamp"]
+
+# HTTP statuses worth retrying: throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def make_session(pool_size=10):
+    """
+    Creates a requests.Session whose connection pool can hold pool_size
+    connections per host, so that concurrent fetches reuse connections.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def entry_timestamp(entry):
+    """ Returns when a feed entry was published (or else last updated) in seconds since
+        the epoch, or None if the feed doesn't say.
+    """
+    for key in ("published_parsed", "updated_parsed"):
+        parsed = entry.get(key)
+        if parsed:
+            # feedparser normalizes dates to UTC struct_times
+            return float(calendar.timegm(parsed))
+    return None
+
+
+@metrics.timed("extract_seconds")
+def extract_text(html):
+    paragraphs = justext.justext(html, justext.get_stoplist("English"))
+    text = "\n\n".join([p.text for p in paragraphs if not p.is_boilerplate])
+    return text
+
+
+def get_text(link, session=None, timeout=None, cache=None, timestamp=None):
+    with metrics.timer("fetch_seconds"):
+        response = (session or requests).get(link, timeout=timeout)
+    if cache is not None:
+        # article_cache.ArticleCache: keep the page (and when it was published, so
+        # rebuild_index can date it), and skip justext if it was seen before
+        return cache.extract(link, response.content, extract_text, timestamp)
+    return extract_text(response.content)
+
+
+def _fetch_with_retries(link, session, timeout, retries, backoff):
+    """ Downloads a link, retrying connection errors and RETRY_STATUSES with exponential backoff. """
+    for attempt in range(retries + 1):
+        try:
+            with metrics.timer("fetch_seconds"):
+                response = session.get(link, timeout=timeout)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            error = requests.HTTPError("HTTP " + str(response.status_code), response=response)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        if attempt < retries:
+            metrics.inc("fetch_retries")
+            time.sleep(backoff * 2 ** attempt)
+    metrics.inc("fetch_errors")
+    raise error
+
+
+def fetch_texts(links, workers=8, per_host=4, timeout=10, retries=2, backoff=0.5,
+                session=None, print_status=False, cache=None, timestamps=None):
+    """
+    Downloads and extracts the article text of many links concurrently.
+
+    params:
+        links[Iterable(str)]:
+            The article urls to fetch.
+
+        workers[int]:
+            Number of threads fetching at once.
+
+        per_host[int]:
+            Maximum number of simultaneous requests to the same host.
+
+        timeout[float]:
+            Seconds to wait for the server per request.
+
+        retries[int]:
+            How often to retry connection errors, timeouts and 429/5xx responses.
+
+        backoff[float]:
+            Seconds to wait before the first retry; doubled on each further retry.
+
+        session[requests.Session]:
+            Session to share; by default one is created with a pool of `workers` connections.
+
+        print_status[bool]:
+            Whether to print each link as it is downloaded.
+
+        cache[article_cache.ArticleCache]:
+            If given, downloaded pages are kept in it, and pages whose content was
+            extracted before reuse the cached text.
+
+        timestamps[dict(str, float)]:
+            Publication time of links, stored with their pages in the cache so that
+            article_cache.rebuild_index keeps them dated.
+
+    returns:
+        (texts, errors)[tuple(dict, dict)]:
+            texts maps each successfully fetched link to its text, in the order of `links`;
+            errors maps each failed link to the exception raised for it.
+    """
+    links = list(links)
+    timestamps = timestamps or {}
+    own_session = session is None
+    if own_session:
+        session = make_session(pool_size=max(workers, 1))
+
+    host_slots = {}
+    host_slots_lock = threading.Lock()
+
+    def host_slot(link):
+        host = urlsplit(link).netloc
+        with host_slots_lock:
+            if host not in host_slots:
+                host_slots[host] = threading.BoundedSemaphore(per_host)
+            return host_slots[host]
+
+    def fetch(link):
+        with host_slot(link):
+            if print_status:
+                print("downloading: " + link)
+            response = _fetch_with_retries(link, session, timeout, retries, backoff)
+        # error pages aren't articles, nor worth caching (as in the ingestion pipeline)
+        response.raise_for_status()
+        # parse outside the host slot so the next download can start
+        if cache is not None:
+            return cache.extract(link, response.content, extract_text, timestamps.get(link))
+        return extract_text(response.content)
+
+    def fetch_captured(link):
+        try:
+            return link, fetch(link), None
+        except Exception as e:
+            return link, None, e
+
+    texts = {}
+    errors = {}
+    try:
+        if workers <= 1:
+            results = map(fetch_captured, links)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+            results = pool.map(fetch_captured, links)
+
+        for link, text, error in results:
+            if error is None:
+                texts[link] = text
+            else:
+                errors[link] = error
+                if print_status:
+                    print("failed: " + link + " (" + str(error) + ")")
+    finally:
+        if workers > 1:
+            pool.shutdown()
+        if own_session:
+            session.close()
+
+    return texts, errors
+
+
+def collect(url, filename="rssdata.txt", mode='write', print_status=True, workers=1, with_published=False,
+            **fetch_options):
+    # read RSS feed
+    with metrics.timer("feed_parse_seconds"):
+        d = feedparser.parse(url)
+
+    # publication times, as {link: seconds since the epoch}
+    links = [entry["link"] for entry in d["entries"]]
+    published = {}
+    for entry in d["entries"]:
+        timestamp = entry_timestamp(entry)
+        if timestamp is not None:
+            published[entry["link"]] = timestamp
+
+    # grab each article; links that fail to download are left out
+    texts, errors = fetch_texts(links, workers=workers, print_status=print_status, timestamps=published,
+                                **fetch_options)
+
+    # with_published: also return the publication times
+    result = texts
+    if with_published:
+        result = (texts, {link: timestamp for link, timestamp in published.items() if link in texts})
+
+    if mode == 'write':
+        # pickle
+        pickle.dump(result, open(filename, "wb"))
+
+    elif mode == 'return':
+        return result
+
+    else:
+        raise Exception("Mode not implemented.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("Usage: python -m news_buddy.collect_rss <url> <filename> [workers]")
+        sys.exit(1)
+
+    # https://www.reuters.com/tools/rss
+    # http://feeds.reuters.com/Reuters/domesticNews
+    url = sys.argv[1]
+    filename = sys.argv[2]
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    collect(url, filename, workers=workers)
@@ -0,0 +1,253 @@
+""" Near-duplicate detection of articles with MinHash and locality sensitive hashing.
+
+    Syndicated wire stories reach many feeds under different urls with almost the
+    same text. Each document is reduced to the set of its token shingles (runs of
+    shingle_size consecutive tokens) and summarized by a MinHash signature: for
+    num_perm random hash functions, the smallest hash of any shingle. Two signatures
+    agree on a given position with probability equal to the Jaccard similarity of the
+    shingle sets.
+
+    Signatures are cut into bands of rows; documents sharing all the rows of any
+    band land in the same bucket. Looking up a document only compares it with the
+    documents in its buckets, so the cost per document doesn't grow with the size of
+    the index. Pairs with Jaccard similarity s become candidates with probability
+    1 - (1 - s^rows)^bands; bands and rows are picked so that it is high at the
+    threshold, and candidates are then confirmed by comparing their signatures.
+"""
+from ._lazy import lazy_import
+import zlib
+
+np = lazy_import("numpy")
+
+__all__ = ["NearDuplicateDetector"]
+
+# Mersenne prime modulus of the MinHash permutations (a * x + b) % _PRIME
+_PRIME = (1 << 31) - 1
+
+
+def lsh_bands(num_perm, threshold, recall=0.9):
+    """ Returns the (bands, rows) with bands * rows == num_perm with the most rows per band
+        (so the fewest dissimilar candidates) that still make pairs at the threshold
+        similarity candidates with at least the given probability.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateDetector():
+    """
+    Finds documents whose token shingles are nearly the same as those of a document
+    seen before; see the module docstring.
+
+    Every document checked is either the original of a cluster, kept in the LSH
+    buckets, or a near-duplicate of one, recorded as a member of its cluster.
+
+    params:
+        threshold [float]:
+            Estimated Jaccard similarity of shingle sets from which a document is a
+            near-duplicate.
+
+        num_perm [int]:
+            Length of the MinHash signatures; longer ones estimate similarity more
+            accurately but cost more to compute.
+
+        shingle_size [int]:
+            Number of consecutive tokens per shingle.
+
+        drop_duplicates [bool]:
+            Whether a search engine using this detector leaves near-duplicates out of
+            its index (they stay listed in their cluster) or indexes them as well.
+
+        seed [int]:
+            Seed of the hash functions; detectors only agree if it is the same.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=128, shingle_size=3, drop_duplicates=True, seed=1):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be in (0, 1].")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.drop_duplicates = drop_duplicates
+        self.bands, self.rows = lsh_bands(num_perm, threshold)
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+        # Dict[str, ndarray]: maps document id to its signature, for originals and members
+        self._signatures = {}
+
+        # Dict[bytes, list(str)]: maps band number + band of a signature to the originals in that bucket
+        self._buckets = {}
+
+        # Dict[str, str]: maps every document checked to the original of its cluster (itself for originals)
+        self._original = {}
+
+        # Dict[str, list(str)]: maps original to the near-duplicates found of it, oldest first
+        self._clusters = {}
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Zeroes the counters. """
+        self.checked = 0
+        self.duplicates = 0
+        self.comparisons = 0
+
+    def stats(self):
+        """ Returns the counters and sizes as a dict. """
+        return {"checked": self.checked,
+                "duplicates": self.duplicates,
+                "comparisons": self.comparisons,
+                "comparisons_per_check": self.comparisons / self.checked if self.checked else 0.0,
+                "originals": len(self._clusters),
+                "buckets": len(self._buckets)}
+
+    # ------------------------------------------------------------------------
+    #  signatures
+    # ------------------------------------------------------------------------
+
+    def signature(self, tokens):
+        """ Returns the MinHash signature (uint32 array of num_perm) of a token sequence,
+            or None if it has no tokens.
+        """
+        tokens = list(tokens)
+        if not tokens:
+            return None
+        size = min(self.shingle_size, len(tokens))
+        shingles = {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles)) % _PRIME
+        # (num_perm x num_shingles) permuted hashes; a, b and x < 2^31 so nothing overflows
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        rows = self.rows
+        return [band.to_bytes(2, "little") + signature[band * rows:(band + 1) * rows].tobytes()
+                for band in range(self.bands)]
+
+    @staticmethod
+    def similarity(signature1, signature2):
+        """ Estimated Jaccard similarity of the shingles behind two signatures. """
+        return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
+
+    # ------------------------------------------------------------------------
+    #  lookups
+    # ------------------------------------------------------------------------
+
+    def find(self, tokens=None, signature=None):
+        """ Returns (original id, estimated similarity) of the most similar original at or
+            above the threshold, or None. Takes the tokens or a precomputed signature.
+        """
+        if signature is None:
+            signature = self.signature(tokens)
+        if signature is None:
+            return None
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        self.comparisons += len(candidates)
+
+        best = None
+        for id in candidates:
+            similarity = self.similarity(signature, self._signatures[id])
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (id, similarity)
+        return best
+
+    def check(self, id, tokens):
+        """
+        Registers a document and returns the id of the original it is a near-duplicate
+        of, or None if it starts a cluster of its own.
+
+        params:
+            id [str]:
+                The document's id; checking an id twice raises a RuntimeError.
+
+            tokens [list(str)]:
+                The document's tokens, as returned by MySearchEngine.tokenize().
+        """
+        if id in self._original:
+            raise RuntimeError("document with id [" + id + "] already checked.")
+        self.checked += 1
+        signature = self.signature(tokens)
+        if signature is None:
+            # nothing to compare; an empty document is never a duplicate
+            self._original[id] = id
+            self._clusters[id] = []
+            return None
+
+        found = self.find(signature=signature)
+        self._signatures[id] = signature
+        if found is not None:
+            original = found[0]
+            self.duplicates += 1
+            self._original[id] = original
+            self._clusters[original].append(id)
+            return original
+
+        self._original[id] = id
+        self._clusters[id] = []
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(id)
+        return None
+
+    def original_of(self, id):
+        """ Returns the original of the cluster a checked document is in (itself for
+            originals), or None if it was never checked.
+        """
+        return self._original.get(id)
+
+    def cluster(self, id):
+        """ Returns the ids of the cluster a checked document is in, original first. """
+        original = self._original[id]
+        return [original] + self._clusters[original]
+
+    def __contains__(self, id):
+        return id in self._original
+
+    def __len__(self):
+        return len(self._original)
+
+    # ------------------------------------------------------------------------
+    #  removal
+    # ------------------------------------------------------------------------
+
+    def remove(self, id):
+        """ Forgets a document. When an original goes, the oldest member of its cluster
+            becomes the original of the others; if duplicates are dropped, they were
+            never indexed and are forgotten too, so they are checked anew if they return.
+        """
+        original = self._original.pop(id)
+        signature = self._signatures.pop(id, None)
+        if original != id:
+            self._clusters[original].remove(id)
+            return
+
+        if signature is not None:
+            for key in self._band_keys(signature):
+                bucket = self._buckets[key]
+                bucket.remove(id)
+                if not bucket:
+                    del self._buckets[key]
+
+        members = self._clusters.pop(id)
+        if self.drop_duplicates:
+            for member in members:
+                del self._original[member]
+                self._signatures.pop(member, None)
+        elif members:
+            successor = members[0]
+            self._clusters[successor] = members[1:]
+            for member in members:
+                self._original[member] = successor
+            for key in self._band_keys(self._signatures[successor]):
+                self._buckets.setdefault(key, []).append(successor)
@@ -0,0 +1,238 @@
+""" Document stores that keep raw article text off the Python heap.
+
+    MySearchEngine.raw_text only needs the MutableMapping interface (id -> text), so
+    any store below can be passed as MySearchEngine(doc_store=...). The default is a
+    plain dict.
+"""
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from ._lazy import lazy_import
+import json
+import mmap
+import os
+import threading
+import zlib
+
+zstandard = lazy_import("zstandard")
+
+__all__ = ["FileDocumentStore"]
+
+FORMAT_NAME = "news_buddy-docstore"
+FORMAT_VERSION = 1
+
+
+class _Codec():
+    """ Compresses single records with zlib, zstd or not at all. """
+
+    def __init__(self, compression, level):
+        if compression not in (None, "zlib", "zstd"):
+            raise ValueError("unknown compression [" + str(compression) + "].")
+        self.compression = compression
+        self.level = level
+        if compression == "zstd":
+            try:
+                self._compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+                self._decompressor = zstandard.ZstdDecompressor()
+            except ImportError:
+                raise ImportError("zstd compression requires the zstandard package.")
+
+    def encode(self, text):
+        data = text.encode("utf-8")
+        if self.compression == "zlib":
+            return zlib.compress(data, 6 if self.level is None else self.level)
+        if self.compression == "zstd":
+            return self._compressor.compress(data)
+        return data
+
+    def decode(self, data):
+        if self.compression == "zlib":
+            data = zlib.decompress(data)
+        elif self.compression == "zstd":
+            data = self._decompressor.decompress(data)
+        return data.decode("utf-8")
+
+
+class FileDocumentStore(MutableMapping):
+    """
+    Append-only document store: texts are appended to a data file and located
+    through an in-memory offset index, so resident memory grows with the number of
+    documents rather than with their size. Reads go through a memory map of the data
+    file, and the most recently read texts are kept in a bounded LRU cache.
+
+    The offset index is also logged to `<path>.idx`, so a store can be reopened.
+    Replacing or deleting a text only updates the index; the old bytes stay in the
+    data file until compact() rewrites it.
+
+    params:
+        path [String]:
+            Data file; created if it doesn't exist.
+
+        compression [String]:
+            None, "zlib" or "zstd" (needs the zstandard package). Each text is
+            compressed on its own so it can be read without its neighbours. Ignored
+            when reopening an existing store, which keeps its own setting.
+
+        cache_size [int]:
+            Number of decoded texts kept in the LRU cache.
+
+        level [int]:
+            Compression level; the codec's default if None.
+    """
+
+    def __init__(self, path, compression=None, cache_size=256, level=None):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.cache_size = cache_size
+
+        # Dict[str, tuple(int, int)]: maps document id to (offset, length) in the data file
+        self._locations = {}
+
+        # OrderedDict[str, str]: recently read texts, least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+        if os.path.exists(self.index_path):
+            compression, level = self._replay_index()
+        else:
+            header = {"format": FORMAT_NAME, "version": FORMAT_VERSION,
+                      "compression": compression, "level": level}
+            with open(self.index_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(header) + "\n")
+
+        self._codec = _Codec(compression, level)
+        self._data = open(path, "ab")
+        self._index = open(self.index_path, "a", encoding="utf-8")
+        self._map = None
+
+    def _replay_index(self):
+        with open(self.index_path, encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("format") != FORMAT_NAME or header.get("version") != FORMAT_VERSION:
+                raise ValueError("[" + self.path + "] is not a supported document store.")
+            for line in f:
+                if not line.endswith("\n"):
+                    # torn write at the end of the log
+                    break
+                fields = line[:-1].split("\t")
+                if fields[0] == "+":
+                    self._locations[fields[3]] = (int(fields[1]), int(fields[2]))
+                elif fields[0] == "-":
+                    self._locations.pop(fields[1], None)
+        return header["compression"], header.get("level")
+
+    @property
+    def compression(self):
+        return self._codec.compression
+
+    # ------------------------------------------------------------------------
+    #  mapping interface
+    # ------------------------------------------------------------------------
+
+    def __getitem__(self, id):
+        with self._lock:
+            if id in self._cache:
+                self._cache.move_to_end(id)
+                return self._cache[id]
+
+            offset, length = self._locations[id]
+            text = self._codec.decode(self._read(offset, length))
+
+            if self.cache_size > 0:
+                self._cache[id] = text
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return text
+
+    def __setitem__(self, id, text):
+        if "\t" in id or "\n" in id:
+            raise ValueError("document ids can't contain tabs or newlines.")
+        data = self._codec.encode(text)
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(data)
+            self._data.flush()
+            self._index.write("+\t" + str(offset) + "\t" + str(len(data)) + "\t" + id + "\n")
+            self._index.flush()
+            self._locations[id] = (offset, len(data))
+            self._cache.pop(id, None)
+
+    def __delitem__(self, id):
+        with self._lock:
+            del self._locations[id]
+            self._index.write("-\t" + id + "\n")
+            self._index.flush()
+            self._cache.pop(id, None)
+
+    def __contains__(self, id):
+        return id in self._locations
+
+    def __iter__(self):
+        return iter(list(self._locations))
+
+    def __len__(self):
+        return len(self._locations)
+
+    # ------------------------------------------------------------------------
+    #  files
+    # ------------------------------------------------------------------------
+
+    def _read(self, offset, length):
+        if length == 0:
+            return b""
+        if self._map is None or offset + length > len(self._map):
+            # the data file grew since it was mapped
+            self._data.flush()
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset:offset + length]
+
+    def stored_bytes(self):
+        """ Returns the size of the live (compressed) texts in bytes. """
+        return sum(length for offset, length in self._locations.values())
+
+    def flush(self):
+        """ Flushes and fsyncs the data file and the offset index. """
+        with self._lock:
+            for f in (self._data, self._index):
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self):
+        """ Rewrites the data file and the offset index without replaced or deleted texts. """
+        with self._lock:
+            tmp_path = self.path + ".compact"
+            tmp_index_path = self.index_path + ".compact"
+            header = {"format": FORMAT_NAME, "version": FORMAT_VERSION,
+                      "compression": self._codec.compression, "level": self._codec.level}
+            locations = {}
+            with open(tmp_path, "wb") as data, open(tmp_index_path, "w", encoding="utf-8") as index:
+                index.write(json.dumps(header) + "\n")
+                for id, (offset, length) in self._locations.items():
+                    locations[id] = (data.tell(), length)
+                    data.write(self._read(offset, length))
+                    index.write("+\t" + str(locations[id][0]) + "\t" + str(length) + "\t" + id + "\n")
+
+            self.close()
+            os.replace(tmp_path, self.path)
+            os.replace(tmp_index_path, self.index_path)
+            self._locations = locations
+            self._data = open(self.path, "ab")
+            self._index = open(self.index_path, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._data.close()
+            self._index.close()
+
+    # pickling an engine keeps its texts in the store and only records where it is
+    def __getstate__(self):
+        self.flush()
+        return {"path": self.path, "cache_size": self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], cache_size=state["cache_size"])
@@ -0,0 +1,513 @@
+from array import array
+from collections import Counter, OrderedDict
+from collections.abc import Mapping, MutableMapping
+from ._lazy import lazy_import
+
+np = lazy_import("numpy")
+
+__all__ = ["EntityCooccurrence", "EntityVectors"]
+
+SCORINGS = ("count", "pmi", "npmi")
+
+
+class EntityCooccurrence(Mapping):
+    """
+    Document-level co-occurrence counts of entity phrases, kept as a sparse symmetric
+    matrix over integer entity ids.
+
+    Reads like the Dict[str, Counter] it replaces: `entity in cooc` tells whether an
+    entity occurs in any document and `cooc[entity]` is the Counter of the entities it
+    co-occurs with. most_common() answers top-k association queries, optionally
+    scored by (normalized) pointwise mutual information, and caches its answers.
+
+    The matrix is stored in CSR form (both triangles, so every row is one slice).
+    The entity ids of added and removed documents are buffered and their pairs are
+    merged into it in one vectorized pass once batch_size pairs are pending; reads
+    combine a row with its buffered pairs, so they are always exact. Removing a
+    document subtracts exactly what adding it contributed; pairs and entities whose
+    counts drop to zero are dropped on merge.
+
+    params:
+        batch_size [int]:
+            Number of buffered (directed) pairs that triggers a merge.
+
+        cache_size [int]:
+            Number of most_common() results to keep.
+    """
+
+    def __init__(self, batch_size=1 << 16, cache_size=4096):
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        # Dict[str, int]: interns entity phrases to entity ids
+        self._ids = {}
+
+        # List[str]: maps entity id back to its phrase
+        self._names = []
+
+        # array('i'): number of documents containing each entity id
+        self._doc_counts = array("i")
+
+        # int: number of documents added, and of entities contained in at least one of them
+        self.num_docs = 0
+        self._num_entities = 0
+
+        # CSR matrix of co-occurrence counts; None until the first merge
+        self._indptr = None
+        self._indices = None
+        self._data = None
+
+        # entity ids of the buffered documents, concatenated, with their number per document
+        # and +1 / -1 per document for additions / removals
+        self._pending_ids = array("i")
+        self._pending_lengths = array("i")
+        self._pending_signs = array("i")
+
+        # int: number of (directed) pairs the buffered documents contribute
+        self._pending_size = 0
+
+        # (rows, columns, weights) arrays of the buffered pairs, built on demand
+        self._pending_pairs = None
+
+        # Set[int]: entity ids whose row has buffered pairs
+        self._dirty = set()
+
+        # int: bumped by every update; Dict[int, int]: version at which a row last changed
+        self._version = 0
+        self._row_versions = {}
+
+        # OrderedDict[tuple, tuple]: most_common() results with the versions they were computed at
+        self._top_k_cache = OrderedDict()
+
+    @classmethod
+    def from_entity_vectors(cls, entity_vectors, **kwargs):
+        """ Builds the matrix from the per-document entity Counters of a search engine. """
+        cooccurrence = cls(**kwargs)
+        for entity_vector in entity_vectors:
+            cooccurrence.add_document(entity_vector.keys())
+        cooccurrence.flush()
+        return cooccurrence
+
+    # ------------------------------------------------------------------------
+    #  updating
+    # ------------------------------------------------------------------------
+
+    def _intern(self, entity):
+        id = self._ids.get(entity)
+        if id is None:
+            id = self._ids[entity] = len(self._names)
+            self._names.append(entity)
+            self._doc_counts.append(0)
+        return id
+
+    def add_document(self, entities):
+        """ Counts one co-occurrence between every two distinct entities of a document. """
+        self._update(sorted({self._intern(entity) for entity in entities}), 1)
+
+    def remove_document(self, entities):
+        """ Subtracts the co-occurrences counted by add_document() for the same entities. """
+        ids = set()
+        for entity in entities:
+            if entity not in self:
+                raise KeyError("entity with name [" + entity + "] not found in index.")
+            ids.add(self._ids[entity])
+        self._update(sorted(ids), -1)
+
+    def _update(self, ids, sign):
+        self.num_docs += sign
+        self._version += 1
+        for id in ids:
+            self._doc_counts[id] += sign
+            self._row_versions[id] = self._version
+            if self._doc_counts[id] == (1 if sign > 0 else 0):
+                self._num_entities += sign
+        if len(ids) < 2:
+            return
+
+        self._pending_ids.extend(ids)
+        self._pending_lengths.append(len(ids))
+        self._pending_signs.append(sign)
+        self._pending_size += len(ids) * (len(ids) - 1)
+        self._pending_pairs = None
+        self._dirty.update(ids)
+        if self._pending_size >= self.batch_size:
+            self.flush()
+
+    def _pending_arrays(self):
+        """ Returns the pairs of the buffered documents as row, column and weight arrays. """
+        if self._pending_pairs is None:
+            ids = np.frombuffer(self._pending_ids, dtype=np.int32)
+            lengths = np.frombuffer(self._pending_lengths, dtype=np.int32).astype(np.int64)
+            signs = np.frombuffer(self._pending_signs, dtype=np.int32)
+            starts = np.cumsum(lengths) - lengths
+
+            # each id is paired with every id of its document: repeat it once per id in
+            # the document and index the document's ids alongside
+            per_id = np.repeat(lengths, lengths)
+            rows = np.repeat(ids, per_id)
+            block_starts = np.repeat(np.repeat(starts, lengths), per_id)
+            position = np.arange(len(rows)) - np.repeat(np.cumsum(per_id) - per_id, per_id)
+            cols = ids[block_starts + position]
+
+            weights = np.repeat(signs, lengths * lengths)
+
+            off_diagonal = rows != cols
+            self._pending_pairs = (rows[off_diagonal], cols[off_diagonal], weights[off_diagonal])
+        return self._pending_pairs
+
+    def flush(self):
+        """ Merges the buffered pairs into the CSR matrix. """
+        if not self._pending_size:
+            return
+        self._merge_pending()
+
+        # reclaim the ids of entities no document contains any more once they are the majority
+        dead = len(self._names) - len(self)
+        if dead > 1024 and dead > len(self._names) // 2:
+            self._compact_ids()
+
+    def _merge_pending(self):
+        n = len(self._names)
+        rows, cols, weights = self._pending_arrays()
+        keys = rows.astype(np.int64) * n + cols
+        if self._indptr is not None:
+            old_n = len(self._indptr) - 1
+            old_rows = np.repeat(np.arange(old_n, dtype=np.int64), np.diff(self._indptr))
+            keys = np.concatenate([old_rows * n + self._indices, keys])
+            weights = np.concatenate([self._data, weights])
+
+        # sum the weights of equal (row, column) keys and drop pairs that cancelled out
+        order = np.argsort(keys, kind="stable")
+        keys, weights = keys[order], weights[order]
+        if len(keys):
+            starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+            keys, weights = keys[starts], np.add.reduceat(weights, starts)
+        nonzero = weights != 0
+        keys, weights = keys[nonzero], weights[nonzero]
+
+        self._indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // n, minlength=n), out=self._indptr[1:])
+        self._indices = (keys % n).astype(np.int32)
+        self._data = weights.astype(np.int32)
+
+        self._pending_ids = array("i")
+        self._pending_lengths = array("i")
+        self._pending_signs = array("i")
+        self._pending_size = 0
+        self._pending_pairs = None
+        self._dirty = set()
+
+    def _compact_ids(self):
+        """ Renumbers the entities still contained in documents densely. Must be called
+            with nothing buffered; their rows and columns are all-zero otherwise.
+        """
+        doc_counts = np.frombuffer(self._doc_counts, dtype=np.int32)
+        alive = np.flatnonzero(doc_counts > 0)
+        new_ids = np.full(len(self._names), -1, dtype=np.int64)
+        new_ids[alive] = np.arange(len(alive))
+
+        if self._indptr is not None:
+            # rows of dead entities are empty, so the row ends of the live ones are unchanged
+            self._indptr = np.concatenate([[0], self._indptr[alive + 1]])
+            self._indices = new_ids[self._indices].astype(np.int32)
+
+        self._names = [self._names[id] for id in alive.tolist()]
+        self._ids = {name: id for id, name in enumerate(self._names)}
+        self._doc_counts = array("i", doc_counts[alive].tolist())
+        self._row_versions = {}
+        self._top_k_cache = OrderedDict()
+
+    # ------------------------------------------------------------------------
+    #  reading
+    # ------------------------------------------------------------------------
+
+    def _row(self, id):
+        """ Returns the (entity ids, counts) arrays of the entities co-occurring with id. """
+        if self._indptr is not None and id < len(self._indptr) - 1:
+            start, end = self._indptr[id], self._indptr[id + 1]
+            cols, counts = self._indices[start:end], self._data[start:end]
+        else:
+            cols, counts = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+
+        if id in self._dirty:
+            rows, pending_cols, pending_weights = self._pending_arrays()
+            mine = rows == id
+            cols, inverse = np.unique(np.concatenate([cols, pending_cols[mine]]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([counts, pending_weights[mine]]),
+                                 minlength=len(cols)).astype(np.int32)
+            nonzero = counts != 0
+            cols, counts = cols[nonzero], counts[nonzero]
+        return cols, counts
+
+    def __contains__(self, entity):
+        id = self._ids.get(entity)
+        return id is not None and self._doc_counts[id] > 0
+
+    def __getitem__(self, entity):
+        if entity not in self:
+            raise KeyError(entity)
+        cols, counts = self._row(self._ids[entity])
+        return Counter(dict(zip([self._names[col] for col in cols.tolist()], counts.tolist())))
+
+    def __iter__(self):
+        return (name for id, name in enumerate(self._names) if self._doc_counts[id] > 0)
+
+    def __len__(self):
+        return self._num_entities
+
+    def doc_count(self, entity):
+        """ Returns the number of documents containing an entity. """
+        id = self._ids.get(entity)
+        return 0 if id is None else self._doc_counts[id]
+
+    def count(self, entity, other):
+        """ Returns the number of documents containing both entities. """
+        if entity not in self or other not in self:
+            return 0
+        cols, counts = self._row(self._ids[entity])
+        i = np.searchsorted(cols, self._ids[other])
+        return int(counts[i]) if i < len(cols) and cols[i] == self._ids[other] else 0
+
+    def num_pairs(self):
+        """ Returns the number of distinct co-occurring (unordered) entity pairs. """
+        self.flush()
+        return 0 if self._data is None else len(self._data) // 2
+
+    def most_common(self, entity, k=10, scoring="count", min_count=1):
+        """
+        Returns the k entities most associated with an entity.
+
+        params:
+            entity [String]:
+                The entity phrase.
+
+            k [int]:
+                Number of entities to return.
+
+            scoring [String]:
+                "count" ranks by the number of documents shared with entity (like
+                Counter.most_common), "pmi" by pointwise mutual information
+                log(p(a, b) / (p(a) p(b))) over documents and "npmi" by PMI normalized
+                to [-1, 1] by -log(p(a, b)).
+
+            min_count [int]:
+                Ignore entities sharing fewer documents than this; PMI otherwise
+                favours entities seen only once.
+
+        returns:
+            List[tuple(str, number)]: (entity, score) pairs, best first.
+        """
+        if scoring not in SCORINGS:
+            raise ValueError("scoring must be one of " + ", ".join(SCORINGS) + ".")
+        if entity not in self:
+            raise KeyError("entity with name [" + entity + "] not found in index.")
+        id = self._ids[entity]
+
+        key = (id, k, scoring, min_count)
+        version = self._row_versions.get(id, 0) if scoring == "count" else self._version
+        cached = self._top_k_cache.get(key)
+        if cached is not None and cached[0] == version:
+            self._top_k_cache.move_to_end(key)
+            return list(cached[1])
+
+        cols, counts = self._row(id)
+        if min_count > 1:
+            enough = counts >= min_count
+            cols, counts = cols[enough], counts[enough]
+
+        if scoring == "count":
+            scores = counts
+        else:
+            doc_counts = np.frombuffer(self._doc_counts, dtype=np.int32)
+            joint = counts / self.num_docs
+            scores = np.log(joint / (doc_counts[id] / self.num_docs * doc_counts[cols] / self.num_docs))
+            if scoring == "npmi":
+                denominator = -np.log(joint)
+                scores = np.where(denominator > 0, scores / np.where(denominator > 0, denominator, 1), 1.0)
+
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+            cols, scores = cols[top], scores[top]
+        # best first; ties in order of first appearance
+        order = np.lexsort((cols, -scores))
+        result = [(self._names[col], score) for col, score in zip(cols[order].tolist(), scores[order].tolist())]
+
+        self._top_k_cache[key] = (version, result)
+        if len(self._top_k_cache) > self.cache_size:
+            self._top_k_cache.popitem(last=False)
+        return list(result)
+
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__)
+        state["_top_k_cache"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        # start from the defaults so matrices pickled by older versions gain new attributes
+        self.__init__(state["batch_size"], state["cache_size"])
+        self.__dict__.update(state)
+        if "_num_entities" not in state:
+            self._num_entities = sum(1 for count in self._doc_counts if count > 0)
+
+
+class EntityVectors(MutableMapping):
+    """
+    The entity vectors of documents (document id -> Counter of entity phrases), kept
+    as entity ids and counts in two flat int32 arrays.
+
+    Reads like the Dict[str, Counter] it replaces, but most_common() sums the vectors
+    of many documents (optionally weighted, e.g. by query score) in one vectorized
+    pass over the arrays instead of adding Counters one by one.
+
+    Each document's entities occupy a contiguous span of the arrays, in the order of
+    its Counter. Arrays grow by doubling; removed documents leave their span behind
+    until dead entries outnumber live ones and the arrays are compacted.
+    """
+
+    def __init__(self):
+        # Dict[str, int]: interns entity phrases to entity ids; List[str]: maps them back
+        self._ids = {}
+        self._names = []
+
+        # ndarray(int32): entity ids and counts of every document's span, the first _size used
+        self._entities = np.zeros(16, dtype=np.int32)
+        self._counts = np.zeros(16, dtype=np.int32)
+        self._size = 0
+
+        # Dict[str, tuple(int, int)]: maps document id to the (start, length) of its span
+        self._spans = {}
+
+        # int: number of entries in the spans of removed documents
+        self._dead = 0
+
+    @classmethod
+    def from_counters(cls, entity_vectors):
+        """ Builds the arrays from a mapping of document id to entity Counter. """
+        vectors = cls()
+        for id, entity_vector in entity_vectors.items():
+            vectors[id] = entity_vector
+        return vectors
+
+    def _intern(self, entity):
+        id = self._ids.get(entity)
+        if id is None:
+            id = self._ids[entity] = len(self._names)
+            self._names.append(entity)
+        return id
+
+    def __setitem__(self, id, entity_vector):
+        if id in self._spans:
+            del self[id]
+        length = len(entity_vector)
+        if self._size + length > len(self._entities):
+            capacity = max(2 * len(self._entities), self._size + length)
+            self._entities = np.concatenate([self._entities[:self._size],
+                                             np.zeros(capacity - self._size, dtype=np.int32)])
+            self._counts = np.concatenate([self._counts[:self._size],
+                                           np.zeros(capacity - self._size, dtype=np.int32)])
+        start = self._size
+        self._entities[start:start + length] = [self._intern(entity) for entity in entity_vector]
+        self._counts[start:start + length] = list(entity_vector.values())
+        self._size += length
+        self._spans[id] = (start, length)
+
+    def __getitem__(self, id):
+        start, length = self._spans[id]
+        names = self._names
+        return Counter(dict(zip([names[entity] for entity in self._entities[start:start + length].tolist()],
+                                self._counts[start:start + length].tolist())))
+
+    def __delitem__(self, id):
+        start, length = self._spans.pop(id)
+        self._dead += length
+        if self._dead > 1024 and self._dead > self._size - self._dead:
+            self._compact()
+
+    def __contains__(self, id):
+        return id in self._spans
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def _compact(self):
+        """ Moves the live spans to the front of the arrays and drops unused entity ids. """
+        starts, lengths = self._span_arrays(list(self._spans))
+        positions = self._positions(starts, lengths)
+        entities, counts = self._entities[positions], self._counts[positions]
+
+        alive = np.unique(entities)
+        new_ids = np.zeros(len(self._names), dtype=np.int32)
+        new_ids[alive] = np.arange(len(alive), dtype=np.int32)
+        self._names = [self._names[entity] for entity in alive.tolist()]
+        self._ids = {name: entity for entity, name in enumerate(self._names)}
+
+        self._entities = new_ids[entities]
+        self._counts = counts
+        self._size = len(entities)
+        new_starts = (np.cumsum(lengths) - lengths).tolist()
+        self._spans = dict(zip(self._spans, zip(new_starts, lengths.tolist())))
+        self._dead = 0
+
+    def _span_arrays(self, ids):
+        spans = self._spans
+        starts = np.fromiter((spans[id][0] for id in ids), dtype=np.int64, count=len(ids))
+        lengths = np.fromiter((spans[id][1] for id in ids), dtype=np.int64, count=len(ids))
+        return starts, lengths
+
+    @staticmethod
+    def _positions(starts, lengths):
+        """ Returns the array positions covered by the given spans, span after span. """
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+
+    def most_common(self, ids, k=10, weights=None):
+        """
+        Sums the entity vectors of some documents and returns the k largest entries.
+
+        params:
+            ids [Iterable(str)]:
+                The document ids; a KeyError is raised for unknown ones.
+
+            k [int]:
+                Number of entities to return; None returns all of them.
+
+            weights [Iterable(float)]:
+                A weight per document (e.g. its query score) multiplying its counts;
+                None sums the plain counts.
+
+        returns:
+            List[tuple(str, number)]: (entity, total) pairs, largest first; ties in order
+            of first appearance, as in Counter.most_common over the summed Counters.
+        """
+        ids = list(ids)
+        for id in ids:
+            if id not in self._spans:
+                raise KeyError("document with id [" + id + "] not found in index.")
+        starts, lengths = self._span_arrays(ids)
+        positions = self._positions(starts, lengths)
+        if not len(positions):
+            return []
+
+        entities = self._entities[positions]
+        values = self._counts[positions]
+        if weights is not None:
+            values = values * np.repeat(np.asarray(list(weights), dtype=np.float64), lengths)
+
+        # one total per distinct entity, remembering where each first appeared
+        distinct, first, inverse = np.unique(entities, return_index=True, return_inverse=True)
+        totals = np.bincount(inverse, weights=values, minlength=len(distinct))
+        if weights is None:
+            totals = totals.astype(np.int64)
+
+        if k is not None and k < len(totals):
+            # keep everything tied with the k-th largest, so ties are broken by appearance
+            kth = np.partition(totals, len(totals) - k)[len(totals) - k]
+            top = totals >= kth
+            distinct, first, totals = distinct[top], first[top], totals[top]
+        order = np.lexsort((first, -totals))[:k]
+        names = self._names
+        return [(names[entity], total) for entity, total in zip(distinct[order].tolist(), totals[order].tolist())]
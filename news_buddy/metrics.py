@@ -0,0 +1,238 @@
+""" Opt-in instrumentation: latency histograms, counters and gauges.
+
+    Instrumented code reports to the module-level registry through inc(), observe()
+    and timer(); every call first checks `enabled`, so while metrics are disabled (the
+    default) the hot paths pay one attribute lookup and nothing is recorded.
+
+        from news_buddy import metrics
+        metrics.enable()
+        ...
+        metrics.snapshot()      # nested dict
+        metrics.prometheus()    # Prometheus text exposition format
+
+    Metrics are identified by a name plus optional labels (e.g. stage="tokenize").
+    Gauges are functions evaluated when a snapshot is taken, e.g. the memory used by
+    the structures of a search engine (see MySearchEngine.memory_usage). Metrics are
+    recorded per process: work done in process pools is reported by the parent from
+    the timings the workers send back.
+"""
+from bisect import bisect_left
+import functools
+import threading
+import time
+
+__all__ = ["enable", "disable", "reset", "inc", "observe", "timer", "timed", "add_gauges", "describe",
+           "snapshot", "prometheus", "LATENCY_BUCKETS"]
+
+# upper bounds (seconds) of the latency histogram buckets; a last +Inf bucket is implied
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# bool: whether anything is recorded
+enabled = False
+
+_lock = threading.Lock()
+
+# Dict[tuple(str, tuple), float]: counter value per (name, labels)
+_counters = {}
+
+# Dict[tuple(str, tuple), list]: per (name, labels) the count in each bucket (cumulative
+# only when exported), followed by the sum and number of observations
+_histograms = {}
+
+# Dict[str, function]: gauge groups; each function returns {gauge name: value}
+_gauges = {}
+
+# help text per metric name, for prometheus()
+_help = {}
+
+
+def enable():
+    """ Starts recording metrics. """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """ Stops recording metrics; what was recorded is kept until reset(). """
+    global enabled
+    enabled = False
+
+
+def reset():
+    """ Forgets every recorded counter and histogram (gauges stay registered). """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items())) if labels else ()
+
+
+def inc(name, value=1, **labels):
+    """ Adds value to a counter. """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """ Records a latency (or any value) in a histogram. """
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0, 0]
+        histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+
+class _Timer():
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name, **labels):
+    """ Returns a context manager recording the time spent in its block in a histogram. """
+    if not enabled:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def timed(name, **labels):
+    """ Decorator recording the latency of every call of a function in a histogram. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Timer(name, labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_gauges(group, function):
+    """ Registers (or replaces) a gauge group: function() returns {gauge name: value} and
+        is evaluated on every snapshot. Pass None to unregister the group.
+    """
+    with _lock:
+        if function is None:
+            _gauges.pop(group, None)
+        else:
+            _gauges[group] = function
+
+
+def describe(name, text):
+    """ Sets the help text exported for a metric. """
+    _help[name] = text
+
+
+def _label_string(labels):
+    return ",".join(key + "=" + str(value) for key, value in labels)
+
+
+def snapshot():
+    """
+    Returns every metric as a dict:
+
+        {"counters":   {name: {labels: value}},
+         "histograms": {name: {labels: {"count", "sum", "mean", "buckets": {le: cumulative count}}}},
+         "gauges":     {group: {name: value}}}
+
+    where labels is a "key=value,..." string ("" without labels).
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(histogram) for key, histogram in _histograms.items()}
+        gauges = dict(_gauges)
+
+    result = {"counters": {}, "histograms": {}, "gauges": {}}
+    for (name, labels), value in sorted(counters.items()):
+        result["counters"].setdefault(name, {})[_label_string(labels)] = value
+    for (name, labels), histogram in sorted(histograms.items()):
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), histogram):
+            cumulative += count
+            buckets[bound] = cumulative
+        count, total = histogram[-1], histogram[-2]
+        result["histograms"].setdefault(name, {})[_label_string(labels)] = {
+            "count": count, "sum": total, "mean": total / count if count else 0.0, "buckets": buckets}
+    for group, function in gauges.items():
+        result["gauges"][group] = dict(function())
+    return result
+
+
+def _prometheus_labels(labels, extra=()):
+    pairs = [(key, str(value)) for key, value in labels] + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(key + '="' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for key, value in pairs) + "}"
+
+
+def prometheus(prefix="news_buddy_"):
+    """ Returns every metric in the Prometheus text exposition format. """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: list(histogram) for key, histogram in _histograms.items()}
+        gauges = dict(_gauges)
+
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            if name in _help:
+                lines.append("# HELP " + prefix + name + " " + _help[name])
+            lines.append("# TYPE " + prefix + name + " " + kind)
+
+    for (name, labels), value in sorted(counters.items()):
+        header(name, "counter")
+        lines.append(prefix + name + _prometheus_labels(labels) + " " + repr(float(value)))
+    for (name, labels), histogram in sorted(histograms.items()):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), histogram):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(prefix + name + "_bucket" + _prometheus_labels(labels, [("le", le)]) + " " + str(cumulative))
+        lines.append(prefix + name + "_sum" + _prometheus_labels(labels) + " " + repr(histogram[-2]))
+        lines.append(prefix + name + "_count" + _prometheus_labels(labels) + " " + str(histogram[-1]))
+    for group, function in sorted(gauges.items()):
+        for name, value in sorted(function().items()):
+            full_name = group + "_" + name
+            header(full_name, "gauge")
+            lines.append(prefix + full_name + " " + repr(float(value)))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,363 @@
+""" Streaming ingestion from rss feeds into a search engine.
+
+    Articles flow through five stages connected by bounded queues:
+
+        parse      feed url -> entries not indexed yet (link, publication time)
+        fetch      entry -> downloaded page
+        extract    page -> article text (justext)
+        annotate   text -> tokens and entities (the NLP pipeline)
+        index      annotated article -> search engine
+
+    Each stage runs its own worker threads. A worker blocks when the queue after its
+    stage is full, so a slow stage (typically annotate) throttles the stages before
+    it instead of the pipeline buffering every article in memory.
+"""
+from collections import deque
+from urllib.parse import urlsplit
+from ._lazy import lazy_import
+from . import metrics
+from .SearchEngine import _record_annotation, annotate_text
+from .collect_rss import _fetch_with_retries, entry_timestamp, extract_text, make_session
+import queue
+import threading
+import time
+
+concurrent_futures = lazy_import("concurrent.futures")
+feedparser = lazy_import("feedparser")
+
+__all__ = ["IngestionPipeline", "STAGES"]
+
+# the stages, in order
+STAGES = ("parse", "fetch", "extract", "annotate", "index")
+
+# default number of worker threads per stage; index always has one, the only writer
+DEFAULT_WORKERS = {"parse": 2, "fetch": 8, "extract": 2, "annotate": 1, "index": 1}
+
+# marks the end of a stage's input
+_DONE = object()
+
+
+class StageStats():
+    """ Throughput and error counters of one pipeline stage. """
+
+    def __init__(self, name, max_errors=100):
+        self.name = name
+        self.received = 0
+        self.emitted = 0
+        self.errors = 0
+
+        # int: items deliberately left out, e.g. near-duplicates the index stage dropped
+        self.dropped = 0
+
+        # float: seconds workers spent processing items, and blocked on a full output queue
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+        # deque[tuple(object, Exception)]: the most recent failed items
+        self.recent_errors = deque(maxlen=max_errors)
+
+        self._lock = threading.Lock()
+
+    def as_dict(self, elapsed):
+        with self._lock:
+            return {"received": self.received,
+                    "emitted": self.emitted,
+                    "errors": self.errors,
+                    "dropped": self.dropped,
+                    "per_second": self.emitted / elapsed if elapsed > 0 else 0.0,
+                    "busy_seconds": self.busy_seconds,
+                    "blocked_seconds": self.blocked_seconds}
+
+
+class _Stage():
+    """ A function run over a queue of items by worker threads, feeding the next stage's queue. """
+
+    def __init__(self, name, function, workers, inbox, max_errors):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.inbox = inbox
+        self.next = None
+        self.stats = StageStats(name, max_errors)
+        self._finished = 0
+        self._finished_lock = threading.Lock()
+
+    def work(self):
+        stats = self.stats
+        while True:
+            item = self.inbox.get()
+            if item is _DONE:
+                break
+            with stats._lock:
+                stats.received += 1
+
+            start = time.perf_counter()
+            try:
+                # stages return a list of items for the next stage (possibly empty)
+                results = self.function(item)
+            except Exception as e:
+                with stats._lock:
+                    stats.errors += 1
+                    stats.busy_seconds += time.perf_counter() - start
+                    stats.recent_errors.append((item, e))
+                metrics.inc("pipeline_errors", stage=self.name)
+                continue
+            busy = time.perf_counter() - start
+            metrics.observe("pipeline_stage_seconds", busy, stage=self.name)
+
+            start = time.perf_counter()
+            for result in results:
+                if self.next is not None:
+                    self.next.inbox.put(result)
+            with stats._lock:
+                stats.emitted += len(results)
+                stats.busy_seconds += busy
+                stats.blocked_seconds += time.perf_counter() - start
+
+        # the last worker to finish tells every worker of the next stage
+        with self._finished_lock:
+            self._finished += 1
+            last = self._finished == self.workers
+        if last and self.next is not None:
+            for _ in range(self.next.workers):
+                self.next.inbox.put(_DONE)
+
+
+class IngestionPipeline():
+    """
+    Streams the articles of rss feeds into a search engine through bounded queues;
+    see the module docstring for the stages.
+
+    params:
+        search_engine[MySearchEngine]:
+            The search engine to add articles to.
+
+        workers[dict(str, int)]:
+            Number of worker threads per stage (see STAGES), overriding DEFAULT_WORKERS.
+            The index stage always has a single worker.
+
+        queue_size[int]:
+            Capacity of the queue in front of every stage but the first.
+
+        processes[int]:
+            If given, the annotate stage runs the NLP pipeline in a pool of this many
+            processes (and gets as many worker threads), since it is CPU bound.
+
+        per_host[int], timeout[float], retries[int], backoff[float]:
+            Passed on to the fetch stage, as in collect_rss.fetch_texts.
+
+        max_errors[int]:
+            Number of failed items each stage keeps in its recent_errors.
+
+        cache[article_cache.ArticleCache]:
+            If given, downloaded pages, extracted texts and annotations are stored in
+            it, and the extract and annotate stages reuse what it already holds.
+
+    Counters are available from stats() while the pipeline runs and after it ends.
+    """
+
+    def __init__(self, search_engine, workers=None, queue_size=64, processes=None,
+                 per_host=4, timeout=10, retries=2, backoff=0.5, max_errors=100, cache=None):
+        self.search_engine = search_engine
+        self.workers = dict(DEFAULT_WORKERS)
+        self.workers.update(workers or {})
+        if processes:
+            self.workers["annotate"] = processes
+        self.workers["index"] = 1
+        for name in STAGES:
+            if self.workers[name] < 1:
+                raise ValueError("stage [" + name + "] needs at least one worker.")
+
+        self.queue_size = queue_size
+        self.processes = processes
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.cache = cache
+
+        self._stages = None
+        self._threads = []
+        self._started = None
+        self._finished = None
+
+    # ------------------------------------------------------------------------
+    #  stages
+    # ------------------------------------------------------------------------
+
+    def _parse(self, url):
+        with metrics.timer("feed_parse_seconds"):
+            d = feedparser.parse(url)
+        # feedparser reports unreachable or malformed feeds instead of raising
+        if d.get("bozo") and not d["entries"]:
+            raise d["bozo_exception"]
+        entries = []
+        for entry in d["entries"]:
+            link = entry.get("link")
+            if link is None:
+                continue
+            # skip articles already indexed or queued from another feed
+            with self._seen_lock:
+                if link in self._seen:
+                    continue
+                self._seen.add(link)
+            if link in self.search_engine.raw_text:
+                continue
+            # ... or dropped as a near-duplicate of an indexed one
+            dedup = self.search_engine.dedup
+            if dedup is not None and link in dedup:
+                continue
+            entries.append((link, entry_timestamp(entry)))
+        return entries
+
+    def _fetch(self, entry):
+        link, timestamp = entry
+        host = urlsplit(link).netloc
+        with self._host_slots_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            slot = self._host_slots[host]
+        with slot:
+            response = _fetch_with_retries(link, self._session, self.timeout, self.retries, self.backoff)
+        response.raise_for_status()
+        return [(link, timestamp, response.content)]
+
+    def _extract(self, page):
+        link, timestamp, content = page
+        if self.cache is not None:
+            return [(link, timestamp, self.cache.extract(link, content, extract_text, timestamp))]
+        return [(link, timestamp, extract_text(content))]
+
+    def _annotate(self, article):
+        link, timestamp, text = article
+        if self.search_engine.overrides_annotation():
+            return [(link, timestamp, text) + self.search_engine.annotate(text)]
+        tokenizer = self.search_engine.tokenizer
+        if self.cache is not None:
+            cached = self.cache.annotations(text, tokenizer)
+            if cached is not None:
+                return [(link, timestamp, text) + cached]
+        if self._pool is None:
+            tokens, entities, timings = annotate_text(text, tokenizer)
+        else:
+            tokens, entities, timings = self._pool.submit(annotate_text, text, tokenizer).result()
+        _record_annotation(timings)
+        if self.cache is not None:
+            self.cache.put_annotations(text, tokenizer, tokens, entities)
+        return [(link, timestamp, text, tokens, entities)]
+
+    def _index(self, article):
+        link, timestamp, text, tokens, entities = article
+        original = self.search_engine.add_annotated(link, text, tokens, entities, timestamp)
+        if original is not None:
+            # a near-duplicate of an indexed article, left out by the engine's dedup detector
+            stats = self._stages[-1].stats
+            with stats._lock:
+                stats.dropped += 1
+            return []
+        return [link]
+
+    # ------------------------------------------------------------------------
+    #  running
+    # ------------------------------------------------------------------------
+
+    def start(self, feeds):
+        """ Starts streaming the articles of the given feed urls (any iterable, consumed
+            lazily) into the search engine and returns right away; see join(). If
+            iterating feeds raises, the urls it gave so far are still ingested and the
+            exception is counted as an error of the parse stage.
+        """
+        if self._threads:
+            raise RuntimeError("pipeline is already running.")
+
+        self._seen = set()
+        self._seen_lock = threading.Lock()
+        self._host_slots = {}
+        self._host_slots_lock = threading.Lock()
+        self._session = make_session(pool_size=self.workers["fetch"])
+        self._pool = None
+        if self.processes:
+            self._pool = concurrent_futures.ProcessPoolExecutor(max_workers=self.processes)
+
+        functions = {"parse": self._parse, "fetch": self._fetch, "extract": self._extract,
+                     "annotate": self._annotate, "index": self._index}
+        self._stages = []
+        for name in STAGES:
+            # the feeds queue only holds urls, so it is bounded by the stage after it
+            inbox = queue.Queue(maxsize=self.queue_size if self._stages else self.workers[name])
+            stage = _Stage(name, functions[name], self.workers[name], inbox, self.max_errors)
+            if self._stages:
+                self._stages[-1].next = stage
+            self._stages.append(stage)
+
+        self._started = time.perf_counter()
+        self._finished = None
+        for stage in self._stages:
+            for i in range(stage.workers):
+                thread = threading.Thread(target=stage.work, name="news_buddy-" + stage.name + "-" + str(i),
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        def feed():
+            first = self._stages[0]
+            try:
+                for url in feeds:
+                    first.inbox.put(url)
+            except Exception as e:
+                # a failing iterable ends the input; the urls it gave so far still go through
+                with first.stats._lock:
+                    first.stats.errors += 1
+                    first.stats.recent_errors.append((feeds, e))
+                metrics.inc("pipeline_errors", stage=first.name)
+            finally:
+                for _ in range(first.workers):
+                    first.inbox.put(_DONE)
+
+        feeder = threading.Thread(target=feed, name="news_buddy-feeds", daemon=True)
+        feeder.start()
+        self._threads.append(feeder)
+
+    def join(self):
+        """ Waits until every article has gone through the pipeline; returns stats(). """
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._finished = time.perf_counter()
+        self._session.close()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        return self.stats()
+
+    def run(self, feeds):
+        """ Streams the articles of the given feed urls into the search engine and
+            waits for them; returns stats().
+        """
+        self.start(feeds)
+        return self.join()
+
+    def stats(self):
+        """
+        Returns the counters of every stage, as {stage: counters}: "received" and
+        "emitted" items, "errors", items "dropped" (near-duplicates the index stage
+        left out), "per_second" (items emitted per second of wall
+        time), "busy_seconds" spent working and "blocked_seconds" spent waiting for
+        room in the next queue, plus the number of items "queued" in front of the stage.
+        """
+        if self._stages is None:
+            return {}
+        end = time.perf_counter() if self._finished is None else self._finished
+        elapsed = end - self._started
+        stats = {}
+        for stage in self._stages:
+            stats[stage.name] = stage.stats.as_dict(elapsed)
+            stats[stage.name]["queued"] = stage.inbox.qsize()
+        return stats
+
+    def errors(self):
+        """ Returns {stage: [(item, exception), ...]} of the most recent failures. """
+        if self._stages is None:
+            return {}
+        return {stage.name: list(stage.stats.recent_errors) for stage in self._stages}
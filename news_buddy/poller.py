@@ -0,0 +1,186 @@
+from ._lazy import lazy_import
+from .collect_rss import entry_timestamp, fetch_texts
+import json
+import os
+import time
+
+feedparser = lazy_import("feedparser")
+
+__all__ = ["FeedPoller"]
+
+
+class FeedPoller():
+    """
+    Polls many RSS feeds on a schedule and adds their new articles to a search engine.
+
+    Feeds are fetched with conditional requests: the ETag and Last-Modified values of
+    the previous response are sent back, so an unchanged feed costs a single
+    "304 Not Modified" round trip. Entries whose link is already indexed are skipped
+    before any article is downloaded.
+
+    params:
+        feeds[Iterable(str)]:
+            The urls of the rss feeds to poll.
+
+        search_engine[MySearchEngine]:
+            The search engine to add articles to.
+
+        interval[float]:
+            Default number of seconds between two polls of the same feed.
+
+        workers[int]:
+            Number of threads downloading articles and of processes running the NLP
+            pipeline over them.
+
+        state_path[str]:
+            Optional JSON file in which per-feed ETag/Last-Modified values are kept
+            across restarts.
+
+        retention[float]:
+            If given, articles older than this many seconds are removed from the search
+            engine after every round of polls, keeping a rolling window of news; entries
+            published before the window aren't downloaded at all.
+
+    Articles are added with the publication time given by the feed, if any.
+    """
+
+    def __init__(self, feeds, search_engine, interval=900, workers=1, state_path=None, retention=None):
+        self.search_engine = search_engine
+        self.interval = interval
+        self.workers = workers
+        self.state_path = state_path
+        self.retention = retention
+
+        # Dict[str, dict]: maps feed url to its polling state:
+        # "etag", "modified", "interval" and "last_polled" (a time.time() value)
+        self.feeds = {}
+
+        saved = {}
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path) as f:
+                saved = json.load(f)
+
+        for url in feeds:
+            if url in saved:
+                self.feeds[url] = saved[url]
+            else:
+                self.add_feed(url)
+
+    def add_feed(self, url, interval=None):
+        """ Starts polling a feed, every `interval` seconds (default: self.interval). """
+        self.feeds[url] = {"etag": None, "modified": None, "last_polled": None, "interval": interval}
+
+    def remove_feed(self, url):
+        """ Stops polling a feed. """
+        del self.feeds[url]
+
+    def is_due(self, url, now=None):
+        """ Returns True if the feed hasn't been polled within its interval. """
+        state = self.feeds[url]
+        if state["last_polled"] is None:
+            return True
+        interval = self.interval if state["interval"] is None else state["interval"]
+        now = time.time() if now is None else now
+        return now - state["last_polled"] >= interval
+
+    def poll(self, url):
+        """
+        Polls a single feed and adds its new articles to the search engine.
+
+        returns:
+            added[list(str)]:
+                Links of the articles that were added.
+        """
+        state = self.feeds[url]
+        d = feedparser.parse(url, etag=state["etag"], modified=state["modified"])
+        state["last_polled"] = time.time()
+
+        # unchanged since the last poll
+        if d.get("status") == 304:
+            return []
+
+        state["etag"] = d.get("etag")
+        state["modified"] = d.get("modified")
+
+        # skip articles we already have (or would expire right away) before downloading them
+        oldest = None if self.retention is None else state["last_polled"] - self.retention
+        dedup = self.search_engine.dedup
+        links = []
+        timestamps = {}
+        for entry in d["entries"]:
+            link = entry.get("link")
+            if link is None or link in self.search_engine.raw_text or link in timestamps:
+                continue
+            # near-duplicates of indexed articles were dropped; don't download them again
+            if dedup is not None and link in dedup:
+                continue
+            timestamp = entry_timestamp(entry)
+            if timestamp is not None and oldest is not None and timestamp < oldest:
+                continue
+            links.append(link)
+            timestamps[link] = timestamp
+        if not links:
+            return []
+
+        texts, errors = fetch_texts(links, workers=self.workers)
+        timestamps = {link: timestamp for link, timestamp in timestamps.items() if timestamp is not None}
+        self.search_engine.add_many(texts, workers=self.workers, timestamps=timestamps)
+        # near-duplicates the search engine's dedup detector dropped weren't added
+        return [link for link in texts if link in self.search_engine.raw_text]
+
+    def poll_due(self):
+        """
+        Polls every feed that is due, then expires articles older than the retention.
+
+        returns:
+            added[dict(str, list(str))]:
+                Maps each polled feed url to the links of the articles added from it.
+        """
+        added = {}
+        now = time.time()
+        for url in list(self.feeds):
+            if self.is_due(url, now):
+                added[url] = self.poll(url)
+        if self.retention is not None:
+            self.search_engine.expire(self.retention)
+        self.save_state()
+        return added
+
+    def seconds_until_due(self):
+        """ Returns how long until the next feed is due (0 if one is due already). """
+        now = time.time()
+        waits = []
+        for url, state in self.feeds.items():
+            if state["last_polled"] is None:
+                return 0.0
+            interval = self.interval if state["interval"] is None else state["interval"]
+            waits.append(state["last_polled"] + interval - now)
+        return max(0.0, min(waits)) if waits else self.interval
+
+    def run(self, iterations=None, print_status=True):
+        """
+        Polls feeds as they become due, sleeping in between.
+
+        params:
+            iterations[int]:
+                Number of polling rounds to run; forever if None.
+
+            print_status[bool]:
+                Whether to print how many articles each poll added.
+        """
+        rounds = 0
+        while iterations is None or rounds < iterations:
+            time.sleep(self.seconds_until_due())
+            for url, links in self.poll_due().items():
+                if print_status:
+                    print("Added " + str(len(links)) + " articles. Source: " + url)
+            rounds += 1
+
+    def save_state(self):
+        """ Writes per-feed polling state to state_path, if one was given. """
+        if self.state_path is None:
+            return
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.feeds, f)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,223 @@
+from array import array
+from bisect import bisect_left
+from ._lazy import lazy_import
+
+np = lazy_import("numpy")
+
+__all__ = ["Postings", "Positions", "intersect", "encode_deltas", "decode_deltas"]
+
+
+class Postings():
+    """ Postings list of a single term: sorted integer document numbers with the
+        term frequency of each, stored in two parallel array('I').
+
+        docs and tfs may also be read-only uint32 memoryviews (e.g. into a memory
+        mapped index file); they are copied into arrays on the first modification.
+
+        Pickled postings are delta + varint encoded, which typically shrinks the
+        document numbers to one or two bytes each.
+    """
+    __slots__ = ("docs", "tfs")
+
+    def __init__(self, docs=None, tfs=None):
+        # array('I'): document numbers in increasing order
+        self.docs = array("I") if docs is None else docs
+
+        # array('I'): term frequency in the document at the same position
+        self.tfs = array("I") if tfs is None else tfs
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __iter__(self):
+        return iter(self.docs)
+
+    def __contains__(self, doc):
+        i = bisect_left(self.docs, doc)
+        return i < len(self.docs) and self.docs[i] == doc
+
+    def append(self, doc, tf):
+        """ Adds a document numbered higher than every document already in the list. """
+        if len(self.docs) and doc <= self.docs[-1]:
+            raise ValueError("document numbers must be appended in increasing order.")
+        self._make_writable()
+        self.docs.append(doc)
+        self.tfs.append(tf)
+
+    def remove(self, doc):
+        """ Removes a document from the list. """
+        i = bisect_left(self.docs, doc)
+        if i == len(self.docs) or self.docs[i] != doc:
+            raise KeyError(doc)
+        self._make_writable()
+        del self.docs[i]
+        del self.tfs[i]
+
+    def _make_writable(self):
+        if not isinstance(self.docs, array):
+            docs, tfs = array("I"), array("I")
+            docs.frombytes(self.docs.tobytes())
+            tfs.frombytes(self.tfs.tobytes())
+            self.docs, self.tfs = docs, tfs
+
+    def renumber(self, numbers):
+        """ Replaces every document number d by numbers[d]; numbers must preserve their order. """
+        self._make_writable()
+        self.docs = array("I", [numbers[doc] for doc in self.docs])
+
+    def index(self, doc):
+        """ Returns the position of a document in the list; raises KeyError if it isn't in it. """
+        i = bisect_left(self.docs, doc)
+        if i == len(self.docs) or self.docs[i] != doc:
+            raise KeyError(doc)
+        return i
+
+    def tf(self, doc):
+        """ Returns the term frequency in a document, or 0 if it isn't in the list. """
+        i = bisect_left(self.docs, doc)
+        if i < len(self.docs) and self.docs[i] == doc:
+            return self.tfs[i]
+        return 0
+
+    def items(self, first_doc=0):
+        """ Returns an iterator of (doc, tf) pairs, starting at the first doc >= first_doc. """
+        if first_doc <= 0:
+            return zip(self.docs, self.tfs)
+        i = bisect_left(self.docs, first_doc)
+        return zip(self.docs[i:], self.tfs[i:])
+
+    def __getstate__(self):
+        return encode_deltas(self.docs), encode_varints(self.tfs)
+
+    def __setstate__(self, state):
+        docs, tfs = state
+        self.docs = decode_deltas(docs)
+        self.tfs = decode_varints(tfs)
+
+
+class Positions():
+    """ Token positions of a single term, parallel to its Postings: entry i holds the
+        positions of the term in the i-th document of the postings list, delta + varint
+        encoded (see encode_deltas), back to back in one byte string.
+
+        offsets and data may also be read-only memoryviews into a memory mapped index
+        file, with offsets pointing into a data buffer shared by all terms; they are
+        copied on the first modification.
+    """
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets=None, data=None):
+        # array('Q'): start of each entry in data, plus the end of the last one
+        self.offsets = array("Q", [0]) if offsets is None else offsets
+
+        # bytearray: the encoded entries
+        self.data = bytearray() if data is None else data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, positions):
+        """ Adds the (increasing) positions of the term in the next document of the postings. """
+        self._make_writable()
+        self.data += encode_deltas(positions)
+        self.offsets.append(len(self.data))
+
+    def remove(self, i):
+        """ Removes entry i, e.g. after removing the i-th document from the postings. """
+        self._make_writable()
+        start, end = self.offsets[i], self.offsets[i + 1]
+        del self.data[start:end]
+        # shift the later entries' offsets in place, in one vectorized pass
+        if i + 2 < len(self.offsets):
+            np.frombuffer(self.offsets, dtype=np.uint64)[i + 2:] -= end - start
+        del self.offsets[i + 1]
+
+    def get(self, i):
+        """ Returns the positions of entry i as an array('I'). """
+        return decode_deltas(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def _make_writable(self):
+        if not isinstance(self.offsets, array):
+            base = self.offsets[0]
+            self.data = bytearray(self.data[base:self.offsets[-1]])
+            self.offsets = array("Q", (offset - base for offset in self.offsets))
+
+    def __getstate__(self):
+        self._make_writable()
+        return bytes(self.data), encode_varints(end - start for start, end in zip(self.offsets, self.offsets[1:]))
+
+    def __setstate__(self, state):
+        data, lengths = state
+        self.data = bytearray(data)
+        self.offsets = array("Q", [0])
+        for length in decode_varints(lengths):
+            self.offsets.append(self.offsets[-1] + length)
+
+
+def intersect(small, large):
+    """ Returns the sorted doc numbers found in both sorted sequences, galloping through
+        `large` so the cost is O(len(small) * log(len(large) / len(small))).
+    """
+    result = array("I")
+    lo = 0
+    n = len(large)
+    for doc in small:
+        # exponential search for an upper bound, then binary search inside it
+        step = 1
+        hi = lo
+        while hi < n and large[hi] < doc:
+            lo = hi + 1
+            hi += step
+            step *= 2
+        lo = bisect_left(large, doc, lo, min(hi, n))
+        if lo == n:
+            break
+        if large[lo] == doc:
+            result.append(doc)
+            lo += 1
+    return result
+
+
+def encode_varints(values):
+    """ Encodes non-negative integers as LEB128 varints. """
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varints(data):
+    """ Decodes LEB128 varints into an array('I'). """
+    values = array("I")
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_deltas(docs):
+    """ Encodes sorted doc numbers as varint gaps between consecutive entries. """
+    previous = 0
+    gaps = []
+    for doc in docs:
+        gaps.append(doc - previous)
+        previous = doc
+    return encode_varints(gaps)
+
+
+def decode_deltas(data):
+    """ Inverse of encode_deltas(). """
+    docs = decode_varints(data)
+    total = 0
+    for i in range(len(docs)):
+        total += docs[i]
+        docs[i] = total
+    return docs
@@ -0,0 +1,401 @@
+""" Answering queries while the index is being updated.
+
+    MySearchEngine isn't synchronized: a query running while documents are added can
+    see half updated postings, norms and statistics, so sharing one engine (such as
+    the module-level `mse`) between a feed poller and the code answering users means
+    serializing everything. A SearchService separates readers from the writer:
+
+        writer      a single thread owns a mutable engine and applies every update
+                    (add, remove, update_via_rss_feed, ...) in turn
+        publish     the writer saves its engine as the next generation of an on-disk
+                    index (storage.save_index) and opens that generation as a snapshot
+        readers     each request takes the current snapshot once and runs entirely
+                    against it; publishing swaps in the next snapshot with a single
+                    assignment, so readers never wait for a lock or for the writer
+
+    Snapshots are opened with storage.load_index(), so their structures are read-only
+    memory mapped views of the generation's files: worker processes opening the same
+    generation share its pages. After publishing, the writer continues from the same
+    generation, copying only the postings it then changes. Earlier generations stay
+    on disk for a while (keep_generations) for requests still running against them.
+
+    Publishing costs O(index): only new texts are appended to the document store, but
+    the postings, forward index and statistics of a generation are written whole. So
+    updates are published in batches rather than one by one: at most every
+    publish_interval seconds, and never more often than PUBLISH_COST_RATIO times the
+    duration of the last publication, so that the writer spends a bounded share of
+    its time publishing as the index grows. publish_writes bounds how many updates
+    readers may miss while the writer never runs out of them.
+"""
+from ._lazy import lazy_import
+from . import metrics
+from .SearchEngine import MySearchEngine
+from .pipeline import IngestionPipeline
+from .storage import _current_generation, load_index, save_index
+import importlib
+import os
+import queue
+import threading
+import time
+
+concurrent_futures = lazy_import("concurrent.futures")
+
+__all__ = ["SearchService", "open_snapshot"]
+
+# structures every query needs, loaded before a snapshot is handed to readers
+_WARM_ATTRIBUTES = ("inverted_index", "positional_index", "doc_freq", "_doc_names", "_doc_numbers",
+                    "_doc_norms", "_term_max_ratio", "timestamps", "_time_buckets")
+
+# read operations that are news_buddy API functions rather than engine methods
+_API_FUNCTIONS = ("new_with", "most_associated_with_entity", "most_associated_with_phrase")
+
+# marks the end of the writer's queue
+_STOP = object()
+
+# automatic publications are at least this many times the last one's duration apart
+PUBLISH_COST_RATIO = 4
+
+# (path, generation, engine) of the snapshot opened in this worker process
+_worker_snapshot = None
+
+
+def open_snapshot(path, engine_class=MySearchEngine):
+    """ Opens the current generation of an index for reading (see storage.load_index)
+        and loads the structures every query needs, so the first queries against it
+        don't pay for that.
+
+        returns:
+            (generation, search_engine)[tuple]:
+                The generation's name and the read-only search engine.
+    """
+    generation = _current_generation(path)
+    engine = load_index(path, engine_class)
+    for name in _WARM_ATTRIBUTES:
+        getattr(engine, name)
+    # builds the term lookup table of the mapped postings
+    engine.inverted_index.get("")
+    return generation, engine
+
+
+def _read(engine, operation, args, kwargs):
+    if operation in _API_FUNCTIONS:
+        news_buddy = importlib.import_module(__package__)
+        return getattr(news_buddy, operation)(*args, search_engine=engine, **kwargs)
+    return getattr(engine, operation)(*args, **kwargs)
+
+
+def _read_in_worker(path, generation, operation, args, kwargs):
+    """ Runs a read operation in a worker process against its own snapshot, first
+        reopening the index if a newer generation than the one it holds was published.
+    """
+    global _worker_snapshot
+    if _worker_snapshot is None or _worker_snapshot[0] != path or _worker_snapshot[1] < generation:
+        _worker_snapshot = (path,) + open_snapshot(path)
+    return _read(_worker_snapshot[2], operation, args, kwargs)
+
+
+class SearchService():
+    """
+    Serves queries from immutable snapshots of an index while a single writer thread
+    updates it; see the module docstring. Use it in a with block or call close().
+
+    params:
+        path [String]:
+            Directory of the on-disk index the generations are published to.
+
+        search_engine [MySearchEngine]:
+            The engine the writer starts from; it is saved to path right away. If
+            None, the index already at path is opened, or else an empty engine is used.
+
+        processes [int]:
+            If given, read requests run in a pool of this many worker processes, each
+            holding its own snapshot, instead of in the calling threads.
+
+        publish_interval [float]:
+            Minimum seconds between automatic publications of the writer's changes,
+            which happen once the writer runs out of queued updates (see also
+            PUBLISH_COST_RATIO); None publishes only on publish().
+
+        publish_writes [int]:
+            Number of unpublished updates after which the writer publishes (once
+            publish_interval allows) even though more updates are queued; None waits
+            until the queue is empty.
+
+        keep_generations [int]:
+            Number of earlier generations left on disk for requests still reading them.
+    """
+
+    def __init__(self, path, search_engine=None, processes=None, publish_interval=1.0, publish_writes=1000,
+                 keep_generations=2):
+        self.path = os.path.abspath(path)
+        self.processes = processes
+        self.publish_interval = publish_interval
+        self.publish_writes = publish_writes
+        self.keep_generations = keep_generations
+
+        self.writes = 0
+        self.publications = 0
+        self.publish_seconds = 0.0
+
+        # Exception or None: the last failure of an automatic publication
+        self.last_error = None
+
+        self._changed = False
+        # number of updates applied since the last publication
+        self._unpublished = 0
+        self._last_published = time.monotonic()
+        self._last_publish_seconds = 0.0
+        self._writes = queue.Queue()
+
+        if search_engine is None and _current_generation(self.path) is None:
+            search_engine = MySearchEngine()
+        if search_engine is None:
+            self._engine = load_index(self.path)
+            # tuple(str, MySearchEngine): name and engine of the generation readers see
+            self._current = open_snapshot(self.path)
+        else:
+            self._engine = search_engine
+            self._publish()
+
+        self._pool = None
+        if processes:
+            self._pool = concurrent_futures.ProcessPoolExecutor(max_workers=processes)
+            # start the workers (opening their snapshots) before there is a writer thread to fork
+            warming = [self._pool.submit(_read_in_worker, self.path, self._current[0], "num_docs", (), {})
+                       for _ in range(processes)]
+            for future in warming:
+                future.result()
+
+        self._writer = threading.Thread(target=self._write_loop, name="news_buddy-writer", daemon=True)
+        self._writer.start()
+
+    # ------------------------------------------------------------------------
+    #  writing
+    # ------------------------------------------------------------------------
+
+    def _publish_due(self):
+        """ Returns the time.monotonic() at which the next automatic publication may
+            happen, or None if there is nothing to publish or it is left to publish().
+        """
+        if not self._changed or self.publish_interval is None:
+            return None
+        gap = max(self.publish_interval, PUBLISH_COST_RATIO * self._last_publish_seconds)
+        return self._last_published + gap
+
+    def _write_loop(self):
+        while True:
+            due = self._publish_due()
+            timeout = None if due is None else max(0.0, due - time.monotonic())
+            try:
+                task = self._writes.get(timeout=timeout)
+            except queue.Empty:
+                task = None
+
+            if task is None:
+                # nothing queued and the interval is over: publish what changed
+                try:
+                    self._publish()
+                except Exception as e:
+                    self.last_error = e
+                continue
+            if task is _STOP:
+                break
+
+            function, args, kwargs, future, changes = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(self._engine, *args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                if changes:
+                    self.writes += 1
+                    self._unpublished += 1
+                    self._changed = True
+            # keep applying queued updates so a burst of them is published once, unless
+            # so many are waiting to be published that readers shouldn't wait for the rest
+            due = self._publish_due()
+            backlog = self.publish_writes is not None and self._unpublished >= self.publish_writes
+            if due is not None and time.monotonic() >= due and (self._writes.empty() or backlog):
+                try:
+                    self._publish()
+                except Exception as e:
+                    self.last_error = e
+
+    def _publish(self):
+        """ Saves the writer's engine as the next generation and swaps in its snapshot;
+            runs on the writer thread (or before it starts).
+        """
+        start = time.perf_counter()
+        engine = self._engine
+        # readers never refresh statistics themselves, so snapshots must be current
+        if engine.stats_are_stale():
+            engine.refresh_stats()
+        save_index(engine, self.path, keep=self.keep_generations)
+        generation, snapshot = open_snapshot(self.path, type(engine))
+
+        # continue from the published generation, so later saves only append new texts;
+        # the settings are saved with it, but the count of changes cached results use isn't
+        self._engine = load_index(self.path, type(engine))
+        self._engine.generation = engine.generation
+        self._current = (generation, snapshot)
+        self._changed = False
+        self._unpublished = 0
+        self._last_published = time.monotonic()
+
+        seconds = time.perf_counter() - start
+        self._last_publish_seconds = seconds
+        self.publications += 1
+        self.publish_seconds += seconds
+        metrics.observe("publish_seconds", seconds)
+        metrics.inc("generations_published")
+        return generation
+
+    def submit(self, function, *args, changes=True, **kwargs):
+        """
+        Queues function(engine, *args, **kwargs) to run on the writer thread with the
+        writer's engine, after the updates queued before it.
+
+        params:
+            changes [bool]:
+                Whether function modifies the engine, so its changes are published.
+
+        returns:
+            future [concurrent.futures.Future]:
+                Resolves to what function returned once it ran.
+        """
+        if not self._writer.is_alive():
+            raise RuntimeError("search service is closed.")
+        future = concurrent_futures.Future()
+        self._writes.put((function, args, kwargs, future, changes))
+        return future
+
+    def add(self, id, text, timestamp=None):
+        """ Queues MySearchEngine.add; returns a Future. """
+        return self.submit(lambda engine: engine.add(id, text, timestamp))
+
+    def add_many(self, docs, workers=1, timestamps=None, cache=None):
+        """ Queues MySearchEngine.add_many; returns a Future. """
+        return self.submit(lambda engine: engine.add_many(docs, workers=workers, timestamps=timestamps, cache=cache))
+
+    def remove(self, id):
+        """ Queues MySearchEngine.remove; returns a Future. """
+        return self.submit(lambda engine: engine.remove(id))
+
+    def expire(self, max_age=None):
+        """ Queues MySearchEngine.expire; returns a Future. """
+        return self.submit(lambda engine: engine.expire(max_age))
+
+    def update_via_rss_feed(self, rss_url, workers=1, cache=None):
+        """ Queues ingesting the new articles of rss feed url(s), as news_buddy.update_via_rss_feed
+            does; returns a Future of the pipeline's stats.
+        """
+        if type(rss_url) == str:
+            rss_url = [rss_url]
+
+        def ingest(engine):
+            pipeline = IngestionPipeline(engine, workers={"fetch": workers},
+                                         processes=workers if workers > 1 else None, cache=cache)
+            return pipeline.run(rss_url)
+        return self.submit(ingest)
+
+    def poll(self, poller):
+        """ Queues polling the feeds of a FeedPoller that are due; returns a Future. """
+        def poll_due(engine):
+            poller.search_engine = engine
+            return poller.poll_due()
+        return self.submit(poll_due)
+
+    def publish(self):
+        """ Queues publishing the writer's changes, if any; returns a Future of the name of
+            the generation holding them, resolved once readers see it.
+        """
+        return self.submit(lambda engine: self._publish() if self._changed else self._current[0], changes=False)
+
+    # ------------------------------------------------------------------------
+    #  reading
+    # ------------------------------------------------------------------------
+
+    @property
+    def generation(self):
+        """ Name of the generation readers currently see. """
+        return self._current[0]
+
+    def snapshot(self):
+        """ Returns the search engine of the current generation; it must only be read. """
+        return self._current[1]
+
+    def read(self, operation, *args, **kwargs):
+        """ Runs a read-only engine method (e.g. "query", "get") or news_buddy API function
+            (e.g. "new_with") against the current snapshot, in a worker process if the
+            service has them, and returns its result.
+        """
+        generation, snapshot = self._current
+        if self._pool is not None:
+            return self._pool.submit(_read_in_worker, self.path, generation, operation, args, kwargs).result()
+        return _read(snapshot, operation, args, kwargs)
+
+    def query(self, q, k=10, mode="or", half_life=None, since=None, now=None, window=10):
+        """ MySearchEngine.query against the current snapshot. """
+        return self.read("query", q, k=k, mode=mode, half_life=half_life, since=since, now=now, window=window)
+
+    def get(self, id):
+        """ MySearchEngine.get against the current snapshot. """
+        return self.read("get", id)
+
+    def num_docs(self):
+        """ MySearchEngine.num_docs of the current snapshot. """
+        return self._current[1].num_docs()
+
+    def new_with(self, texts, trigger_token="Reuters", mode="and"):
+        """ news_buddy.new_with against the current snapshot. """
+        return self.read("new_with", texts, trigger_token=trigger_token, mode=mode)
+
+    def most_associated_with_entity(self, entity, num_entities=10, scoring="count"):
+        """ news_buddy.most_associated_with_entity against the current snapshot. """
+        return self.read("most_associated_with_entity", entity, num_entities=num_entities, scoring=scoring)
+
+    def most_associated_with_phrase(self, text, num_entities=10, num_docs=10, weighted=False):
+        """ news_buddy.most_associated_with_phrase against the current snapshot. """
+        return self.read("most_associated_with_phrase", text, num_entities=num_entities, num_docs=num_docs,
+                         weighted=weighted)
+
+    # ------------------------------------------------------------------------
+    #  lifecycle
+    # ------------------------------------------------------------------------
+
+    def stats(self):
+        """ Returns the current "generation", number of "writes" applied, "unpublished"
+            and "pending", "publications" and the mean seconds they took, and "docs"
+            readers see.
+        """
+        generation, snapshot = self._current
+        return {"generation": generation,
+                "writes": self.writes,
+                "unpublished": self._unpublished,
+                "pending": self._writes.qsize(),
+                "publications": self.publications,
+                "publish_seconds_mean": self.publish_seconds / self.publications if self.publications else 0.0,
+                "docs": snapshot.num_docs()}
+
+    def close(self, publish=True):
+        """ Applies the queued updates, publishes them unless publish is False, and stops
+            the writer and worker processes.
+        """
+        if self._writer.is_alive():
+            if publish:
+                self.publish()
+            self._writes.put(_STOP)
+            self._writer.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
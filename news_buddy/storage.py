@@ -0,0 +1,576 @@
+""" Versioned on-disk index format for MySearchEngine.
+
+    An index directory holds one or more generations plus an append-only document
+    store shared between them:
+
+        CURRENT                 name of the live generation, replaced atomically
+        documents-NNNNNN.bin    raw article texts (UTF-8), appended to by saves
+        gen-NNNNNN/
+            header.json         format name and version, byte order, counts, engine settings
+            terms.txt           vocabulary, one term per line (term id = line number)
+            terms.df            uint32 document frequency per term id
+            terms.offsets       uint64 start of each term's postings (num_terms + 1)
+            terms.maxratio      float64 score upper bound per term id
+            postings.docs       uint32 document numbers, grouped by term id
+            postings.tfs        uint32 term frequencies, parallel to postings.docs
+            postings.positions  varint encoded token positions per posting (positional indexes only)
+            postings.posoffsets uint64 start of each posting's positions (num_postings + 1)
+            docs.txt            document id per document number, empty if removed
+            docs.norms          float64 tf-idf norm per document number
+            docs.text           uint64 (offset, length) of each text in the document store
+            docs.time           float64 timestamp per document number, NaN if removed
+            forward.offsets     uint64 start of each document's terms (num_doc_numbers + 1)
+            forward.terms       uint32 term ids of each document
+            forward.tfs         uint32 term frequencies, parallel to forward.terms
+            entities.pkl        pickled entity vectors, coocurrences and dedup detector
+
+    load_index() only reads header.json and memory-maps the binary files; every
+    engine structure is materialized lazily on first use, postings term by term.
+"""
+from array import array
+from collections import Counter
+from collections.abc import MutableMapping
+from .cache import QueryCache
+from .entities import EntityCooccurrence, EntityVectors
+from .postings import Positions, Postings
+from .SearchEngine import MySearchEngine
+import json
+import math
+import mmap
+import os
+import pickle
+import shutil
+import sys
+
+__all__ = ["save_index", "load_index", "FORMAT_VERSION"]
+
+FORMAT_NAME = "news_buddy-index"
+
+# 2 added docs.time, the positional postings and the dedup detector in entities.pkl;
+# version 1 generations lack them and are still read (as undated, without positions)
+FORMAT_VERSION = 2
+_READABLE_VERSIONS = (1, 2)
+
+
+# ----------------------------------------------------------------------------
+#  memory mapped files
+# ----------------------------------------------------------------------------
+
+def _map_file(path, typecode):
+    """ Returns a read-only memoryview of the given typecode over a memory mapped file. """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(array(typecode))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)
+
+
+class _IndexFiles():
+    """ Lazily opened files of one generation, shared by the mapped structures. """
+
+    def __init__(self, directory, documents_path, header):
+        self.directory = directory
+        self.documents_path = documents_path
+        self.header = header
+        self._cache = {}
+
+    def array(self, name, typecode):
+        key = (name, typecode)
+        if key not in self._cache:
+            self._cache[key] = _map_file(os.path.join(self.directory, name), typecode)
+        return self._cache[key]
+
+    def lines(self, name, count):
+        if name not in self._cache:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                data = f.read()
+            self._cache[name] = data.split("\n") if count else []
+        return self._cache[name]
+
+    def terms(self):
+        return self.lines("terms.txt", self.header["num_terms"])
+
+    def term_ids(self):
+        if "term_ids" not in self._cache:
+            self._cache["term_ids"] = {term: i for i, term in enumerate(self.terms())}
+        return self._cache["term_ids"]
+
+    def doc_names(self):
+        return self.lines("docs.txt", self.header["num_doc_numbers"])
+
+    def doc_numbers(self):
+        if "doc_numbers" not in self._cache:
+            self._cache["doc_numbers"] = {id: doc for doc, id in enumerate(self.doc_names()) if id}
+        return self._cache["doc_numbers"]
+
+    def documents(self):
+        if "documents" not in self._cache:
+            self._cache["documents"] = _map_file(self.documents_path, "B")
+        return self._cache["documents"]
+
+
+class _MappedMapping(MutableMapping):
+    """ A mapping over stored values with an in-memory overlay for changes. """
+
+    def __init__(self, files, count):
+        self._files = files
+        self._count = count
+        self._overlay = {}
+        self._deleted = set()
+
+    def _stored_keys(self):
+        raise NotImplementedError
+
+    def _has_stored(self, key):
+        raise NotImplementedError
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        if key in self._overlay:
+            return True
+        return key not in self._deleted and self._has_stored(key)
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._deleted or not self._has_stored(key):
+            raise KeyError(key)
+        return self._load(key)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._count += 1
+        self._overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._overlay.pop(key, None)
+        if self._has_stored(key):
+            self._deleted.add(key)
+        self._count -= 1
+
+    def __iter__(self):
+        # loading a stored value may cache it in the overlay, so snapshot the overlay first
+        overlay = list(self._overlay)
+        overlaid = set(overlay)
+        for key in self._stored_keys():
+            if key not in self._deleted and key not in overlaid:
+                yield key
+        yield from overlay
+
+    def __len__(self):
+        return self._count
+
+    def materialize(self):
+        """ Returns a plain dict copy, e.g. for pickling. """
+        return {key: self[key] for key in self}
+
+
+class MappedTexts(_MappedMapping):
+    """ Document id -> raw text, read from the document store on demand. """
+
+    def __init__(self, files, count):
+        super().__init__(files, count)
+
+        # Dict[str, tuple(int, int)]: store locations of texts written by a later save
+        self._saved_locations = {}
+
+    def _stored_keys(self):
+        return (id for id in self._files.doc_names() if id)
+
+    def _has_stored(self, id):
+        return id in self._files.doc_numbers()
+
+    def _load(self, id):
+        offset, length = self.location(id)
+        return bytes(self._files.documents()[offset:offset + length]).decode("utf-8")
+
+    def location(self, id):
+        """ Returns (offset, length) of the stored text of a document, or None if its
+            current text isn't in the document store yet.
+        """
+        if id in self._saved_locations:
+            return self._saved_locations[id]
+        if id in self._overlay or id in self._deleted or not self._has_stored(id):
+            return None
+        doc = self._files.doc_numbers()[id]
+        locations = self._files.array("docs.text", "Q")
+        return locations[2 * doc], locations[2 * doc + 1]
+
+    def __setitem__(self, id, text):
+        self._saved_locations.pop(id, None)
+        super().__setitem__(id, text)
+
+    def __delitem__(self, id):
+        self._saved_locations.pop(id, None)
+        super().__delitem__(id)
+
+
+class MappedTermVectors(_MappedMapping):
+    """ Document id -> term vector (Counter), rebuilt from the forward index on demand. """
+
+    def _stored_keys(self):
+        return (id for id in self._files.doc_names() if id)
+
+    def _has_stored(self, id):
+        return id in self._files.doc_numbers()
+
+    def _load(self, id):
+        doc = self._files.doc_numbers()[id]
+        offsets = self._files.array("forward.offsets", "Q")
+        lo, hi = offsets[doc], offsets[doc + 1]
+        terms = self._files.terms()
+        term_ids = self._files.array("forward.terms", "I")[lo:hi]
+        tfs = self._files.array("forward.tfs", "I")[lo:hi]
+        return Counter({terms[term_id]: tf for term_id, tf in zip(term_ids, tfs)})
+
+    def materialize(self):
+        return {id: Counter(tv) for id, tv in self.items()}
+
+
+class MappedPostingsIndex(_MappedMapping):
+    """ Term -> Postings whose arrays are views into the memory mapped postings files.
+        Postings are cached once loaded, so modifications stick.
+    """
+
+    def _stored_keys(self):
+        return iter(self._files.terms())
+
+    def _has_stored(self, term):
+        return term in self._files.term_ids()
+
+    def _load(self, term):
+        term_id = self._files.term_ids()[term]
+        offsets = self._files.array("terms.offsets", "Q")
+        lo, hi = offsets[term_id], offsets[term_id + 1]
+        postings = Postings(self._files.array("postings.docs", "I")[lo:hi],
+                            self._files.array("postings.tfs", "I")[lo:hi])
+        self._overlay[term] = postings
+        return postings
+
+    def get(self, term, default=None):
+        # fast path for query(), which looks up every query term with get()
+        postings = self._overlay.get(term)
+        if postings is not None:
+            return postings
+        return super().get(term, default)
+
+
+class MappedPositionsIndex(MappedPostingsIndex):
+    """ Term -> Positions whose offsets and data are views into the memory mapped
+        positions files, parallel to a MappedPostingsIndex.
+    """
+
+    def _load(self, term):
+        term_id = self._files.term_ids()[term]
+        offsets = self._files.array("terms.offsets", "Q")
+        lo, hi = offsets[term_id], offsets[term_id + 1]
+        positions = Positions(self._files.array("postings.posoffsets", "Q")[lo:hi + 1],
+                              self._files.array("postings.positions", "B"))
+        self._overlay[term] = positions
+        return positions
+
+
+# ----------------------------------------------------------------------------
+#  saving
+# ----------------------------------------------------------------------------
+
+def _current_generation(path):
+    """ Returns the name of the live generation directory, or None. """
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _write_array(directory, name, typecode, values):
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(array(typecode, values).tobytes() if not isinstance(values, array) else values.tobytes())
+
+
+def _atomic_write(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_index(search_engine, path, keep=0):
+    """
+    Saves a search engine in the on-disk index format.
+
+    Each save writes a new generation directory and then atomically replaces the
+    CURRENT pointer, so readers never see a half written index. When the engine was
+    opened from the same path with load_index(), texts already in the document store
+    are not written again; only new documents are appended.
+
+    params:
+        search_engine [MySearchEngine]:
+            The search engine to save.
+
+        path [String]:
+            Directory of the index; created if needed.
+
+        keep [int]:
+            Number of earlier generations (and the document stores they use) left in
+            place for readers that opened them with load_index() and may still load
+            their structures; older ones are deleted.
+    """
+    from .SparseSearchEngine import SparseSearchEngine
+    if isinstance(search_engine, SparseSearchEngine):
+        raise TypeError("SparseSearchEngine can't be saved in the index format; pickle it instead.")
+
+    os.makedirs(path, exist_ok=True)
+    previous = _current_generation(path)
+    number = int(previous.split("-")[1]) + 1 if previous else 1
+    name = "gen-%06d" % number
+    directory = os.path.join(path, name)
+    tmp_directory = directory + ".tmp"
+    if os.path.exists(tmp_directory):
+        shutil.rmtree(tmp_directory)
+    # a save that died after renaming its generation but before replacing CURRENT left
+    # it behind unpublished; nothing reads it, and it would block the rename below
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(tmp_directory)
+
+    engine = search_engine
+    raw_text = engine.raw_text
+
+    # append to the engine's own document store if it was opened from this index
+    incremental = isinstance(raw_text, MappedTexts) and \
+        os.path.dirname(os.path.abspath(raw_text._files.documents_path)) == os.path.abspath(path)
+    if incremental:
+        documents_path = raw_text._files.documents_path
+    else:
+        documents_path = os.path.join(path, "documents-%06d.bin" % number)
+        # no published generation uses this store yet, so anything in it was left by such a save
+        if os.path.exists(documents_path):
+            os.remove(documents_path)
+
+    # vocabulary and postings
+    terms = list(engine.inverted_index.keys())
+    term_ids = {term: i for i, term in enumerate(terms)}
+    df = array("I")
+    term_offsets = array("Q", [0])
+    max_ratio = array("d")
+    with open(os.path.join(tmp_directory, "postings.docs"), "wb") as docs_file, \
+            open(os.path.join(tmp_directory, "postings.tfs"), "wb") as tfs_file:
+        for term in terms:
+            postings = engine.inverted_index[term]
+            docs_file.write(postings.docs)
+            tfs_file.write(postings.tfs)
+            df.append(engine.doc_freq[term])
+            term_offsets.append(term_offsets[-1] + len(postings))
+            max_ratio.append(engine._term_max_ratio.get(term, 0.0))
+
+    if engine.positions:
+        position_offsets = array("Q", [0])
+        with open(os.path.join(tmp_directory, "postings.positions"), "wb") as positions_file:
+            for term in terms:
+                positions = engine.positional_index[term]
+                # mapped positions point into a shared buffer, so rebase their offsets
+                first = positions.offsets[0]
+                positions_file.write(positions.data[first:positions.offsets[-1]])
+                base = position_offsets[-1]
+                position_offsets.extend(base + offset - first for offset in positions.offsets[1:])
+        _write_array(tmp_directory, "postings.posoffsets", "Q", position_offsets)
+
+    with open(os.path.join(tmp_directory, "terms.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(terms))
+    _write_array(tmp_directory, "terms.df", "I", df)
+    _write_array(tmp_directory, "terms.offsets", "Q", term_offsets)
+    _write_array(tmp_directory, "terms.maxratio", "d", max_ratio)
+
+    # documents: ids, norms, store locations and forward index
+    doc_names = engine._doc_names
+    text_locations = array("Q")
+    forward_offsets = array("Q", [0])
+    forward_terms = array("I")
+    forward_tfs = array("I")
+    doc_times = array("d")
+    with open(documents_path, "ab") as documents_file:
+        for id in doc_names:
+            doc_times.append(engine.timestamps.get(id, math.nan))
+            if id is None:
+                text_locations.extend((0, 0))
+                forward_offsets.append(forward_offsets[-1])
+                continue
+
+            location = raw_text.location(id) if incremental else None
+            if location is None:
+                data = raw_text[id].encode("utf-8")
+                location = (documents_file.tell(), len(data))
+                documents_file.write(data)
+                if incremental:
+                    raw_text._saved_locations[id] = location
+            text_locations.extend(location)
+
+            for term, tf in engine.term_vectors[id].items():
+                forward_terms.append(term_ids[term])
+                forward_tfs.append(tf)
+            forward_offsets.append(len(forward_terms))
+        documents_file.flush()
+        os.fsync(documents_file.fileno())
+
+    with open(os.path.join(tmp_directory, "docs.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(id or "" for id in doc_names))
+    _write_array(tmp_directory, "docs.norms", "d", engine._doc_norms)
+    _write_array(tmp_directory, "docs.text", "Q", text_locations)
+    _write_array(tmp_directory, "docs.time", "d", doc_times)
+    _write_array(tmp_directory, "forward.offsets", "Q", forward_offsets)
+    _write_array(tmp_directory, "forward.terms", "I", forward_terms)
+    _write_array(tmp_directory, "forward.tfs", "I", forward_tfs)
+
+    with open(os.path.join(tmp_directory, "entities.pkl"), "wb") as f:
+        pickle.dump({"entity_vectors": engine.entity_vectors,
+                     "entity_coocurrences": engine.entity_coocurrences,
+                     "dedup": engine.dedup}, f)
+
+    header = {"format": FORMAT_NAME,
+              "version": FORMAT_VERSION,
+              "byteorder": sys.byteorder,
+              "num_docs": engine.num_docs(),
+              "num_doc_numbers": len(doc_names),
+              "num_terms": len(terms),
+              "documents": os.path.basename(documents_path),
+              "stats_num_docs": engine._stats_num_docs,
+              "stats_changes": engine._stats_changes,
+              "stats_tolerance": engine.stats_tolerance,
+              "retention": engine.retention,
+              "query_cache": None if engine.query_cache is None else
+              {"max_size": engine.query_cache.max_size, "ttl": engine.query_cache.ttl},
+              "tokenizer": engine.tokenizer,
+              "positions": engine.positions}
+    with open(os.path.join(tmp_directory, "header.json"), "w") as f:
+        json.dump(header, f, indent=1)
+
+    # publish the new generation, then clean up what it and the kept ones no longer reference
+    os.rename(tmp_directory, directory)
+    _atomic_write(os.path.join(path, "CURRENT"), name + "\n")
+    generations = sorted(entry for entry in os.listdir(path)
+                         if entry.startswith("gen-") and not entry.endswith(".tmp") and entry < name)
+    kept = set(generations[len(generations) - keep:] if keep > 0 else ()) | {name}
+    documents = {header["documents"]}
+    for entry in kept - {name}:
+        try:
+            with open(os.path.join(path, entry, "header.json")) as f:
+                documents.add(json.load(f)["documents"])
+        except (OSError, ValueError, KeyError):
+            kept.discard(entry)
+    for entry in os.listdir(path):
+        stale_generation = entry.startswith("gen-") and entry not in kept
+        stale_documents = entry.startswith("documents-") and entry not in documents
+        if stale_generation:
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+        elif stale_documents:
+            os.remove(os.path.join(path, entry))
+
+
+# ----------------------------------------------------------------------------
+#  loading
+# ----------------------------------------------------------------------------
+
+def load_index(path, engine_class=MySearchEngine):
+    """
+    Opens a search engine saved with save_index().
+
+    Only the header is read; the other files are memory mapped and each engine
+    structure is materialized on first use.
+
+    params:
+        path [String]:
+            Directory of the index.
+
+        engine_class [type]:
+            MySearchEngine or a subclass of it that shares its term index layout.
+
+    returns:
+        search_engine [MySearchEngine]
+    """
+    name = _current_generation(path)
+    if name is None:
+        raise FileNotFoundError("no index found at [" + path + "].")
+    directory = os.path.join(path, name)
+
+    with open(os.path.join(directory, "header.json")) as f:
+        header = json.load(f)
+    if header.get("format") != FORMAT_NAME:
+        raise ValueError("[" + path + "] is not a news_buddy index.")
+    if header.get("version") not in _READABLE_VERSIONS:
+        raise ValueError("unsupported index format version " + str(header.get("version")) +
+                         " (expected " + str(FORMAT_VERSION) + ").")
+    if header.get("byteorder") != sys.byteorder:
+        raise ValueError("index was written on a " + str(header.get("byteorder")) + "-endian machine.")
+
+    files = _IndexFiles(directory, os.path.join(path, header["documents"]), header)
+
+    def entities():
+        if "entities" not in files._cache:
+            with open(os.path.join(directory, "entities.pkl"), "rb") as f:
+                files._cache["entities"] = pickle.load(f)
+        return files._cache["entities"]
+
+    def entity_coocurrences():
+        coocurrences = entities()["entity_coocurrences"]
+        # indexes written before coocurrences were kept in a sparse matrix
+        if not isinstance(coocurrences, EntityCooccurrence):
+            coocurrences = EntityCooccurrence.from_entity_vectors(entities()["entity_vectors"].values())
+        return coocurrences
+
+    def entity_vectors():
+        vectors = entities()["entity_vectors"]
+        # indexes written before entity vectors were kept in compact arrays
+        if not isinstance(vectors, EntityVectors):
+            vectors = EntityVectors.from_counters(vectors)
+        return vectors
+
+    def timestamps():
+        # generations written before documents had timestamps lack the file
+        if not os.path.exists(os.path.join(directory, "docs.time")):
+            return {}
+        return {id: timestamp for id, timestamp in zip(files.doc_names(), files.array("docs.time", "d"))
+                if id and not math.isnan(timestamp)}
+
+    def doc_norms():
+        norms = array("d")
+        norms.frombytes(files.array("docs.norms", "d").tobytes())
+        return norms
+
+    engine = engine_class()
+    engine._stats_num_docs = header["stats_num_docs"]
+    engine._stats_changes = header.get("stats_changes", 0)
+    engine.stats_tolerance = header["stats_tolerance"]
+    # settings; generations written before they were saved keep the defaults
+    engine.retention = header.get("retention")
+    if "query_cache" in header:
+        engine.query_cache = None if header["query_cache"] is None else QueryCache(**header["query_cache"])
+    # queries must be split like the documents were; older indexes always used nltk
+    engine.tokenizer = header.get("tokenizer", "nltk")
+    engine.positions = header.get("positions", False)
+    engine._lazy_attributes = {
+        "raw_text": lambda: MappedTexts(files, header["num_docs"]),
+        "term_vectors": lambda: MappedTermVectors(files, header["num_docs"]),
+        "inverted_index": lambda: MappedPostingsIndex(files, header["num_terms"]),
+        "positional_index": lambda: MappedPositionsIndex(files, header["num_terms"]) if engine.positions else {},
+        "doc_freq": lambda: Counter(dict(zip(files.terms(), files.array("terms.df", "I")))),
+        "_doc_names": lambda: [id or None for id in files.doc_names()],
+        "_doc_numbers": lambda: dict(files.doc_numbers()),
+        "_doc_norms": doc_norms,
+        "_term_max_ratio": lambda: dict(zip(files.terms(), files.array("terms.maxratio", "d"))),
+        "entity_vectors": entity_vectors,
+        "entity_coocurrences": entity_coocurrences,
+        "timestamps": timestamps,
+        # generations written before near-duplicate detection have none
+        "dedup": lambda: entities().get("dedup"),
+        "_time_buckets": lambda: engine._build_time_buckets(),
+    }
+    for attribute in engine._lazy_attributes:
+        delattr(engine, attribute)
+    return engine
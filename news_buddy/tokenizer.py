@@ -0,0 +1,162 @@
+""" Word tokenizers for MySearchEngine.
+
+    "nltk" is nltk.word_tokenize: Punkt sentence splitting followed by the Treebank
+    word tokenizer. "fast" reproduces the Treebank conventions (clitics such as "n't"
+    and "'s" split off, `` and '' for double quotes, sentence-final periods split off,
+    periods, commas and colons inside words and numbers kept) with one precompiled
+    regular expression and no sentence splitting. Abbreviations are recognized from a
+    fixed list instead of Punkt's model, so the two can disagree on rare tokens;
+    compare_tokenizers() measures how often.
+"""
+from collections import Counter
+from ._lazy import lazy_import
+import re
+import string
+
+nltk = lazy_import("nltk")
+
+__all__ = ["TOKENIZERS", "get_tokenizer", "split_words", "normalize_tokens", "compare_tokenizers"]
+
+# every substring of string.punctuation, i.e. the tokens `token in string.punctuation` filters out
+_PUNCTUATION = frozenset(string.punctuation[i:j]
+                         for i in range(len(string.punctuation))
+                         for j in range(i + 1, len(string.punctuation) + 1))
+
+# characters that always stand alone
+_SEPARATORS = r"""\s;@#$%&?!*()\[\]{}<>"`“”‘’„«»\u2012-\u2015"""
+
+# double quotes become `` when they open a quotation and '' otherwise, as in Treebank
+_OPENING_QUOTE = re.compile(r"""^"|(?<=[\s(\[{<])(?:"|'')""")
+_CLOSING_QUOTE = re.compile(r'"')
+
+_WORD = re.compile(r"""
+      `` | '' | \.{2,} | --
+    # Treebank splits these words in two
+    | (?i: can(?=not\b) | gon(?=na\b) | got(?=ta\b) | gim(?=me\b) | lem(?=me\b) | wan(?=na\b) )
+    # abbreviations keep their period, unless it ends the text
+    | (?: (?:[A-Za-z]\.){2,}
+        | (?i: mr | mrs | ms | dr | prof | sen | rep | gov | gen | col | lt | sgt | capt | st | jr | sr
+             | inc | corp | co | ltd | vs | etc | jan | feb | aug | sept | oct | nov | dec )\.
+      )(?![\w/.-])(?!['")\]}>»”’\s]*$)
+    # clitics, and apostrophes opening a quotation
+    | (?: '[sSmMdD] | '(?:ll|LL|re|RE|ve|VE) | n't | N'T )\b
+    | '(?!(?i:re|ve|ll|m|t|s|d|n)\b)(?=\w)
+    # words: anything up to a separator, keeping apostrophes, periods, commas and colons
+    # inside words and numbers, but stopping before clitics and sentence-final periods
+    | (?: [^""" + _SEPARATORS + r""",:'.nN-]
+        | [nN](?!'[tT]\b)
+        | -(?!-)
+        | '(?!(?:[sSmMdD]|ll|LL|re|RE|ve|VE)\b)(?=\w)
+        | \.(?=[\w/-])
+        | [,:](?=\d)
+      )+
+    | \S
+""", re.VERBOSE)
+
+
+def nltk_words(text):
+    """ Splits text into word tokens with nltk.word_tokenize. """
+    return nltk.word_tokenize(text)
+
+
+# closing quotes and brackets; the abbreviation rule of _WORD looks past them to the end of the text
+_CLOSING = frozenset("'\")]}>»”’")
+
+# _WORD never matches across whitespace and only looks beyond it for the end of the text,
+# so the tokens of a chunk between whitespace can be memoized; maps chunk to its tokens
+_CHUNK_TOKENS = {}
+_CHUNK_CACHE_SIZE = 1 << 16
+
+
+def fast_words(text):
+    """ Splits text into word tokens like nltk.word_tokenize, with a single regular expression. """
+    text = _CLOSING_QUOTE.sub(" '' ", _OPENING_QUOTE.sub(" `` ", text))
+    chunks = text.split()
+
+    # the end of the text: the last chunk with more than closing punctuation, and what follows
+    end = len(chunks)
+    while end > 0 and _CLOSING.issuperset(chunks[end - 1]):
+        end -= 1
+    end = max(end - 1, 0)
+
+    cache = _CHUNK_TOKENS
+    if len(cache) > _CHUNK_CACHE_SIZE:
+        cache.clear()
+    words = []
+    for chunk in chunks[:end]:
+        tokens = cache.get(chunk)
+        if tokens is None:
+            # more text follows the chunk, as the trailing word stands for
+            tokens = cache[chunk] = _WORD.findall(chunk + " _")[:-1]
+        words.extend(tokens)
+    words.extend(_WORD.findall(" ".join(chunks[end:])))
+    return words
+
+
+# Dict[str, function]: word splitters selectable by name
+TOKENIZERS = {"nltk": nltk_words, "fast": fast_words}
+
+
+def get_tokenizer(name):
+    """ Returns the word splitter registered in TOKENIZERS under name. """
+    if name not in TOKENIZERS:
+        raise ValueError("unknown tokenizer [" + str(name) + "], expected one of " +
+                         ", ".join(TOKENIZERS) + ".")
+    return TOKENIZERS[name]
+
+
+def split_words(text, tokenizer="nltk"):
+    """ Splits text into word tokens (case and punctuation kept) with the named tokenizer. """
+    return get_tokenizer(tokenizer)(text)
+
+
+def normalize_tokens(words):
+    """ Lowercases word tokens and filters out punctuation (as in string.punctuation). """
+    return [token.lower() for token in words if token not in _PUNCTUATION]
+
+
+def compare_tokenizers(texts, reference="nltk", candidate="fast", max_examples=20):
+    """
+    Tokenizes a sample corpus with two tokenizers and reports how well they agree,
+    after the same normalization MySearchEngine.tokenize applies.
+
+    params:
+        texts[Iterable(str)]:
+            The sample documents.
+
+        reference[str], candidate[str]:
+            Names of the tokenizers to compare (see TOKENIZERS).
+
+        max_examples[int]:
+            Number of most frequent disagreeing tokens to report.
+
+    returns:
+        report[dict]:
+            "documents" and "identical_documents" (documents tokenized identically),
+            "tokens" (reference tokens), "agreement" (fraction of reference tokens that
+            the candidate produced as well, counted as multisets) and "only_reference" /
+            "only_candidate" (the most common tokens produced by only one of them).
+    """
+    documents = identical = tokens = shared = 0
+    only_reference = Counter()
+    only_candidate = Counter()
+    for text in texts:
+        expected = normalize_tokens(split_words(text, reference))
+        actual = normalize_tokens(split_words(text, candidate))
+        documents += 1
+        tokens += len(expected)
+        if expected == actual:
+            identical += 1
+            shared += len(expected)
+            continue
+        expected_counts, actual_counts = Counter(expected), Counter(actual)
+        shared += sum((expected_counts & actual_counts).values())
+        only_reference.update(expected_counts - actual_counts)
+        only_candidate.update(actual_counts - expected_counts)
+
+    return {"documents": documents,
+            "identical_documents": identical,
+            "tokens": tokens,
+            "agreement": shared / tokens if tokens else 1.0,
+            "only_reference": only_reference.most_common(max_examples),
+            "only_candidate": only_candidate.most_common(max_examples)}